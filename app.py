@@ -1,405 +1,1140 @@
-import logging
-import json
-import asyncio
-import warnings
-
-# 忽略 lark_oapi 的弃用警告，避免日志污染
-warnings.filterwarnings('ignore', category=UserWarning, module='lark_oapi')
-
-from flask import Flask
-import lark_oapi as lark
-from lark_oapi.adapter.flask import parse_req
-from lark_oapi.api.im.v1 import CreateMessageRequest, CreateMessageResponse, CreateMessageRequestBody, P2ImMessageReceiveV1
-import redis
-
-from config_manager import ConfigManager
-from deepseek_client import DeepSeekClient
-
-app = Flask(__name__)
-config = ConfigManager()
-
-# 配置日志，生产环境记录到文件，开发环境仅输出到控制台
-log_level = config.get_log_level()
-logging.basicConfig(
-    level=log_level,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('logs/app.log'),
-        logging.StreamHandler()
-    ] if config.is_production() else [logging.StreamHandler()]
-)
-logger = logging.getLogger(__name__)
-
-# 记录当前环境
-logger.info(f'应用启动，运行环境: {"生产环境" if config.is_production() else "开发环境"}')
-
-# 初始化 Redis 客户端连接池，提升连接复用效率
-redis_pool = redis.ConnectionPool(
-    host=config.get('REDIS_HOST'),
-    port=int(config.get('REDIS_PORT', 6379)),
-    decode_responses=True,
-    socket_connect_timeout=5,
-    socket_timeout=5,
-    retry_on_timeout=True,
-    health_check_interval=30,
-    max_connections=10
-)
-redis_client = redis.Redis(connection_pool=redis_pool)
-
-# 检查 Redis 连接，重试机制提升健壮性
-redis_connection_retry = 3
-connected = False
-for i in range(redis_connection_retry):
-    try:
-        redis_client.ping()
-        logger.info("成功连接到Redis服务")
-        connected = True
-        break
-    except redis.ConnectionError as e:
-        logger.warning(f"Redis连接尝试 {i+1}/{redis_connection_retry} 失败: {str(e)}")
-        if i < redis_connection_retry - 1:
-            import time
-            time.sleep(1)
-
-if not connected:
-    logger.error("无法连接到Redis服务，请检查配置和服务状态")
-    if config.is_production():
-        exit(1)
-    else:
-        logger.warning("开发环境下Redis连接失败，继续运行但部分功能可能受限")
-
-# 事件ID过期时间（秒），合理设置避免Redis空间占用过大
-EVENT_EXPIRE_SECONDS = 3600
-
-# Redis操作最大重试次数，提升分布式去重健壮性
-REDIS_MAX_RETRIES = 3
-
-# Redis重试间隔（秒），防止频繁重试导致性能下降
-REDIS_RETRY_INTERVAL = 0.1
-
-# 启动前检查必要配置，缺失则直接退出，保证服务安全
-required_configs = ['DEEPSEEK_API_KEY', 'FEISHU_ENCRYPT_KEY', 'FEISHU_VERIFICATION_TOKEN', 'FEISHU_APP_ID', 'FEISHU_APP_SECRET']
-if config.is_production():
-    required_configs.extend(['REDIS_HOST', 'REDIS_PORT'])
-
-missing = [key for key in required_configs if not config.get(key)]
-if missing:
-    logger.error(f"缺少必要配置: {', '.join(missing)}")
-    exit(1)
-
-ds_client = DeepSeekClient(config.get('DEEPSEEK_API_KEY'), config.get('DEEPSEEK_API_URL', 'https://api.deepseek.com/v1'))
-
-# 初始化飞书客户端，统一日志等级
-client = lark.Client.builder() \
-    .app_id(config.get('FEISHU_APP_ID')) \
-    .app_secret(config.get('FEISHU_APP_SECRET')) \
-    .log_level(lark.LogLevel.INFO) \
-    .build()
-
-def get_sender_open_id(data):
-    """获取发送者的 open_id，兼容不同 SDK 版本，优先返回 open_id，其次 user_id"""
-    try:
-        if hasattr(data, 'event'):
-            if hasattr(data.event, 'sender'):
-                if hasattr(data.event.sender, 'sender_id'):
-                    if hasattr(data.event.sender.sender_id, 'open_id'):
-                        return data.event.sender.sender_id.open_id
-                    elif hasattr(data.event.sender.sender_id, 'user_id'):
-                        return data.event.sender.sender_id.user_id
-                    raise AttributeError("sender_id对象缺少open_id或user_id属性")
-                elif hasattr(data.event.sender, 'open_id'):
-                    return data.event.sender.open_id
-                elif hasattr(data.event.sender, 'user_id'):
-                    return data.event.sender.user_id
-                raise AttributeError("sender对象缺少必要的ID属性")
-            elif hasattr(data.event, 'user_id'):
-                return data.event.user_id
-            raise AttributeError("event对象缺少发送者信息")
-        elif hasattr(data, 'sender'):
-            if hasattr(data.sender, 'sender_id') and hasattr(data.sender.sender_id, 'open_id'):
-                return data.sender.sender_id.open_id
-            elif hasattr(data.sender, 'open_id'):
-                return data.sender.open_id
-            raise AttributeError("sender对象缺少必要的ID属性")
-        elif hasattr(data, 'user_id'):
-            return data.user_id
-        raise AttributeError("无法找到发送者ID属性")
-    except AttributeError as e:
-        logger.error(f"无法获取发送者ID: {str(e)}")
-        return None
-
-async def send_chunk(chunk, user_open_id):
-    """发送流式回复的 chunk，失败自动记录日志"""
-    try:
-        content = chunk.get('content', '')
-        if content and user_open_id:
-            message_content = json.dumps({"text": content})
-            req = CreateMessageRequest.builder() \
-                .receive_id_type("open_id") \
-                .request_body(CreateMessageRequestBody.builder()
-                    .receive_id(user_open_id)
-                    .msg_type("text")
-                    .content(message_content)
-                    .build()) \
-                .build()
-            resp: CreateMessageResponse = client.im.v1.message.create(req)
-            if resp.code != 0:
-                logger.error(f"发送流式回复chunk失败: {resp.msg}")
-            else:
-                logger.info(f"流式回复chunk发送成功，消息ID: {resp.data.message_id}")
-    except Exception as e:
-        logger.error(f"发送流式回复chunk异常: {str(e)}")
-
-async def process_message(user_msg, context=None, user_open_id=None, ds_client=None):
-    """异步处理消息，自动选择 DeepSeek 客户端"""
-    try:
-        client = ds_client or globals().get('ds_client')
-        if not client:
-            raise ValueError('DeepSeek client not available')
-        # 统一温度参数，关闭流式
-        return await client.reason(user_msg, context=context, temperature=0.3, stream=False)
-    except Exception as e:
-        logger.exception(f"处理消息时发生异常: {str(e)}")
-        return '服务暂时不可用，请稍后再试'
-
-async def async_do_p2_im_message_receive_v1(data: P2ImMessageReceiveV1):
-    """异步处理飞书消息事件，包含去重、指令解析、上下文维护和异常记录"""
-    try:
-        # 获取事件ID，优先使用 event_id，其次 message_id
-        try:
-            event_id = None
-            if hasattr(data, 'event') and hasattr(data.event, 'event_id'):
-                event_id = data.event.event_id
-            elif hasattr(data, 'event_id'):
-                event_id = data.event_id
-            if not event_id and hasattr(data, 'event') and hasattr(data.event, 'message') and hasattr(data.event.message, 'message_id'):
-                event_id = data.event.message.message_id
-            if not event_id:
-                raise AttributeError("无法找到事件ID或消息ID")
-        except AttributeError as e:
-            logger.error(f"无法获取事件ID: {str(e)}")
-            return None
-
-        # Redis 分布式去重，防止重复处理事件，重试机制提升健壮性
-        redis_key = f"event:{event_id}"
-        logger.debug(f"尝试设置Redis去重键: {redis_key}")
-        result = False
-        retry_count = 0
-        while retry_count < REDIS_MAX_RETRIES and not result:
-            try:
-                result = redis_client.set(redis_key, "processed", ex=EVENT_EXPIRE_SECONDS, nx=True)
-                retry_count += 1
-                if not result and retry_count < REDIS_MAX_RETRIES:
-                    logger.debug(f"Redis设置失败，准备重试 ({retry_count}/{REDIS_MAX_RETRIES})")
-                    await asyncio.sleep(REDIS_RETRY_INTERVAL)
-            except redis.ConnectionError as e:
-                logger.error(f"Redis连接错误: {str(e)}")
-                retry_count += 1
-                if retry_count < REDIS_MAX_RETRIES:
-                    await asyncio.sleep(REDIS_RETRY_INTERVAL)
-            except Exception as e:
-                logger.error(f"Redis去重操作异常: {str(e)}")
-                break
-        logger.debug(f"Redis设置结果: {result}")
-        if not result:
-            logger.warning(f"事件 {event_id} 已处理或Redis设置失败，跳过重复处理")
-            return None
-        logger.info(f"事件 {event_id} 标记为已处理")
-
-        # 验证消息类型，仅处理文本消息
-        if data.event.message.message_type != 'text':
-            logger.warning(f"忽略非文本消息: {data.event.message.message_type}")
-            return None
-
-        # 解析消息内容，异常自动记录
-        raw_content = data.event.message.content
-        if not raw_content:
-            logger.error("收到空消息内容")
-            return None
-        try:
-            content_dict = json.loads(raw_content)
-            user_msg = content_dict.get('text', '').strip()
-        except (TypeError, json.JSONDecodeError) as e:
-            logger.error(f"解析消息内容失败: {e}")
-            user_msg = ''
-        if not user_msg:
-            return None
-
-        # 指令消息处理，支持余额、清除上下文、帮助
-        if user_msg.strip() == "查询余额" or user_msg.strip().startswith("/查询余额"):
-            try:
-                balance_info = await ds_client.get_balance()
-                is_available = balance_info.get("is_available", False)
-                balance_details = balance_info.get("balance_infos", [])
-                reply = f"账户余额状态: {'有可用余额' if is_available else '无可用余额'}\n"
-                if balance_details:
-                    reply += "余额详情:\n"
-                    for detail in balance_details:
-                        currency = detail.get('currency', '未知货币')
-                        total_balance = detail.get('total_balance', '0')
-                        granted_balance = detail.get('granted_balance', '0')
-                        topped_up_balance = detail.get('topped_up_balance', '0')
-                        reply += f"- 货币类型: {currency}\n"
-                        reply += f"- 总余额: {total_balance} {currency}\n"
-                        reply += f"- 赠额余额: {granted_balance} {currency}\n"
-                        reply += f"- 充值余额: {topped_up_balance} {currency}\n"
-                else:
-                    reply += "暂无余额详情"
-            except Exception as e:
-                reply = f"查询余额失败: {str(e)}"
-        elif user_msg.strip().startswith("/清除上下文"):
-            try:
-                user_open_id = get_sender_open_id(data)
-                if user_open_id:
-                    redis_key = f"context:{user_open_id}"
-                    redis_client.delete(redis_key)
-                    reply = "🧹对话上下文已清除"
-                else:
-                    reply = "无法获取用户信息，清除上下文失败"
-            except Exception as e:
-                reply = f"清除上下文失败: {str(e)}"
-        elif user_msg.strip().startswith("/帮助") or user_msg.strip().startswith("/help") or user_msg.strip().startswith("/指定"):
-            reply = "🤖 机器人指令说明\n\n"
-            reply += "📌 查询余额\n"
-            reply += "   指令: /查询余额\n"
-            reply += "   功能: 查询DeepSeek API账户余额\n\n"
-            reply += "📌 清除上下文\n"
-            reply += "   指令: /清除上下文\n"
-            reply += "   功能: 清除当前对话的上下文历史\n\n"
-            reply += "📌 帮助\n"
-            reply += "   指令: /帮助 或 /help 或 /指定\n"
-            reply += "   功能: 查看所有可用指令说明\n\n"
-            reply += "💡 提示: 直接发送消息即可进行正常对话，机器人会自动维护上下文"
-        else:
-            # 普通消息处理，自动维护上下文，异常自动记录
-            try:
-                user_open_id = get_sender_open_id(data)
-                context = []
-                if user_open_id:
-                    redis_key = f"context:{user_open_id}"
-                    context_str = redis_client.get(redis_key)
-                    if context_str:
-                        try:
-                            context = json.loads(context_str)
-                        except json.JSONDecodeError:
-                            logger.error(f"解析上下文失败，用户: {user_open_id}")
-                            context = []
-                response = await process_message(user_msg, context=context, user_open_id=user_open_id)
-                if response and user_open_id:
-                    logger.debug(f"准备发送回复给用户 {user_open_id}: {response[:30]}...")
-                    reply = response
-                    # 更新上下文，最多保留10条
-                    new_context = context.copy()
-                    new_context.append({"role": "user", "content": user_msg})
-                    if len(new_context) > 10:
-                        new_context = new_context[-10:]
-                    redis_client.set(redis_key, json.dumps(new_context), ex=86400)
-                else:
-                    reply = None
-            except Exception as e:
-                logger.exception(f"处理消息时发生异常: {str(e)}")
-                reply = '服务暂时不可用，请稍后再试'
-                # 记录异常事件，便于后续排查
-                try:
-                    error_event_key = f"error:event:{event_id}"
-                    error_info = {
-                        'timestamp': asyncio.get_event_loop().time(),
-                        'error_type': type(e).__name__,
-                        'error_message': str(e),
-                        'user_open_id': user_open_id,
-                        'user_msg': user_msg
-                    }
-                    redis_client.set(error_event_key, json.dumps(error_info), ex=86400)
-                except Exception as redis_e:
-                    logger.error(f"记录异常事件到Redis失败: {str(redis_e)}")
-
-        # 发送消息，失败自动重试，最多3次
-        if reply is not None:
-            user_open_id = get_sender_open_id(data)
-            if not user_open_id:
-                logger.error("无法获取发送者ID，消息发送失败")
-                return None
-            max_retries = 3
-            retry_count = 0
-            sent_successfully = False
-            message_id = None
-            while retry_count < max_retries and not sent_successfully:
-                try:
-                    req = CreateMessageRequest.builder() \
-                        .receive_id_type("open_id") \
-                        .request_body(CreateMessageRequestBody.builder()
-                            .receive_id(user_open_id)
-                            .msg_type("text")
-                            .content(json.dumps({"text": reply}))
-                            .build()) \
-                        .build()
-                    resp: CreateMessageResponse = client.im.v1.message.create(req)
-                    if resp.code != 0:
-                        logger.error(f"发送消息失败: {resp.msg}, 错误码: {resp.code}, 重试次数: {retry_count+1}/{max_retries}")
-                        retry_count += 1
-                        if retry_count < max_retries:
-                            await asyncio.sleep(0.2)
-                    else:
-                        message_id = resp.data.message_id
-                        logger.info(f"消息发送成功，消息ID: {message_id}, 用户: {user_open_id}")
-                        sent_successfully = True
-                except Exception as e:
-                    logger.error(f"发送消息异常: {str(e)}, 重试次数: {retry_count+1}/{max_retries}")
-                    retry_count += 1
-                    if retry_count < max_retries:
-                        await asyncio.sleep(0.2)
-            if not sent_successfully:
-                logger.error(f"消息发送失败，已达到最大重试次数 ({max_retries})")
-        return None
-    except Exception as e:
-        logger.exception(f"处理消息时发生异常: {str(e)}")
-        return None
-
-# 创建全局事件循环，避免每次请求创建新循环，提升性能
-try:
-    loop = asyncio.get_event_loop()
-except RuntimeError:
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-
-def do_p2_im_message_receive_v1(data: P2ImMessageReceiveV1):
-    """同步处理飞书消息事件，封装异步主逻辑"""
-    try:
-        return loop.run_until_complete(async_do_p2_im_message_receive_v1(data))
-    except Exception as e:
-        logger.exception(f"处理消息时发生异常: {str(e)}")
-        return {'msg_type': 'text', 'content': {'text': '服务暂时不可用，请稍后再试'}}
-
-# 初始化事件处理器，注册消息回调
-handler = lark.EventDispatcherHandler.builder(
-    config.get('FEISHU_ENCRYPT_KEY'),
-    config.get('FEISHU_VERIFICATION_TOKEN'),
-    lark.LogLevel.INFO
-).register_p2_im_message_receive_v1(do_p2_im_message_receive_v1).build()
-
-@app.route('/feishu/callback', methods=['POST'])
-def handle_feishu():
-    """处理飞书回调请求，异常自动记录"""
-    try:
-        req = parse_req()
-        handler.do(req)
-        return "OK", 200
-    except Exception as e:
-        logger.exception("处理飞书回调时发生异常")
-        return "Server Error", 500
-
-if __name__ == '__main__':
-    port = int(config.get('PORT', 5000))
-    logger.info(f"启动服务在端口 {port}")
-    server_type = config.get('SERVER', 'waitress')
-    # 根据配置选择服务器类型，生产环境推荐 waitress
-    if server_type == 'waitress':
-        from waitress import serve
-        logger.info("使用Waitress服务器 (同步模式)")
-        serve(app, host='0.0.0.0', port=port, threads=4)
-    elif server_type == 'gunicorn':
-        logger.warning("Gunicorn服务器需要通过命令行启动，此处将使用Flask开发服务器")
-        app.run(host='0.0.0.0', port=port)
-    else:
-        logger.warning("使用Flask开发服务器 - 仅限测试环境")
-        app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+import logging
+import json
+import asyncio
+import atexit
+import hashlib
+import os
+import sys
+import threading
+import time
+import warnings
+from typing import TYPE_CHECKING
+
+# 记录本模块的导入耗时，用于检查启动开销是否超出 IMPORT_TIME_BUDGET
+IMPORT_STARTED = time.perf_counter()
+
+# 忽略 lark_oapi 的弃用警告，避免日志污染
+warnings.filterwarnings('ignore', category=UserWarning, module='lark_oapi')
+
+# lark_oapi 导入需要数秒，Flask 只在 WSGI 模式下使用，二者都在首次使用或预热时才导入
+import redis
+
+from config_manager import ConfigManager
+from deepseek_client import REASONER_MODEL, DeepSeekClient, is_deepseek_failure
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from hedging import LatencyTracker
+from singleflight import SingleFlight
+from rate_limiter import RateLimiter
+from stream_card import StreamingCardReply
+from feishu_sender import FeishuSender
+from redis_store import AsyncRedisStore
+from conversation_store import RedisConversationStore, MemoryConversationStore
+from context_builder import SYSTEM_PROMPT, SYSTEM_PROMPT_VERSION, ContextBuilder
+from response_cache import ResponseCache
+from worker_pool import MessageWorkerPool
+from scheduler import KeyedScheduler
+from event_stream import EventStreamPublisher
+from event_dedupe import CLAIMED, DUPLICATE, EventDeduplicator
+from message_coalescer import MessageCoalescer
+from model_router import ModelRouter
+from usage_accounting import CHAT, USER, UsageAccountant, usage_total
+from inflight import CLEAR, STOP, SUPERSEDED, GenerationCancelled, InflightRegistry
+from readiness import ReadinessProbe
+from logging_setup import PayloadLogger, bind_event_id, reset_event_id, setup_logging
+from metrics import (CONTEXT_TRIMMED_TOKENS, DUPLICATE_EVENTS, EVENTS, QUOTA_EXCEEDED, ROUTE_DECISIONS, ROUTE_SECONDS,
+                     STAGE_SECONDS, STARTUP_SECONDS, render as render_metrics, timed)
+
+if TYPE_CHECKING:
+    # 仅用于类型注解，运行时不导入 lark SDK
+    from lark_oapi.api.im.v1 import P2ImMessageReceiveV1
+
+config = ConfigManager()
+
+# 配置日志，生产环境记录到文件，开发环境仅输出到控制台；写盘在后台线程进行，不阻塞请求处理
+log_level = config.get_log_level()
+setup_logging(
+    level=log_level,
+    log_format=config.get('LOG_FORMAT', 'json').lower(),
+    log_file='logs/app.log' if config.is_production() else None,
+    queue_size=int(config.get('LOG_QUEUE_SIZE', 10000))
+)
+logger = logging.getLogger(__name__)
+
+# 请求/响应载荷只按比例采样记录，截断并隐去消息正文和凭证
+payload_logger = PayloadLogger(
+    sample_rate=float(config.get('LOG_PAYLOAD_SAMPLE_RATE', 0.01)),
+    max_chars=int(config.get('LOG_PAYLOAD_MAX_CHARS', 2000)),
+    redact_text=config.get('LOG_REDACT_MESSAGES', 'true').lower() == 'true'
+)
+
+# 记录当前环境
+logger.info("应用启动，运行环境: %s", "生产环境" if config.is_production() else "开发环境")
+
+# 初始化 Redis 客户端连接池，提升连接复用效率
+redis_pool = redis.ConnectionPool(
+    host=config.get('REDIS_HOST'),
+    port=int(config.get('REDIS_PORT', 6379)),
+    db=int(config.get('REDIS_DB', 0)),
+    decode_responses=True,
+    socket_connect_timeout=5,
+    socket_timeout=5,
+    retry_on_timeout=True,
+    health_check_interval=30,
+    max_connections=10
+)
+redis_client = redis.Redis(connection_pool=redis_pool)
+
+# 消息处理协程使用的异步 Redis 客户端，连接池按 worker 并发数调整，避免阻塞事件循环
+redis_store = AsyncRedisStore(
+    host=config.get('REDIS_HOST'),
+    port=int(config.get('REDIS_PORT', 6379)),
+    db=int(config.get('REDIS_DB', 0)),
+    max_connections=int(config.get('REDIS_MAX_CONNECTIONS', int(config.get('WORKER_POOL_SIZE', 16)) + 4))
+)
+
+# 对话历史存储，生产环境使用 Redis 列表，开发测试可切换为进程内存储
+CONVERSATION_BACKEND = config.get('CONVERSATION_BACKEND', 'redis').lower()
+CONVERSATION_MAX_TURNS = int(config.get('CONVERSATION_MAX_TURNS', 20))
+CONVERSATION_TTL = int(config.get('CONVERSATION_TTL', 86400))
+if CONVERSATION_BACKEND == 'memory':
+    conversation_store = MemoryConversationStore(max_turns=CONVERSATION_MAX_TURNS, ttl=CONVERSATION_TTL)
+else:
+    conversation_store = RedisConversationStore(redis_store, max_turns=CONVERSATION_MAX_TURNS, ttl=CONVERSATION_TTL)
+
+# 流式回复模式：首个 token 到达即发送卡片，之后合并增量持续更新同一张卡片
+STREAM_REPLY_MODE = config.get('STREAM_REPLY_MODE', 'false').lower() == 'true'
+STREAM_UPDATE_INTERVAL = float(config.get('STREAM_UPDATE_INTERVAL', 0.5))
+STREAM_UPDATE_MIN_CHARS = int(config.get('STREAM_UPDATE_MIN_CHARS', 20))
+STREAM_SHOW_REASONING = config.get('STREAM_SHOW_REASONING', 'false').lower() == 'true'
+
+# 事件ID过期时间（秒），合理设置避免Redis空间占用过大
+EVENT_EXPIRE_SECONDS = 3600
+
+# Redis操作最大重试次数，提升分布式去重健壮性
+REDIS_MAX_RETRIES = 3
+
+# Redis重试间隔（秒），防止频繁重试导致性能下降
+REDIS_RETRY_INTERVAL = 0.1
+
+# 熔断：依赖在滑动窗口内失败率过高时立即返回降级结果，不再等待超时或重试，半开探测成功后恢复
+CIRCUIT_BREAKER_ENABLED = config.get('CIRCUIT_BREAKER_ENABLED', 'true').lower() == 'true'
+CIRCUIT_BREAKER_FAILURE_RATE = float(config.get('CIRCUIT_BREAKER_FAILURE_RATE', 0.5))
+CIRCUIT_BREAKER_MIN_CALLS = int(config.get('CIRCUIT_BREAKER_MIN_CALLS', 10))
+CIRCUIT_BREAKER_WINDOW = int(config.get('CIRCUIT_BREAKER_WINDOW', 30))
+redis_breaker = CircuitBreaker(
+    'redis',
+    failure_rate=CIRCUIT_BREAKER_FAILURE_RATE,
+    min_calls=CIRCUIT_BREAKER_MIN_CALLS,
+    window=CIRCUIT_BREAKER_WINDOW,
+    open_seconds=float(config.get('REDIS_CIRCUIT_OPEN_SECONDS', 5)),
+    # 命令错误说明 Redis 仍在正常响应，只有连接和超时计为故障
+    is_failure=lambda e: isinstance(e, (redis.ConnectionError, redis.TimeoutError))
+) if CIRCUIT_BREAKER_ENABLED else None
+deepseek_breaker = CircuitBreaker(
+    'deepseek',
+    failure_rate=CIRCUIT_BREAKER_FAILURE_RATE,
+    min_calls=CIRCUIT_BREAKER_MIN_CALLS,
+    window=CIRCUIT_BREAKER_WINDOW,
+    open_seconds=float(config.get('DEEPSEEK_CIRCUIT_OPEN_SECONDS', 30)),
+    is_failure=is_deepseek_failure
+) if CIRCUIT_BREAKER_ENABLED else None
+# DeepSeek 熔断期间的降级回复
+CIRCUIT_OPEN_REPLY = 'DeepSeek 服务暂时不可用，请稍后再试'
+
+# 进程内去重记录的条数上限与过期时间；Redis 不可用时是否继续处理（fail-open）还是放弃处理（fail-closed）
+DEDUPE_LOCAL_MAX_ENTRIES = int(config.get('DEDUPE_LOCAL_MAX_ENTRIES', 10000))
+DEDUPE_LOCAL_TTL = int(config.get('DEDUPE_LOCAL_TTL', 600))
+DEDUPE_FAIL_OPEN = config.get('DEDUPE_FAIL_OPEN', 'true').lower() == 'true'
+event_dedupe = EventDeduplicator(
+    redis_store,
+    conversation_store,
+    event_expire=EVENT_EXPIRE_SECONDS,
+    max_entries=DEDUPE_LOCAL_MAX_ENTRIES,
+    local_ttl=DEDUPE_LOCAL_TTL,
+    fail_open=DEDUPE_FAIL_OPEN,
+    max_retries=REDIS_MAX_RETRIES,
+    retry_interval=REDIS_RETRY_INTERVAL,
+    circuit_breaker=redis_breaker
+)
+
+def check_required_configs():
+    """启动服务前检查必要配置，缺失则直接退出，保证服务安全"""
+    required_configs = ['DEEPSEEK_API_KEY', 'FEISHU_ENCRYPT_KEY', 'FEISHU_VERIFICATION_TOKEN', 'FEISHU_APP_ID', 'FEISHU_APP_SECRET']
+    if config.is_production():
+        required_configs.extend(['REDIS_HOST', 'REDIS_PORT'])
+    missing = [key for key in required_configs if not config.get(key)]
+    if missing:
+        logger.error("缺少必要配置: %s", ', '.join(missing))
+        exit(1)
+
+# 合并并发的相同 DeepSeek 请求，可选通过 Redis 在多个进程之间协调
+SINGLEFLIGHT_ENABLED = config.get('SINGLEFLIGHT_ENABLED', 'true').lower() == 'true'
+singleflight = SingleFlight(
+    redis_store=redis_store if config.get('SINGLEFLIGHT_REDIS', 'false').lower() == 'true' else None,
+    lock_ttl=int(config.get('SINGLEFLIGHT_LOCK_TTL', 120)),
+    result_ttl=int(config.get('SINGLEFLIGHT_RESULT_TTL', 10))
+) if SINGLEFLIGHT_ENABLED else None
+
+# DeepSeek 客户端侧限流：RPM/TPM 令牌桶排队、AIMD 并发控制、429/5xx 退避重试，可选通过 Redis 跨进程共享额度
+rate_limiter = RateLimiter(
+    rpm=int(config.get('DEEPSEEK_RPM_LIMIT', 0)),
+    tpm=int(config.get('DEEPSEEK_TPM_LIMIT', 0)),
+    max_concurrency=int(config.get('DEEPSEEK_MAX_CONCURRENCY', 50)),
+    max_retries=int(config.get('DEEPSEEK_MAX_RETRIES', 3)),
+    base_delay=float(config.get('DEEPSEEK_RETRY_BASE_DELAY', 1.0)),
+    max_delay=float(config.get('DEEPSEEK_RETRY_MAX_DELAY', 20.0)),
+    redis_store=redis_store if config.get('RATE_LIMIT_REDIS', 'false').lower() == 'true' else None
+)
+
+# deepseek-chat 对冲请求（可选）：超过最近首包耗时的分位数仍未返回时再发一个相同请求，取先返回的结果；
+# 流式首包耗时与非流式完整回复耗时分布不同，分别统计
+DEEPSEEK_HEDGE_ENABLED = config.get('DEEPSEEK_HEDGE_ENABLED', 'false').lower() == 'true'
+
+def make_hedge_tracker():
+    return LatencyTracker(
+        percentile=float(config.get('DEEPSEEK_HEDGE_PERCENTILE', 0.95)),
+        min_delay=float(config.get('DEEPSEEK_HEDGE_MIN_DELAY', 0.5)),
+        max_delay=float(config.get('DEEPSEEK_HEDGE_MAX_DELAY', 10))
+    ) if DEEPSEEK_HEDGE_ENABLED else None
+
+# DeepSeek 客户端持有长连接池，连接池参数均可通过环境变量调整
+ds_client = DeepSeekClient(
+    config.get('DEEPSEEK_API_KEY'),
+    config.get('DEEPSEEK_API_URL', 'https://api.deepseek.com/v1'),
+    pool_limit=int(config.get('DEEPSEEK_POOL_LIMIT', 100)),
+    pool_limit_per_host=int(config.get('DEEPSEEK_POOL_LIMIT_PER_HOST', 30)),
+    dns_cache_ttl=int(config.get('DEEPSEEK_DNS_CACHE_TTL', 300)),
+    keepalive_timeout=float(config.get('DEEPSEEK_KEEPALIVE_TIMEOUT', 60)),
+    connect_timeout=float(config.get('DEEPSEEK_CONNECT_TIMEOUT', 10)),
+    read_timeout=float(config.get('DEEPSEEK_READ_TIMEOUT', 300)),
+    verify_ssl=config.get('DEEPSEEK_VERIFY_SSL', 'true').lower() == 'true',
+    singleflight=singleflight,
+    balance_cache_ttl=int(config.get('BALANCE_CACHE_TTL', 30)),
+    balance_stale_ttl=int(config.get('BALANCE_STALE_TTL', 300)),
+    rate_limiter=rate_limiter,
+    completion_token_estimate=int(config.get('DEEPSEEK_COMPLETION_TOKEN_ESTIMATE', 1000)),
+    payload_logger=payload_logger,
+    circuit_breaker=deepseek_breaker,
+    hedge_tracker=make_hedge_tracker(),
+    non_stream_hedge_tracker=make_hedge_tracker()
+)
+
+# 按 token 预算组装上下文：固定的系统提示词 + 只追加的历史，保持请求前缀稳定以命中 DeepSeek 上下文缓存；
+# 超出预算时一次性压缩较早的大段消息，由 deepseek-chat 在后台折叠为摘要
+CONTEXT_SUMMARY_ENABLED = config.get('CONTEXT_SUMMARY_ENABLED', 'true').lower() == 'true'
+# 自定义系统提示词时需同时设置新的版本号，便于对照缓存命中率的变化
+SYSTEM_PROMPT_TEXT = config.get('SYSTEM_PROMPT', SYSTEM_PROMPT)
+SYSTEM_PROMPT_TAG = config.get('SYSTEM_PROMPT_VERSION', SYSTEM_PROMPT_VERSION if SYSTEM_PROMPT_TEXT == SYSTEM_PROMPT else 'custom')
+logger.info("系统提示词版本: %s", SYSTEM_PROMPT_TAG)
+context_builder = ContextBuilder(
+    conversation_store,
+    summarizer=(lambda prompt: ds_client.chat(prompt, temperature=0.3, hedge=False)) if CONTEXT_SUMMARY_ENABLED else None,
+    token_budget=int(config.get('CONTEXT_TOKEN_BUDGET', 6000)),
+    summary_max_chars=int(config.get('CONTEXT_SUMMARY_MAX_CHARS', 1500)),
+    system_prompt=SYSTEM_PROMPT_TEXT,
+    compact_ratio=float(config.get('CONTEXT_COMPACT_RATIO', 0.5))
+)
+
+# 普通对话默认使用的模型与温度参数
+REPLY_MODEL = REASONER_MODEL
+REPLY_TEMPERATURE = 0.3
+
+# 模型路由：简单消息走 deepseek-chat 快速回复，较长或涉及代码、数学、推理的消息走 deepseek-reasoner
+model_router = ModelRouter(
+    default_route=config.get('MODEL_ROUTE_DEFAULT', 'auto').lower(),
+    fast_max_chars=int(config.get('MODEL_ROUTE_FAST_MAX_CHARS', 60)),
+    chat_defaults=ModelRouter.parse_chat_defaults(config.get('MODEL_ROUTE_CHAT_DEFAULTS'))
+)
+
+# 重复提问的回复缓存（可选）：进程内 LRU + Redis 共享层
+RESPONSE_CACHE_ENABLED = config.get('RESPONSE_CACHE_ENABLED', 'false').lower() == 'true'
+response_cache = ResponseCache(
+    redis_store=redis_store if config.get('RESPONSE_CACHE_REDIS', 'true').lower() == 'true' else None,
+    max_entries=int(config.get('RESPONSE_CACHE_MAX_ENTRIES', 1000)),
+    local_ttl=int(config.get('RESPONSE_CACHE_LOCAL_TTL', 300)),
+    redis_ttl=int(config.get('RESPONSE_CACHE_TTL', 3600)),
+    max_entry_chars=int(config.get('RESPONSE_CACHE_MAX_ENTRY_CHARS', 8000)),
+    max_temperature=float(config.get('RESPONSE_CACHE_MAX_TEMPERATURE', 0.5)),
+    max_context_turns=int(config.get('RESPONSE_CACHE_MAX_CONTEXT_TURNS', 0))
+) if RESPONSE_CACHE_ENABLED else None
+
+# 按用户/会话/天统计 token 用量，后台批量写入 Redis；可选的每日额度在请求 DeepSeek 前检查
+USAGE_ACCOUNTING_ENABLED = config.get('USAGE_ACCOUNTING_ENABLED', 'true').lower() == 'true'
+usage_accountant = UsageAccountant(
+    redis_store,
+    user_daily_limit=int(config.get('USAGE_USER_DAILY_TOKENS', 0)),
+    chat_daily_limit=int(config.get('USAGE_CHAT_DAILY_TOKENS', 0)),
+    flush_interval=float(config.get('USAGE_FLUSH_INTERVAL', 5)),
+    retention_days=int(config.get('USAGE_RETENTION_DAYS', 35)),
+    circuit_breaker=redis_breaker
+) if USAGE_ACCOUNTING_ENABLED else None
+
+# 进行中的生成按用户登记：/停止、清除上下文时取消，可选在同一用户发来新消息时取消旧的生成，并关闭上游连接
+CANCEL_ON_NEW_MESSAGE = config.get('CANCEL_ON_NEW_MESSAGE', 'false').lower() == 'true'
+inflight = InflightRegistry()
+# 不会取消进行中生成的指令消息
+COMMAND_PREFIXES = ('查询余额', '/查询余额', '/清除上下文', '/用量', '/停止', '/帮助', '/help', '/指定')
+
+# 飞书消息发送器：异步长连接池、tenant_access_token 缓存、按应用和接收者限频
+feishu_sender = FeishuSender(
+    config.get('FEISHU_APP_ID'),
+    config.get('FEISHU_APP_SECRET'),
+    base_url=config.get('FEISHU_API_BASE_URL'),
+    app_qps=int(config.get('FEISHU_APP_QPS', 50)),
+    recipient_qps=int(config.get('FEISHU_RECIPIENT_QPS', 5)),
+    max_retries=int(config.get('FEISHU_SEND_MAX_RETRIES', 3))
+)
+
+def message_uuid(event_id, purpose='reply'):
+    """根据事件 ID 生成发送消息的幂等键，同一事件的重试或重推不会产生重复消息"""
+    return hashlib.md5(f"{event_id}:{purpose}".encode('utf-8')).hexdigest()
+
+def get_event_id(data):
+    """获取事件ID，优先使用 event_id，其次 message_id"""
+    try:
+        event_id = None
+        if hasattr(data, 'event') and hasattr(data.event, 'event_id'):
+            event_id = data.event.event_id
+        elif hasattr(data, 'event_id'):
+            event_id = data.event_id
+        if not event_id and hasattr(data, 'event') and hasattr(data.event, 'message') and hasattr(data.event.message, 'message_id'):
+            event_id = data.event.message.message_id
+        if not event_id:
+            raise AttributeError("无法找到事件ID或消息ID")
+        return event_id
+    except AttributeError as e:
+        logger.error("无法获取事件ID: %s", e)
+        return None
+
+def parse_text_message(data):
+    """解析文本消息内容，非文本消息或内容为空时返回 None"""
+    # 验证消息类型，仅处理文本消息
+    if data.event.message.message_type != 'text':
+        logger.warning("忽略非文本消息: %s", data.event.message.message_type)
+        return None
+    # 解析消息内容，异常自动记录
+    raw_content = data.event.message.content
+    if not raw_content:
+        logger.error("收到空消息内容")
+        return None
+    try:
+        content_dict = json.loads(raw_content)
+        return content_dict.get('text', '').strip() or None
+    except (TypeError, json.JSONDecodeError) as e:
+        logger.error("解析消息内容失败: %s", e)
+        return None
+
+def get_chat_id(data):
+    """获取消息所在群聊的 chat_id，单聊或缺失时返回 None
+
+    单聊会话与用户一一对应，用量统计和会话默认路由都按用户处理，不再单独按会话统计。
+    """
+    message = getattr(getattr(data, 'event', None), 'message', None)
+    if getattr(message, 'chat_type', None) == 'p2p':
+        return None
+    return getattr(message, 'chat_id', None)
+
+def get_sender_open_id(data):
+    """获取发送者的 open_id，兼容不同 SDK 版本，优先返回 open_id，其次 user_id"""
+    try:
+        if hasattr(data, 'event'):
+            if hasattr(data.event, 'sender'):
+                if hasattr(data.event.sender, 'sender_id'):
+                    if hasattr(data.event.sender.sender_id, 'open_id'):
+                        return data.event.sender.sender_id.open_id
+                    elif hasattr(data.event.sender.sender_id, 'user_id'):
+                        return data.event.sender.sender_id.user_id
+                    raise AttributeError("sender_id对象缺少open_id或user_id属性")
+                elif hasattr(data.event.sender, 'open_id'):
+                    return data.event.sender.open_id
+                elif hasattr(data.event.sender, 'user_id'):
+                    return data.event.sender.user_id
+                raise AttributeError("sender对象缺少必要的ID属性")
+            elif hasattr(data.event, 'user_id'):
+                return data.event.user_id
+            raise AttributeError("event对象缺少发送者信息")
+        elif hasattr(data, 'sender'):
+            if hasattr(data.sender, 'sender_id') and hasattr(data.sender.sender_id, 'open_id'):
+                return data.sender.sender_id.open_id
+            elif hasattr(data.sender, 'open_id'):
+                return data.sender.open_id
+            raise AttributeError("sender对象缺少必要的ID属性")
+        elif hasattr(data, 'user_id'):
+            return data.user_id
+        raise AttributeError("无法找到发送者ID属性")
+    except AttributeError as e:
+        logger.error("无法获取发送者ID: %s", e)
+        return None
+
+async def send_chunk(chunk, user_open_id):
+    """发送流式回复的 chunk，失败自动记录日志"""
+    try:
+        content = chunk.get('content', '')
+        if content and user_open_id:
+            message_id = await feishu_sender.send_text(user_open_id, content)
+            logger.info("流式回复chunk发送成功，消息ID: %s", message_id)
+    except Exception as e:
+        logger.error("发送流式回复chunk异常: %s", e)
+
+async def lookup_response_cache(user_msg, context=None, model=REPLY_MODEL):
+    """查询回复缓存
+
+    Returns:
+        (缓存的回复或 None, 缓存键)；不可缓存的请求缓存键为 None
+    """
+    if response_cache is None or not response_cache.cacheable(REPLY_TEMPERATURE, context):
+        return None, None
+    cache_key = response_cache.make_key(user_msg, model, REPLY_TEMPERATURE, context)
+    cached = await response_cache.get(cache_key)
+    if cached is not None:
+        logger.info("命中回复缓存，统计: %s", response_cache.stats())
+    return cached, cache_key
+
+async def process_message(user_msg, context=None, user_open_id=None, ds_client=None, raise_errors=False, model=REPLY_MODEL,
+                          usage=None):
+    """异步处理消息，自动选择 DeepSeek 客户端；raise_errors 为 True 时失败直接抛出，否则返回错误提示
+
+    usage 不为 None 时写入本次请求的 token 用量，命中缓存时保持为空
+    """
+    try:
+        client = ds_client or globals().get('ds_client')
+        if not client:
+            raise ValueError('DeepSeek client not available')
+        cached, cache_key = await lookup_response_cache(user_msg, context, model)
+        if cached is not None:
+            return cached
+        # 统一温度参数，关闭流式
+        response = await client.complete(user_msg, model=model, context=context, temperature=REPLY_TEMPERATURE, stream=False,
+                                         usage=usage)
+        if cache_key:
+            await response_cache.set(cache_key, response)
+        return response
+    except CircuitOpenError:
+        raise
+    except Exception as e:
+        if raise_errors:
+            raise
+        logger.exception("处理消息时发生异常: %s", e)
+        return '服务暂时不可用，请稍后再试'
+
+async def process_message_stream(user_msg, context=None, user_open_id=None, ds_client=None, uuid=None, raise_errors=False,
+                                 on_first_token=None, model=REPLY_MODEL, usage=None):
+    """流式处理消息，增量渲染到同一张飞书卡片
+
+    raise_errors 为 True 时，卡片发出前的失败直接抛出；卡片已发出后仍在卡片中提示中断；
+    on_first_token 在收到 DeepSeek 首个 token 时调用一次；usage 不为 None 时写入本次请求的 token 用量
+
+    Returns:
+        (完整回复文本, 是否已通过卡片送达)，未能发出卡片时由调用方走普通发送流程
+    """
+    card = StreamingCardReply(
+        feishu_sender,
+        user_open_id,
+        update_interval=STREAM_UPDATE_INTERVAL,
+        min_update_chars=STREAM_UPDATE_MIN_CHARS,
+        show_reasoning=STREAM_SHOW_REASONING,
+        uuid=uuid
+    )
+    try:
+        deepseek = ds_client or globals().get('ds_client')
+        if not deepseek:
+            raise ValueError('DeepSeek client not available')
+        cached, cache_key = await lookup_response_cache(user_msg, context, model)
+        if cached is not None:
+            # 命中缓存时直接以普通消息返回，无需渐进渲染
+            return cached, False
+        async for chunk in deepseek.complete(user_msg, model=model, context=context, temperature=REPLY_TEMPERATURE, stream=True,
+                                             usage=usage):
+            if on_first_token:
+                on_first_token()
+                on_first_token = None
+            await card.feed(chunk)
+        await card.finish()
+        if cache_key:
+            await response_cache.set(cache_key, card.content)
+        return card.content, card.created
+    except CircuitOpenError:
+        # 熔断在发出请求前即拒绝，此时卡片尚未发出
+        raise
+    except asyncio.CancelledError:
+        # 生成被取消时结束已发出的卡片，避免停留在生成中的状态
+        if card.created:
+            try:
+                await card.finish(notice='⏹️ 已停止生成')
+            except Exception as card_e:
+                logger.error("结束流式卡片失败: %s", card_e)
+        raise
+    except Exception as e:
+        if not card.created:
+            if raise_errors:
+                raise
+            logger.exception("流式处理消息时发生异常: %s", e)
+            return '服务暂时不可用，请稍后再试', False
+        logger.exception("流式处理消息时发生异常: %s", e)
+        try:
+            await card.finish(notice='⚠️ 回复生成中断，请稍后再试')
+        except Exception as card_e:
+            logger.error("结束流式卡片失败: %s", card_e)
+        return card.content, True
+
+async def reply_to_message(event_id, user_open_id, user_msg, context, summary, from_stream=False, on_first_token=None,
+                           chat_id=None):
+    """普通消息处理，自动维护上下文，异常自动记录
+
+    Args:
+        on_first_token: 收到 DeepSeek 首个 token 时调用，非流式模式下在回复生成后调用
+        chat_id: 消息所在会话，用于按会话统计用量和检查额度
+
+    Returns:
+        需要以普通消息发送的回复，流式卡片已送达或无需回复时为 None
+    """
+    new_turns = None
+    error_info = None
+    # 按消息内容和前缀选择模型，带路由前缀的消息去掉前缀后再提问和保存
+    route = model_router.route(user_msg, chat_id, user_open_id)
+    ROUTE_DECISIONS.labels(route.name, route.reason).inc()
+    if not route.text:
+        return "请在 /深度思考 或 /快速 后输入问题"
+    user_msg = route.text
+    if usage_accountant is not None:
+        exceeded = await usage_accountant.check_quota(user_open_id, chat_id)
+        if exceeded:
+            scope, used, limit = exceeded
+            QUOTA_EXCEEDED.labels(scope).inc()
+            logger.info("%s今日 token 用量 %s 已达额度 %s，拒绝本条消息", "用户" if scope == USER else "会话", used, limit)
+            return f"{'你' if scope == USER else '本会话'}今日的 token 用量 ({used}) 已达上限 ({limit})，请明天再试；发送 /用量 查看明细"
+    usage = {}
+    try:
+        # 对话历史已在去重时一并读取，按 token 预算裁剪后发送
+        with timed(STAGE_SECONDS, 'context_build'):
+            prompt_context, trimmed_tokens = await context_builder.build(user_open_id, context, summary, user_msg)
+        if trimmed_tokens:
+            CONTEXT_TRIMMED_TOKENS.inc(trimmed_tokens)
+        delivered = False
+        stream = STREAM_REPLY_MODE and bool(user_open_id)
+        with timed(STAGE_SECONDS, 'deepseek'), timed(ROUTE_SECONDS, route.name, 'true' if stream else 'false'):
+            # 生成在独立子任务中运行并按用户登记，/停止 等可随时取消；
+            # 失败直接抛出到下方 except 分支，由其回复降级提示并记录异常事件，错误提示不会写入对话历史
+            if stream:
+                response, delivered = await inflight.run(user_open_id, event_id, process_message_stream(
+                    user_msg, context=prompt_context, user_open_id=user_open_id, uuid=message_uuid(event_id, 'card'),
+                    raise_errors=True, on_first_token=on_first_token, model=route.model, usage=usage))
+            else:
+                response = await inflight.run(user_open_id, event_id, process_message(
+                    user_msg, context=prompt_context, user_open_id=user_open_id, raise_errors=True, model=route.model,
+                    usage=usage))
+                if on_first_token:
+                    on_first_token()
+        if response and user_open_id:
+            logger.debug("准备发送回复给用户 %s，回复长度: %s", user_open_id, len(response))
+            # 流式模式下回复已经通过卡片送达，无需再次发送
+            reply = None if delivered else response
+            # 同时保存用户消息和机器人回复，条数上限由对话存储负责裁剪
+            new_turns = [
+                {"role": "user", "content": user_msg},
+                {"role": "assistant", "content": response}
+            ]
+        else:
+            reply = None
+    except CircuitOpenError as e:
+        # 熔断期间立即回复降级提示，不记录异常事件，也不写入对话历史
+        if from_stream:
+            raise
+        logger.warning("DeepSeek 熔断中，返回降级回复: %s", e)
+        reply = CIRCUIT_OPEN_REPLY
+    except GenerationCancelled as e:
+        # 被取消的生成不回复也不写入对话历史，/停止 指令自行回复取消结果
+        logger.info("%s，用户: %s", e, user_open_id)
+        return None
+    except Exception as e:
+        if from_stream:
+            raise
+        logger.exception("处理消息时发生异常: %s", e)
+        reply = '服务暂时不可用，请稍后再试'
+        # 记录异常事件，便于后续排查
+        error_info = {
+            'timestamp': asyncio.get_event_loop().time(),
+            'error_type': type(e).__name__,
+            'error_message': str(e),
+            'user_open_id': user_open_id,
+            'user_msg': user_msg
+        }
+    finally:
+        # 只在进程内累计，由后台任务批量写入 Redis
+        if usage_accountant is not None:
+            usage_accountant.record(user_open_id, chat_id, usage)
+    # 追加对话消息与记录异常事件合并为一次 Redis 往返
+    try:
+        await call_redis(
+            redis_store.save_turns_and_error,
+            conversation_store,
+            user_open_id=user_open_id,
+            turns=new_turns,
+            error_event_id=event_id if error_info else None,
+            error_info=error_info
+        )
+    except Exception as redis_e:
+        logger.error("写回上下文或记录异常事件到Redis失败: %s", redis_e)
+    return reply
+
+async def call_redis(func, *args, **kwargs):
+    """在 Redis 熔断保护下执行，未开启熔断时直接执行"""
+    if redis_breaker is None:
+        return await func(*args, **kwargs)
+    return await redis_breaker.call(func, *args, **kwargs)
+
+async def send_reply(event_id, user_open_id, reply):
+    """发送消息，发送器负责限频和退避重试，uuid 保证重试不会产生重复消息"""
+    if not user_open_id:
+        logger.error("无法获取发送者ID，消息发送失败")
+        return
+    try:
+        with timed(STAGE_SECONDS, 'feishu_send'):
+            message_id = await feishu_sender.send_text(user_open_id, reply, uuid=message_uuid(event_id))
+        logger.info("消息发送成功，消息ID: %s, 用户: %s", message_id, user_open_id)
+    except Exception as e:
+        logger.error("消息发送失败: %s, 用户: %s", e, user_open_id)
+
+async def format_usage_report(user_open_id, chat_id=None):
+    """生成 /用量 指令的回复"""
+    if usage_accountant is None:
+        return "未开启用量统计"
+    usage = await usage_accountant.get_usage(user_open_id, chat_id)
+    limits = {USER: usage_accountant.user_daily_limit, CHAT: usage_accountant.chat_daily_limit}
+    reply = f"📊 今日 token 用量 ({time.strftime('%Y-%m-%d')})\n"
+    for scope, title in ((USER, '个人'), (CHAT, '本会话')):
+        if scope not in usage:
+            continue
+        values = usage[scope]
+        total = usage_total(values)
+        reply += f"\n{title}:\n"
+        reply += f"- 请求次数: {values['requests']}\n"
+        reply += f"- 输入 tokens: {values['prompt']} (缓存命中 {values['cache_hit']})\n"
+        reply += f"- 输出 tokens: {values['completion']}\n"
+        reply += f"- 合计: {total}"
+        reply += f" / 每日额度 {limits[scope]}\n" if limits[scope] > 0 else " (不限额度)\n"
+    return reply.rstrip()
+
+async def process_coalesced_messages(user_open_id, items, mark_started):
+    """合并窗口结束后处理同一用户的连续消息，合并为一条用户消息回复一次
+
+    Args:
+        items: [(事件ID, 消息文本, 会话ID), ...]，按到达顺序排列
+        mark_started: 收到首个 token 后调用，此后再有新消息不再取消本次生成
+    """
+    event_id = items[0][0]
+    user_msg = '\n'.join(text for _, text, _ in items)
+    chat_id = items[-1][2]
+    started = time.perf_counter()
+    correlation = bind_event_id(event_id)
+    try:
+        # 合并期间上一轮回复可能已写回历史，重新读取
+        with timed(STAGE_SECONDS, 'context_load'):
+            context, summary = await event_dedupe.load_context(user_open_id)
+        reply = await reply_to_message(event_id, user_open_id, user_msg, context, summary, on_first_token=mark_started,
+                                       chat_id=chat_id)
+        if reply is not None:
+            await send_reply(event_id, user_open_id, reply)
+    except Exception as e:
+        logger.exception("处理合并消息时发生异常: %s", e)
+        await send_reply(event_id, user_open_id, '服务暂时不可用，请稍后再试')
+    finally:
+        STAGE_SECONDS.labels('coalesced_batch').observe(time.perf_counter() - started)
+        reset_event_id(correlation)
+
+async def async_do_p2_im_message_receive_v1(data: 'P2ImMessageReceiveV1', from_stream=False):
+    """异步处理飞书消息事件，包含去重、指令解析、上下文维护和异常记录
+
+    Args:
+        from_stream: 事件来自 Redis Stream 工作队列，去重已在入队时完成；
+            处理失败时抛出异常而不是回复错误提示，由工作队列重新投递
+    """
+    started = time.perf_counter()
+    correlation = None
+    try:
+        # 解析事件ID、发送者和文本内容，非文本或空消息无需去重直接忽略
+        with timed(STAGE_SECONDS, 'event_parse'):
+            event_id = get_event_id(data)
+            user_open_id = get_sender_open_id(data)
+            chat_id = get_chat_id(data)
+            user_msg = parse_text_message(data) if event_id else None
+        # 之后的日志（包括 DeepSeek 客户端中的）都带上事件 ID
+        correlation = bind_event_id(event_id)
+        if not user_msg:
+            EVENTS.labels('ignored').inc()
+            return None
+
+        # 两级去重：进程内记录拦截重推风暴，Redis SET NX 在多进程间去重并在同一次往返中预取对话历史
+        with timed(STAGE_SECONDS, 'redis_dedupe'):
+            if from_stream:
+                # 入队时已完成去重，读取失败时抛出异常，由工作队列重新投递
+                context, summary = await event_dedupe.load_context(user_open_id)
+                outcome = CLAIMED
+            else:
+                outcome, context, summary = await event_dedupe.claim(event_id, user_open_id)
+        if outcome != CLAIMED:
+            if outcome == DUPLICATE:
+                logger.info("事件 %s 已处理，跳过重复处理", event_id)
+                DUPLICATE_EVENTS.inc()
+                EVENTS.labels('duplicate').inc()
+            else:
+                EVENTS.labels('dedupe_failed').inc()
+            return None
+        logger.info("事件 %s 标记为已处理", event_id)
+        EVENTS.labels('processed').inc()
+        if CANCEL_ON_NEW_MESSAGE and user_open_id and not user_msg.strip().startswith(COMMAND_PREFIXES):
+            # 新消息取代同一用户进行中的生成，回调或 Stream 读取时通常已经取消，这里处理同步模式等未能提前取消的情况
+            inflight.cancel(user_open_id, SUPERSEDED, exclude_event_id=event_id)
+
+        # 指令消息处理，支持余额、清除上下文、帮助
+        if user_msg.strip() == "查询余额" or user_msg.strip().startswith("/查询余额"):
+            try:
+                balance_info = await ds_client.get_balance()
+                is_available = balance_info.get("is_available", False)
+                balance_details = balance_info.get("balance_infos", [])
+                reply = f"账户余额状态: {'有可用余额' if is_available else '无可用余额'}\n"
+                if balance_details:
+                    reply += "余额详情:\n"
+                    for detail in balance_details:
+                        currency = detail.get('currency', '未知货币')
+                        total_balance = detail.get('total_balance', '0')
+                        granted_balance = detail.get('granted_balance', '0')
+                        topped_up_balance = detail.get('topped_up_balance', '0')
+                        reply += f"- 货币类型: {currency}\n"
+                        reply += f"- 总余额: {total_balance} {currency}\n"
+                        reply += f"- 赠额余额: {granted_balance} {currency}\n"
+                        reply += f"- 充值余额: {topped_up_balance} {currency}\n"
+                else:
+                    reply += "暂无余额详情"
+            except Exception as e:
+                reply = f"查询余额失败: {str(e)}"
+        elif user_msg.strip().startswith("/停止"):
+            if user_open_id:
+                # 回调或 Stream 读取时通常已经取消，这里处理同步模式等未能提前取消的情况
+                inflight.cancel(user_open_id, STOP)
+                if message_coalescer is not None:
+                    inflight.mark_stopped(user_open_id, message_coalescer.cancel(user_open_id))
+            reply = "⏹️ 已停止生成" if user_open_id and inflight.pop_stopped(user_open_id) else "当前没有正在生成的回复"
+        elif user_msg.strip().startswith("/清除上下文"):
+            try:
+                if user_open_id:
+                    # 先取消进行中的生成，避免旧回复在清除之后写回历史
+                    inflight.cancel(user_open_id, CLEAR)
+                    # 等待合并的消息不再回复，避免在清除之后写入新的历史
+                    if message_coalescer is not None:
+                        message_coalescer.cancel(user_open_id)
+                    # 进行中的摘要任务也一并取消，避免旧摘要在清除之后写回
+                    context_builder.cancel(user_open_id)
+                    await conversation_store.clear(user_open_id)
+                    reply = "🧹对话上下文已清除"
+                else:
+                    reply = "无法获取用户信息，清除上下文失败"
+            except Exception as e:
+                reply = f"清除上下文失败: {str(e)}"
+        elif user_msg.strip().startswith("/用量"):
+            try:
+                reply = await format_usage_report(user_open_id, chat_id)
+            except Exception as e:
+                reply = f"查询用量失败: {str(e)}"
+        elif user_msg.strip().startswith("/帮助") or user_msg.strip().startswith("/help") or user_msg.strip().startswith("/指定"):
+            reply = "🤖 机器人指令说明\n\n"
+            reply += "📌 查询余额\n"
+            reply += "   指令: /查询余额\n"
+            reply += "   功能: 查询DeepSeek API账户余额\n\n"
+            reply += "📌 清除上下文\n"
+            reply += "   指令: /清除上下文\n"
+            reply += "   功能: 清除当前对话的上下文历史\n\n"
+            reply += "📌 停止生成\n"
+            reply += "   指令: /停止\n"
+            reply += "   功能: 停止正在生成的回复\n\n"
+            reply += "📌 查询用量\n"
+            reply += "   指令: /用量\n"
+            reply += "   功能: 查看今日的 token 用量和每日额度\n\n"
+            reply += "📌 指定模型\n"
+            reply += "   指令: /深度思考 问题 或 /快速 问题\n"
+            reply += "   功能: 使用推理模型深度思考，或使用对话模型快速回复；不加前缀时按问题自动选择\n\n"
+            reply += "📌 帮助\n"
+            reply += "   指令: /帮助 或 /help 或 /指定\n"
+            reply += "   功能: 查看所有可用指令说明\n\n"
+            reply += "💡 提示: 直接发送消息即可进行正常对话，机器人会自动维护上下文"
+        elif message_coalescer is not None and user_open_id and not from_stream:
+            # 连续发送的短消息在合并窗口结束后一起回复，由合并器负责调用 DeepSeek 和发送
+            message_coalescer.submit(user_open_id, (event_id, user_msg, chat_id))
+            reply = None
+        else:
+            reply = await reply_to_message(event_id, user_open_id, user_msg, context, summary, from_stream=from_stream,
+                                           chat_id=chat_id)
+
+        if reply is not None:
+            await send_reply(event_id, user_open_id, reply)
+        return None
+    except Exception as e:
+        EVENTS.labels('error').inc()
+        if from_stream:
+            raise
+        logger.exception("处理消息时发生异常: %s", e)
+        return None
+    finally:
+        STAGE_SECONDS.labels('total').observe(time.perf_counter() - started)
+        if correlation is not None:
+            reset_event_id(correlation)
+
+# 创建全局事件循环，避免每次请求创建新循环，提升性能
+try:
+    loop = asyncio.get_event_loop()
+except RuntimeError:
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+def close_sync_loop_resources():
+    """同步模式下在进程退出时关闭全局事件循环上的连接池"""
+    try:
+        if not loop.is_closed():
+            loop.run_until_complete(ds_client.close())
+            if usage_accountant is not None:
+                loop.run_until_complete(usage_accountant.close())
+            loop.run_until_complete(redis_store.close())
+            loop.run_until_complete(feishu_sender.close())
+    except Exception as e:
+        logger.error("关闭DeepSeek连接池失败: %s", e)
+
+# 事件队列模式：local 在接收回调的进程内处理；stream 时回调节点只把事件写入 Redis Stream，由 stream_worker 进程消费
+EVENT_QUEUE_MODE = config.get('EVENT_QUEUE_MODE', 'local').lower()
+EVENT_STREAM_KEY = config.get('EVENT_STREAM_KEY', 'feishu:events')
+event_publisher = EventStreamPublisher(
+    redis_client,
+    stream_key=EVENT_STREAM_KEY,
+    maxlen=int(config.get('EVENT_STREAM_MAXLEN', 100000)),
+    event_expire=EVENT_EXPIRE_SECONDS
+) if EVENT_QUEUE_MODE == 'stream' else None
+
+# 进程角色，stream_worker 进程只消费事件，不启动回调相关的工作池
+APP_ROLE = config.get('APP_ROLE', 'web').lower()
+
+# 服务器类型，uvicorn 为原生异步模式：每个 worker 进程在自己的事件循环上接收回调并处理消息
+SERVER = config.get('SERVER', 'waitress').lower()
+ASYNC_SERVER_MODE = SERVER == 'uvicorn'
+
+# 先应答模式：回调只负责解密校验并入队，消息由后台工作池异步处理，避免阻塞 HTTP 线程导致飞书超时重推
+ACK_FIRST_MODE = config.get('ACK_FIRST_MODE', 'true').lower() == 'true'
+
+worker_pool = MessageWorkerPool(
+    worker_count=int(config.get('WORKER_POOL_SIZE', 16)),
+    queue_size=int(config.get('WORKER_QUEUE_SIZE', 200)),
+    submit_timeout=float(config.get('WORKER_SUBMIT_TIMEOUT', 0.5)),
+    shutdown_timeout=float(config.get('WORKER_SHUTDOWN_TIMEOUT', 30)),
+    max_pending_per_key=int(config.get('WORKER_MAX_PENDING_PER_USER', 20))
+)
+
+def schedule_nowait(key, coro_func, args):
+    """在消息处理的事件循环上按用户键提交任务，与该用户排队中的消息保序，受 WORKER_POOL_SIZE 并发上限约束"""
+    if ASYNC_SERVER_MODE:
+        event_scheduler.put_nowait(key, coro_func, args)
+    else:
+        worker_pool.submit_nowait(coro_func, *args, key=key)
+
+# 连续消息合并：同一用户在窗口内连续发送的消息合并为一次提问，需要常驻的事件循环，Stream 消费模式下不启用
+MESSAGE_COALESCE_ENABLED = config.get('MESSAGE_COALESCE_ENABLED', 'false').lower() == 'true'
+message_coalescer = None
+if MESSAGE_COALESCE_ENABLED:
+    if EVENT_QUEUE_MODE == 'stream' or APP_ROLE == 'stream-worker' or not (ASYNC_SERVER_MODE or ACK_FIRST_MODE):
+        logger.warning("连续消息合并需要先应答模式或uvicorn模式，且不支持Stream事件队列，已忽略MESSAGE_COALESCE_ENABLED")
+    else:
+        message_coalescer = MessageCoalescer(
+            process_coalesced_messages,
+            window=int(config.get('MESSAGE_COALESCE_WINDOW_MS', 1500)) / 1000,
+            max_wait=int(config.get('MESSAGE_COALESCE_MAX_WAIT_MS', 6000)) / 1000,
+            max_messages=int(config.get('MESSAGE_COALESCE_MAX_MESSAGES', 10)),
+            schedule=schedule_nowait
+        )
+
+event_scheduler = None
+if ASYNC_SERVER_MODE:
+    # 回调与消息处理共用 ASGI worker 的事件循环，不再需要后台工作池线程；调度器和连接池由 asgi_app 随 lifespan 启动和关闭
+    event_scheduler = KeyedScheduler(
+        concurrency=int(config.get('WORKER_POOL_SIZE', 16)),
+        max_pending=int(config.get('WORKER_QUEUE_SIZE', 200)),
+        max_pending_per_key=int(config.get('WORKER_MAX_PENDING_PER_USER', 20)),
+        name='event-scheduler'
+    )
+
+# 启动预热：并行加载 lark SDK、创建连接池、预取 tenant_access_token，可选预先建立到 DeepSeek 的连接
+PREWARM_ENABLED = config.get('PREWARM_ENABLED', 'true').lower() == 'true'
+# 导入 app 模块的耗时预算（秒），超出时告警，扩容和滚动发布时新实例应在数秒内可以接收流量
+IMPORT_TIME_BUDGET = float(config.get('IMPORT_TIME_BUDGET', 1.0))
+
+# 就绪检查：预热完成且 Redis 可用时 /readyz 才返回 200，编排系统据此只向已预热的实例转发流量
+readiness = ReadinessProbe(
+    timeout=float(config.get('READINESS_TIMEOUT', 2)),
+    cache_ttl=float(config.get('READINESS_CACHE_TTL', 5))
+)
+
+async def check_redis():
+    await redis_store.client.ping()
+
+async def check_event_handler():
+    if event_handler is None:
+        raise RuntimeError('事件处理器尚未加载')
+
+readiness.add_check('redis', check_redis)
+readiness.add_check('event_handler', check_event_handler)
+
+# 飞书事件处理器在预热或首个回调时创建，创建时才导入 lark SDK
+event_handler = None
+_event_handler_lock = threading.Lock()
+
+def get_event_handler():
+    """获取飞书事件处理器，首次调用时导入 lark SDK 并注册消息回调，线程安全"""
+    global event_handler
+    if event_handler is None:
+        with _event_handler_lock:
+            if event_handler is None:
+                started = time.perf_counter()
+                import lark_oapi as lark
+                event_handler = lark.EventDispatcherHandler.builder(
+                    config.get('FEISHU_ENCRYPT_KEY'),
+                    config.get('FEISHU_VERIFICATION_TOKEN'),
+                    lark.LogLevel.INFO
+                ).register_p2_im_message_receive_v1(do_p2_im_message_receive_v1).build()
+                logger.info("飞书事件处理器已加载，耗时 %.2f 秒", time.perf_counter() - started)
+    return event_handler
+
+async def warm_up():
+    """预热各项依赖，单项失败只记录日志，首次使用时会重试；完成后就绪检查才会通过"""
+    started = time.perf_counter()
+    steps = {
+        'deepseek': ds_client.warm_up() if PREWARM_ENABLED else ds_client.start(),
+        'feishu': feishu_sender.start()
+    }
+    if APP_ROLE != 'stream-worker':
+        # lark SDK 在线程池中导入，期间事件循环仍可响应健康检查
+        steps['event_handler'] = asyncio.get_running_loop().run_in_executor(None, get_event_handler)
+    results = await asyncio.gather(*steps.values(), return_exceptions=True)
+    for name, result in zip(steps, results):
+        if isinstance(result, Exception):
+            logger.warning("预热 %s 失败，将在首次使用时重试: %s", name, result)
+    elapsed = time.perf_counter() - started
+    STARTUP_SECONDS.labels('warmup').set(elapsed)
+    readiness.mark_warmed()
+    logger.info("预热完成，耗时 %.2f 秒", elapsed)
+
+_warm_up_task = None
+
+async def start_warm_up():
+    """在后台开始预热，不阻塞服务启动，预热期间 /healthz 正常响应而 /readyz 返回 503"""
+    global _warm_up_task
+    _warm_up_task = asyncio.get_running_loop().create_task(warm_up())
+
+async def check_readiness():
+    """执行就绪检查，返回 (HTTP 状态码, 响应体)"""
+    ready, results = await readiness.check()
+    return (200 if ready else 503), json.dumps({'ready': ready, 'checks': results}, ensure_ascii=False)
+
+_services_started = False
+
+def start_background_services():
+    """按服务模式启动工作池并开始预热，重复调用无副作用
+
+    先应答模式下连接池随工作池事件循环创建和关闭，预热在工作池事件循环上后台进行；
+    同步模式下在全局事件循环上完成预热后返回。uvicorn 模式由 asgi_app 随 lifespan 启动。
+    """
+    global _services_started
+    if _services_started or ASYNC_SERVER_MODE or APP_ROLE == 'stream-worker':
+        return
+    _services_started = True
+    if ACK_FIRST_MODE:
+        worker_pool.add_startup_hook(start_warm_up)
+        if message_coalescer is not None:
+            # 工作队列排空后处理仍在合并窗口中的消息，再关闭连接池
+            worker_pool.add_shutdown_hook(lambda: message_coalescer.drain(timeout=worker_pool.shutdown_timeout))
+        worker_pool.add_shutdown_hook(ds_client.close)
+        if usage_accountant is not None:
+            # 写入剩余用量后再关闭 Redis 连接池
+            worker_pool.add_shutdown_hook(usage_accountant.close)
+        worker_pool.add_shutdown_hook(redis_store.close)
+        worker_pool.add_shutdown_hook(feishu_sender.close)
+        worker_pool.start()
+        atexit.register(worker_pool.stop)
+    else:
+        loop.run_until_complete(warm_up())
+        atexit.register(close_sync_loop_resources)
+
+def run_readiness_check():
+    """在处理消息的事件循环上执行就绪检查，供 WSGI 路由调用"""
+    if worker_pool.running:
+        return worker_pool.run(check_readiness(), timeout=readiness.timeout + 1)
+    return loop.run_until_complete(check_readiness())
+
+def cancel_reason(text):
+    """根据消息内容判断是否取消同一用户进行中的生成，返回取消原因，无需取消时返回 None"""
+    text = text.strip()
+    if text.startswith('/停止'):
+        return STOP
+    if text.startswith('/清除上下文'):
+        return CLEAR
+    if CANCEL_ON_NEW_MESSAGE and text and not text.startswith(COMMAND_PREFIXES):
+        return SUPERSEDED
+    return None
+
+def preempt(user_open_id, event_id, text):
+    """在消息处理的事件循环上执行回调阶段的抢占：按消息内容取消进行中的生成，并打断尚未开始输出的合并消息"""
+    reason = cancel_reason(text)
+    if reason is not None:
+        inflight.cancel(user_open_id, reason, exclude_event_id=event_id)
+    if message_coalescer is not None and reason in (STOP, CLEAR):
+        # 等待合并或排队中的消息尚未登记为生成，一并丢弃，/停止 按已停止回复
+        dropped = message_coalescer.cancel(user_open_id)
+        if reason == STOP:
+            inflight.mark_stopped(user_open_id, dropped)
+    if message_coalescer is not None and text.strip() and not text.strip().startswith(COMMAND_PREFIXES):
+        # 新消息处理后与被打断的消息重新合并
+        message_coalescer.interrupt(user_open_id)
+
+def preempt_generation(data):
+    """在回调中立即抢占同一用户进行中的生成
+
+    同一用户的消息按顺序处理，/停止 等消息排在进行中的生成之后就无法及时生效，因此入队前先按消息内容取消；
+    指令的回复仍由排队处理的消息完成。已见过的事件（飞书重推）不触发取消。
+    """
+    event_id = get_event_id(data)
+    user_open_id = get_sender_open_id(data)
+    if not event_id or not user_open_id or event_dedupe.seen(event_id):
+        return
+    try:
+        message = data.event.message
+        text = json.loads(message.content).get('text', '') if message.message_type == 'text' else ''
+    except (AttributeError, TypeError, ValueError):
+        return
+    if cancel_reason(text) is None and message_coalescer is None:
+        return
+    if ASYNC_SERVER_MODE or APP_ROLE == 'stream-worker':
+        # 已在消息处理的事件循环上（uvicorn 回调或 Stream 消费者读取循环）
+        preempt(user_open_id, event_id, text)
+    elif worker_pool.running:
+        # 先于消息入队执行，排队处理的 /停止 能看到取消结果
+        worker_pool.loop.call_soon_threadsafe(preempt, user_open_id, event_id, text)
+
+def do_p2_im_message_receive_v1(data: 'P2ImMessageReceiveV1'):
+    """同步处理飞书消息事件，封装异步主逻辑"""
+    if event_publisher is not None:
+        # 去重后写入 Redis Stream 即应答，写入失败时抛出异常，由事件处理器转换为 500 响应，飞书稍后会重推该事件
+        event_id = get_event_id(data)
+        if event_id and event_dedupe.check_local(event_id):
+            DUPLICATE_EVENTS.inc()
+            return None
+        try:
+            import lark_oapi as lark
+            entry_id = event_publisher.publish(event_id, get_sender_open_id(data), lark.JSON.marshal(data))
+        except Exception:
+            event_dedupe.forget(event_id)
+            raise
+        if entry_id is None:
+            logger.warning("重复事件，跳过入队")
+            DUPLICATE_EVENTS.inc()
+        return None
+    if ASYNC_SERVER_MODE or ACK_FIRST_MODE:
+        preempt_generation(data)
+    if ASYNC_SERVER_MODE:
+        # 回调运行在 ASGI 事件循环线程上，入队后立即应答；队列满时抛出 QueueFullError，飞书稍后会重推该事件
+        event_scheduler.put_nowait(get_sender_open_id(data), async_do_p2_im_message_receive_v1, (data,))
+        return None
+    if ACK_FIRST_MODE:
+        # 同一用户的消息按顺序处理，避免并发读写同一份上下文；不同用户之间并行
+        # 队列满时抛出 QueueFullError，由事件处理器转换为 500 响应，飞书稍后会重推该事件
+        worker_pool.submit(async_do_p2_im_message_receive_v1, data, key=get_sender_open_id(data))
+        return None
+    try:
+        return loop.run_until_complete(async_do_p2_im_message_receive_v1(data))
+    except Exception as e:
+        logger.exception("处理消息时发生异常: %s", e)
+        return {'msg_type': 'text', 'content': {'text': '服务暂时不可用，请稍后再试'}}
+
+def handle_feishu():
+    """处理飞书回调请求，异常自动记录"""
+    from lark_oapi.adapter.flask import parse_req, parse_resp
+    try:
+        req = parse_req()
+        resp = get_event_handler().do(req)
+        return parse_resp(resp)
+    except Exception as e:
+        logger.exception("处理飞书回调时发生异常")
+        return "Server Error", 500
+
+def handle_metrics():
+    """Prometheus 指标"""
+    from flask import Response
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+def handle_healthz():
+    """存活检查：进程能响应请求即返回 200"""
+    return 'ok', 200
+
+def handle_readyz():
+    """就绪检查：预热完成且依赖可用时返回 200，否则返回 503"""
+    try:
+        status, body = run_readiness_check()
+    except Exception as e:
+        status, body = 503, json.dumps({'ready': False, 'error': str(e)}, ensure_ascii=False)
+    return body, status, {'Content-Type': 'application/json; charset=utf-8'}
+
+def create_app():
+    """创建 WSGI 应用：检查配置、注册路由、启动工作池并在后台预热
+
+    用法: gunicorn 'app:create_app()'；导入 app 模块本身不连接任何依赖，也不导入 lark SDK。
+    """
+    from flask import Flask
+    check_required_configs()
+    flask_app = Flask(__name__)
+    flask_app.add_url_rule('/feishu/callback', view_func=handle_feishu, methods=['POST'])
+    flask_app.add_url_rule('/metrics', view_func=handle_metrics, methods=['GET'])
+    flask_app.add_url_rule('/healthz', view_func=handle_healthz, methods=['GET'])
+    flask_app.add_url_rule('/readyz', view_func=handle_readyz, methods=['GET'])
+    start_background_services()
+    return flask_app
+
+_wsgi_app = None
+
+def __getattr__(name):
+    # 兼容 gunicorn app:app 的启动方式，首次访问时才创建应用
+    global _wsgi_app
+    if name == 'app':
+        if _wsgi_app is None:
+            _wsgi_app = create_app()
+        return _wsgi_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+STARTUP_SECONDS.labels('import').set(IMPORT_SECONDS)
+if IMPORT_SECONDS > IMPORT_TIME_BUDGET:
+    logger.warning("app 模块导入耗时 %.2f 秒，超出预算 %s 秒", IMPORT_SECONDS, IMPORT_TIME_BUDGET)
+else:
+    logger.info("app 模块导入耗时 %.2f 秒", IMPORT_SECONDS)
+
+if __name__ == '__main__':
+    port = int(config.get('PORT', 5000))
+    logger.info("启动服务在端口 %s", port)
+    # 根据配置选择服务器类型，高并发场景推荐 uvicorn
+    if SERVER == 'uvicorn':
+        workers = int(config.get('SERVER_WORKERS', 1))
+        logger.info("使用Uvicorn服务器 (异步模式)，worker进程数: %s", workers)
+        # 用 uvicorn 替换当前进程：每个 worker 进程只导入一次 asgi_app，各自拥有独立的事件循环和连接池
+        os.execvp(sys.executable, [
+            sys.executable, '-m', 'uvicorn', 'asgi_app:create_app', '--factory',
+            '--host', '0.0.0.0', '--port', str(port), '--workers', str(workers), '--no-access-log'
+        ])
+    elif SERVER == 'waitress':
+        from waitress import serve
+        logger.info("使用Waitress服务器 (同步模式)")
+        serve(create_app(), host='0.0.0.0', port=port, threads=4)
+    elif SERVER == 'gunicorn':
+        workers = int(config.get('SERVER_WORKERS', 1))
+        logger.info("使用Gunicorn服务器 (同步模式)，worker进程数: %s", workers)
+        # 与 uvicorn 相同，用 gunicorn 替换当前进程，每个 worker 进程 fork 后各自创建应用和后台工作池
+        os.execvp(sys.executable, [
+            sys.executable, '-m', 'gunicorn', 'app:create_app()',
+            '--bind', f'0.0.0.0:{port}', '--workers', str(workers)
+        ])
+    else:
+        logger.warning("使用Flask开发服务器 - 仅限测试环境")
+        create_app().run(host='0.0.0.0', port=port)
\ No newline at end of file
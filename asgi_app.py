@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import os
+
+# 直接通过 uvicorn/gunicorn 加载本模块时默认进入异步服务模式
+os.environ.setdefault('SERVER', 'uvicorn')
+
+import app as bot
+from metrics import render as render_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class FeishuCallbackASGI:
+    """飞书事件回调的原生 ASGI 应用
+
+    复用 lark 事件处理器完成解密、校验和分发，事件处理器把消息放入调度器后立即应答，
+    消息处理协程与回调运行在同一个事件循环上。lifespan 启动时创建调度器并在后台预热，
+    关闭时等待队列排空后释放连接。/healthz 只说明进程存活，/readyz 在预热完成且依赖可用后才返回 200。
+    """
+
+    CALLBACK_PATH = '/feishu/callback'
+    METRICS_PATH = '/metrics'
+    HEALTH_PATH = '/healthz'
+    READY_PATH = '/readyz'
+    # 飞书事件体通常只有几 KB，超出上限直接拒绝
+    MAX_BODY_SIZE = 1024 * 1024
+
+    def __init__(self, get_handler, scheduler, startup_hooks=(), shutdown_hooks=(), shutdown_timeout=30.0,
+                 check_readiness=None, blocking_handler=False):
+        """
+        Args:
+            get_handler: 返回 lark EventDispatcherHandler 的函数，首次调用时导入 lark SDK
+            scheduler: KeyedScheduler 实例，事件处理器向其提交消息处理任务
+            startup_hooks: lifespan 启动时依次执行的协程函数（如创建连接池）
+            shutdown_hooks: 队列排空后依次执行的协程函数（如关闭连接池）
+            shutdown_timeout: 关闭时等待队列排空的最长秒数，超时后丢弃剩余任务
+            check_readiness: 返回 (HTTP 状态码, JSON 响应体) 的协程函数，为 None 时 /readyz 与 /healthz 相同
+            blocking_handler: 事件处理器会执行阻塞 IO（如 Stream 模式下同步写入 Redis）时为 True，
+                改在线程池中执行，避免阻塞事件循环
+        """
+        self.get_handler = get_handler
+        self.scheduler = scheduler
+        self.startup_hooks = list(startup_hooks)
+        self.shutdown_hooks = list(shutdown_hooks)
+        self.shutdown_timeout = shutdown_timeout
+        self.check_readiness = check_readiness
+        self.blocking_handler = blocking_handler
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.scheduler.start()
+                for hook in self.startup_hooks:
+                    try:
+                        await hook()
+                    except Exception as e:
+                        logger.exception("启动钩子执行失败: %s", e)
+                logger.info("异步服务worker已启动，进程: %s, 并发上限: %s", os.getpid(), self.scheduler.concurrency)
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self._shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _shutdown(self):
+        pending = self.scheduler.pending
+        if pending:
+            logger.info("等待消息队列排空，剩余任务: %s", pending)
+        if not await self.scheduler.join(timeout=self.shutdown_timeout):
+            logger.warning("消息队列未能在 %s 秒内排空，丢弃剩余任务: %s", self.shutdown_timeout, self.scheduler.pending)
+        await self.scheduler.stop()
+        for hook in self.shutdown_hooks:
+            try:
+                await hook()
+            except Exception as e:
+                logger.exception("关闭钩子执行失败: %s", e)
+
+    async def _http(self, scope, receive, send):
+        if scope['path'] == self.METRICS_PATH and scope['method'] == 'GET':
+            body, content_type = render_metrics()
+            await self._respond(send, 200, body, [(b'content-type', content_type.encode('latin-1'))])
+            return
+        if scope['path'] == self.HEALTH_PATH and scope['method'] == 'GET':
+            await self._respond(send, 200, b'ok')
+            return
+        if scope['path'] == self.READY_PATH and scope['method'] == 'GET':
+            await self._ready(send)
+            return
+        if scope['path'] != self.CALLBACK_PATH:
+            await self._respond(send, 404, b'Not Found')
+            return
+        if scope['method'] != 'POST':
+            await self._respond(send, 405, b'Method Not Allowed')
+            return
+        body = await self._read_body(receive)
+        if body is None:
+            await self._respond(send, 413, b'Payload Too Large')
+            return
+        handler = self.get_handler()
+        from lark_oapi.core.model import RawRequest
+        req = RawRequest()
+        req.uri = scope['path']
+        req.body = body
+        # lark 按规范大小写读取签名相关请求头，ASGI 请求头均为小写
+        req.headers = {name.decode('latin-1').title(): value.decode('latin-1') for name, value in scope['headers']}
+        try:
+            if self.blocking_handler:
+                resp = await asyncio.get_running_loop().run_in_executor(None, handler.do, req)
+            else:
+                # 解密、校验和入队都是内存操作，直接在事件循环上执行
+                resp = handler.do(req)
+        except Exception:
+            logger.exception("处理飞书回调时发生异常")
+            await self._respond(send, 500, b'Server Error')
+            return
+        headers = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in resp.headers.items()]
+        await self._respond(send, resp.status_code, resp.content or b'', headers)
+
+    async def _ready(self, send):
+        if self.check_readiness is None:
+            await self._respond(send, 200, b'ok')
+            return
+        try:
+            status, body = await self.check_readiness()
+        except Exception as e:
+            logger.exception("就绪检查异常: %s", e)
+            status, body = 503, '{"ready": false}'
+        await self._respond(send, status, body.encode('utf-8'), [(b'content-type', b'application/json; charset=utf-8')])
+
+    async def _read_body(self, receive):
+        chunks = []
+        size = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return b''.join(chunks)
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.MAX_BODY_SIZE:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body', False):
+                return b''.join(chunks)
+
+    @staticmethod
+    async def _respond(send, status, body, headers=None):
+        if headers is None:
+            headers = [(b'content-type', b'text/plain; charset=utf-8')]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def create_app():
+    """创建 ASGI 应用，用法: uvicorn asgi_app:create_app --factory
+
+    lifespan 启动时只启动调度器并在后台开始预热，worker 可以立即响应健康检查。
+    """
+    if not bot.ASYNC_SERVER_MODE:
+        raise RuntimeError(f"asgi_app 仅支持 SERVER=uvicorn，当前为 {bot.SERVER}")
+    bot.check_required_configs()
+    shutdown_timeout = float(bot.config.get('WORKER_SHUTDOWN_TIMEOUT', 30))
+    shutdown_hooks = [bot.ds_client.close, bot.redis_store.close, bot.feishu_sender.close]
+    if bot.usage_accountant is not None:
+        # 写入剩余用量后再关闭 Redis 连接池
+        shutdown_hooks.insert(1, bot.usage_accountant.close)
+    if bot.message_coalescer is not None:
+        # 调度队列排空后处理仍在合并窗口中的消息，再关闭连接池
+        shutdown_hooks.insert(0, lambda: bot.message_coalescer.drain(timeout=shutdown_timeout))
+    return FeishuCallbackASGI(
+        bot.get_event_handler,
+        bot.event_scheduler,
+        startup_hooks=[bot.start_warm_up],
+        shutdown_hooks=shutdown_hooks,
+        shutdown_timeout=shutdown_timeout,
+        check_readiness=bot.check_readiness,
+        # Stream 模式下回调同步写入 Redis 后才应答，保证应答过的事件不会丢失
+        blocking_handler=bot.event_publisher is not None
+    )
+
+
+_application = None
+
+
+def __getattr__(name):
+    # 兼容 uvicorn asgi_app:application 的启动方式，首次访问时才创建应用
+    global _application
+    if name == 'application':
+        if _application is None:
+            _application = create_app()
+        return _application
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,139 @@
+"""SSE 解析微基准：对比逐行解析与增量解码器在长推理流上的每 token 解析开销
+
+用法：
+    python bench/bench_sse_parser.py --reasoning-tokens 8000 --content-tokens 1000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+from aiohttp import StreamReader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sse_parser import CONTENT, REASONING, ChatStreamDecoder  # noqa: E402
+
+
+def build_stream(reasoning_tokens, content_tokens):
+    """构造与 deepseek-reasoner 格式一致的 SSE 字节流"""
+    base = {
+        'id': 'bench-0f6c7e1a', 'object': 'chat.completion.chunk', 'created': 1700000000,
+        'model': 'deepseek-reasoner', 'system_fingerprint': 'fp_bench'
+    }
+    events = []
+    for field, count in (('reasoning_content', reasoning_tokens), ('content', content_tokens)):
+        for i in range(count):
+            delta = {'role': None, 'content': None, 'reasoning_content': None}
+            delta[field] = f"词{i % 97}"
+            chunk = dict(base, choices=[{'index': 0, 'delta': delta, 'logprobs': None, 'finish_reason': None}])
+            events.append(b'data: ' + json.dumps(chunk, ensure_ascii=False).encode('utf-8') + b'\n\n')
+            if i % 500 == 0:
+                events.append(b': keep-alive\n\n')
+    usage = {'prompt_tokens': 100, 'completion_tokens': reasoning_tokens + content_tokens}
+    events.append(b'data: ' + json.dumps(dict(base, choices=[{'index': 0, 'delta': {'content': ''}, 'finish_reason': 'stop'}], usage=usage)).encode('utf-8') + b'\n\n')
+    events.append(b'data: [DONE]\n\n')
+    return b''.join(events)
+
+
+def split_reads(raw, read_size, seed):
+    """按接近 read_size 的随机长度切分，模拟 TCP 分包"""
+    rng = random.Random(seed)
+    reads, i = [], 0
+    while i < len(raw):
+        n = rng.randint(max(1, read_size // 2), read_size * 3 // 2)
+        reads.append(raw[i:i + n])
+        i += n
+    return reads
+
+
+class _Protocol:
+    """StreamReader 需要的最小协议对象，压测中不做流控"""
+
+    def pause_reading(self, *args, **kwargs):
+        pass
+
+    def resume_reading(self, *args, **kwargs):
+        pass
+
+
+def _reader(reads):
+    # 与客户端收到的响应体一致：按 TCP 分包写入 aiohttp 的 StreamReader
+    reader = StreamReader(_Protocol(), 2 ** 16, loop=asyncio.get_running_loop())
+    for data in reads:
+        reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+async def parse_legacy(reads):
+    """原实现：按行读取响应体，逐行解码后解析"""
+    tokens = 0
+    async for chunk in _reader(reads):
+        if chunk:
+            chunk_str = chunk.decode('utf-8')
+            if chunk_str.startswith('data: '):
+                data_str = chunk_str[6:]
+                if data_str.strip() == '[DONE]':
+                    break
+                try:
+                    data = json.loads(data_str)
+                    if 'choices' in data and len(data['choices']) > 0:
+                        delta = data['choices'][0].get('delta', {})
+                        if delta.get('reasoning_content'):
+                            tokens += 1
+                        if delta.get('content'):
+                            tokens += 1
+                except json.JSONDecodeError:
+                    pass
+    return tokens
+
+
+async def parse_decoder(reads):
+    """增量解码器：按读取到的字节块解码完整事件"""
+    decoder = ChatStreamDecoder()
+    tokens = 0
+    async for data in _reader(reads).iter_any():
+        for kind, _ in decoder.feed(data):
+            if kind == REASONING or kind == CONTENT:
+                tokens += 1
+        if decoder.done:
+            break
+    return tokens
+
+
+def measure(func, reads, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tokens = asyncio.run(func(reads))
+        best = min(best, time.perf_counter() - start)
+    return best, tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SSE 解析微基准')
+    parser.add_argument('--reasoning-tokens', type=int, default=8000)
+    parser.add_argument('--content-tokens', type=int, default=1000)
+    parser.add_argument('--read-sizes', default='64,512,4096', help='模拟的 TCP 读取大小，逗号分隔')
+    parser.add_argument('--repeat', type=int, default=5, help='重复次数，取最好成绩')
+    args = parser.parse_args()
+
+    raw = build_stream(args.reasoning_tokens, args.content_tokens)
+    expected = args.reasoning_tokens + args.content_tokens
+    print(f"流大小: {len(raw)} 字节，token 数: {expected}")
+
+    print(f"{'读取大小':<10}{'逐行解析':>16}{'增量解码':>16}")
+    for read_size in (int(size) for size in args.read_sizes.split(',')):
+        reads = split_reads(raw, read_size, seed=read_size)
+        legacy, legacy_tokens = measure(parse_legacy, reads, args.repeat)
+        decoded, decoded_tokens = measure(parse_decoder, reads, args.repeat)
+        print(f"{f'≈{read_size}B':<10}{legacy * 1e6 / expected:>10.2f} µs/token{decoded * 1e6 / expected:>10.2f} µs/token"
+              f"  tokens={legacy_tokens}/{decoded_tokens}")
+
+
+if __name__ == '__main__':
+    main()
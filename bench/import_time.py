@@ -0,0 +1,71 @@
+"""测量导入 app 模块的耗时，超出预算时返回非零退出码，可在 CI 中检查启动开销
+
+用法示例：
+    python bench/import_time.py
+    python bench/import_time.py --runs 10 --budget 0.5 --top 15
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 导入 app 只需要配置存在，不会连接 Redis、DeepSeek 或飞书
+DUMMY_ENV = {
+    'DEEPSEEK_API_KEY': 'bench-deepseek-key',
+    'FEISHU_APP_ID': 'cli_bench',
+    'FEISHU_APP_SECRET': 'bench-secret',
+    'FEISHU_ENCRYPT_KEY': 'bench-encrypt-key',
+    'FEISHU_VERIFICATION_TOKEN': 'bench-verification-token',
+    'REDIS_HOST': '127.0.0.1',
+    'LOG_LEVEL': 'WARNING'
+}
+
+
+def measure_once():
+    """在新的解释器中导入 app，返回 (墙钟秒数, {模块: 累计秒数})"""
+    env = dict(os.environ)
+    env.update(DUMMY_ENV)
+    code = 'import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=REPO_ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # 只统计 app 直接导入的模块，缩进每深一层多两个空格
+        if name.startswith('   ') and not name.startswith('    '):
+            modules[name.strip()] = int(cumulative) / 1e6
+    return float(result.stdout.strip().splitlines()[-1]), modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='测量 app 模块的导入耗时')
+    parser.add_argument('--runs', type=int, default=5, help='测量次数，取中位数')
+    parser.add_argument('--budget', type=float, default=1.0, help='导入耗时预算（秒）')
+    parser.add_argument('--top', type=int, default=10, help='列出耗时最多的模块数')
+    args = parser.parse_args()
+
+    timings = []
+    slowest = {}
+    for _ in range(args.runs):
+        elapsed, modules = measure_once()
+        timings.append(elapsed)
+        for name, seconds in modules.items():
+            slowest[name] = max(slowest.get(name, 0.0), seconds)
+    median = statistics.median(timings)
+    print(f"导入 app 耗时(秒): median={median:.3f} min={min(timings):.3f} max={max(timings):.3f}，预算: {args.budget}")
+    print("耗时最多的模块(累计秒数):")
+    for name, seconds in sorted(slowest.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"  {seconds:.3f}  {name}")
+    if median > args.budget:
+        print(f"导入耗时超出预算 {args.budget} 秒")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
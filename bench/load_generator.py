@@ -0,0 +1,213 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import time
+from collections import Counter
+
+import aiohttp
+from Crypto.Cipher import AES
+
+
+class FeishuEventFactory:
+    """构造与飞书一致的加密、签名 im.message.receive_v1 回调请求"""
+
+    def __init__(self, encrypt_key, verification_token):
+        self.encrypt_key = encrypt_key
+        self.verification_token = verification_token
+        self._key = hashlib.sha256(encrypt_key.encode('utf-8')).digest()
+
+    def _encrypt(self, plaintext):
+        iv = os.urandom(AES.block_size)
+        data = plaintext.encode('utf-8')
+        pad = AES.block_size - len(data) % AES.block_size
+        data += bytes([pad]) * pad
+        return base64.b64encode(iv + AES.new(self._key, AES.MODE_CBC, iv).encrypt(data)).decode('utf-8')
+
+    def build(self, event_id, message_id, open_id, text):
+        """返回 (请求体, 请求头)"""
+        event = {
+            'schema': '2.0',
+            'header': {
+                'event_id': event_id,
+                'event_type': 'im.message.receive_v1',
+                'create_time': str(int(time.time() * 1000)),
+                'token': self.verification_token,
+                'app_id': 'cli_bench',
+                'tenant_key': 'bench'
+            },
+            'event': {
+                'sender': {'sender_id': {'open_id': open_id}, 'sender_type': 'user'},
+                'message': {
+                    'message_id': message_id,
+                    'chat_type': 'p2p',
+                    'message_type': 'text',
+                    'content': json.dumps({'text': text}, ensure_ascii=False)
+                }
+            }
+        }
+        body = json.dumps({'encrypt': self._encrypt(json.dumps(event, ensure_ascii=False))}).encode('utf-8')
+        timestamp = str(int(time.time()))
+        nonce = os.urandom(8).hex()
+        signature = hashlib.sha256((timestamp + nonce + self.encrypt_key).encode('utf-8') + body).hexdigest()
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Lark-Request-Timestamp': timestamp,
+            'X-Lark-Request-Nonce': nonce,
+            'X-Lark-Signature': signature
+        }
+        return body, headers
+
+
+class _PendingReply:
+    __slots__ = ('sent_at', 'first_at', 'future')
+
+    def __init__(self, sent_at, future):
+        self.sent_at = sent_at
+        self.first_at = None
+        self.future = future
+
+
+class LoadGenerator:
+    """按用户并发回放消息事件，并通过飞书替身的回调统计端到端耗时
+
+    每个虚拟用户顺序发送消息，收到最终回复后再发下一条；按比例在短暂延迟后
+    重推同一事件，模拟飞书超时重推，检验去重是否生效。
+    """
+
+    def __init__(self, callback_url, factory, users=20, messages_per_user=5, duplicate_rate=0.0,
+                 duplicate_delay=0.05, think_time=0.0, reply_timeout=60.0, seed=None):
+        """
+        Args:
+            callback_url: 机器人回调地址
+            factory: FeishuEventFactory 实例
+            users: 并发虚拟用户数
+            messages_per_user: 每个用户发送的消息数
+            duplicate_rate: 重推同一事件的比例（0-1）
+            duplicate_delay: 重推前的等待秒数
+            think_time: 收到回复后到发送下一条消息的间隔秒数
+            reply_timeout: 等待回复的最长秒数，超时计入 timeouts
+            seed: 随机数种子
+        """
+        self.callback_url = callback_url
+        self.factory = factory
+        self.users = users
+        self.messages_per_user = messages_per_user
+        self.duplicate_rate = duplicate_rate
+        self.duplicate_delay = duplicate_delay
+        self.think_time = think_time
+        self.reply_timeout = reply_timeout
+        self._random = random.Random(seed)
+        self._run_id = os.urandom(4).hex()
+        self._pending = {}
+        self._session = None
+        self._background = set()
+        self.latencies = []
+        self.ttfts = []
+        self.statuses = Counter()
+        self.timeouts = 0
+        self.duplicates_posted = 0
+        self.unexpected_replies = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def on_feishu_message(self, receive_id, kind, finished, timestamp):
+        """MockFeishu 监听回调：首条可见回复记为首 token，最终回复结束计时"""
+        pending = self._pending.get(receive_id)
+        if pending is None:
+            # 没有等待中的消息却收到回复，通常是重复事件被处理了两次
+            if kind != 'patch':
+                self.unexpected_replies += 1
+            return
+        if pending.first_at is None:
+            pending.first_at = timestamp
+        if finished and not pending.future.done():
+            pending.future.set_result(timestamp)
+
+    async def run(self):
+        connector = aiohttp.TCPConnector(limit=max(self.users * 2, 10))
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self._session = session
+            self.started_at = time.perf_counter()
+            await asyncio.gather(*(self._run_user(i) for i in range(self.users)))
+            self.finished_at = time.perf_counter()
+            if self._background:
+                await asyncio.gather(*self._background, return_exceptions=True)
+
+    async def _post(self, body, headers):
+        try:
+            async with self._session.post(self.callback_url, data=body, headers=headers) as response:
+                await response.read()
+                self.statuses[response.status] += 1
+        except aiohttp.ClientError as e:
+            self.statuses[type(e).__name__] += 1
+
+    async def _post_duplicate(self, body, headers):
+        await asyncio.sleep(self.duplicate_delay)
+        self.duplicates_posted += 1
+        await self._post(body, headers)
+
+    async def _run_user(self, index):
+        open_id = f"ou_bench_{self._run_id}_{index}"
+        loop = asyncio.get_running_loop()
+        for seq in range(self.messages_per_user):
+            message_id = f"om_bench_{self._run_id}_{index}_{seq}"
+            event_id = f"ev_bench_{self._run_id}_{index}_{seq}"
+            body, headers = self.factory.build(event_id, message_id, open_id, f"压测消息 {index}-{seq}，请简单回复")
+            pending = _PendingReply(time.perf_counter(), loop.create_future())
+            self._pending[open_id] = pending
+            await self._post(body, headers)
+            if self.duplicate_rate and self._random.random() < self.duplicate_rate:
+                task = loop.create_task(self._post_duplicate(body, headers))
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+            try:
+                finished_at = await asyncio.wait_for(pending.future, timeout=self.reply_timeout)
+                self.latencies.append(finished_at - pending.sent_at)
+                if pending.first_at is not None:
+                    self.ttfts.append(pending.first_at - pending.sent_at)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+            finally:
+                self._pending.pop(open_id, None)
+            if self.think_time:
+                await asyncio.sleep(self.think_time)
+
+    def summary(self):
+        duration = (self.finished_at or time.perf_counter()) - (self.started_at or time.perf_counter())
+        completed = len(self.latencies)
+        return {
+            'messages': self.users * self.messages_per_user,
+            'completed': completed,
+            'timeouts': self.timeouts,
+            'duration_seconds': round(duration, 3),
+            'throughput_per_second': round(completed / duration, 3) if duration > 0 else 0.0,
+            'latency_seconds': distribution(self.latencies),
+            'ttft_seconds': distribution(self.ttfts),
+            'callback_status': {str(k): v for k, v in sorted(self.statuses.items(), key=lambda item: str(item[0]))},
+            'duplicates_posted': self.duplicates_posted,
+            'unexpected_replies': self.unexpected_replies
+        }
+
+
+def percentile(sorted_values, p):
+    """最近秩法百分位数，sorted_values 须已排序"""
+    if not sorted_values:
+        return None
+    rank = max(1, min(len(sorted_values), int(round(p / 100.0 * len(sorted_values) + 0.5))))
+    return sorted_values[rank - 1]
+
+
+def distribution(values):
+    values = sorted(values)
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'mean': None, 'max': None}
+    return {
+        'p50': round(percentile(values, 50), 4),
+        'p95': round(percentile(values, 95), 4),
+        'p99': round(percentile(values, 99), 4),
+        'mean': round(sum(values) / len(values), 4),
+        'max': round(values[-1], 4)
+    }
@@ -0,0 +1,154 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+class MockDeepSeek:
+    """离线压测用的 DeepSeek 替身，兼容 OpenAI 格式的 /chat/completions 接口
+
+    支持 SSE 流式输出，可配置首 token 延迟、输出速率、回复长度，并按比例注入 429/503。
+    """
+
+    def __init__(self, first_token_latency=0.5, tokens_per_second=50.0, reply_tokens=40, reasoning_tokens=0,
+                 error_rate=0.0, error_status=429, retry_after=None, seed=None):
+        """
+        Args:
+            first_token_latency: 首个 token 前的等待秒数
+            tokens_per_second: 输出速率（token/秒），0 表示不限速
+            reply_tokens: 每次回复的 content token 数
+            reasoning_tokens: deepseek-reasoner 在 content 之前输出的 reasoning_content token 数
+            error_rate: 注入错误的请求比例（0-1）
+            error_status: 注入的错误状态码，429 或 503
+            retry_after: 注入错误时返回的 Retry-After 秒数，为 None 时不返回
+            seed: 随机数种子，便于复现
+        """
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.reasoning_tokens = reasoning_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self.requests = 0
+        self.injected_errors = 0
+        self.stream_requests = 0
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post('/chat/completions', self.handle_completions)
+        app.router.add_post('/v1/chat/completions', self.handle_completions)
+        app.router.add_get('/user/balance', self.handle_balance)
+        app.router.add_get('/_stats', self.handle_stats)
+        return app
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'stream_requests': self.stream_requests,
+            'injected_errors': self.injected_errors
+        }
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    async def handle_balance(self, request):
+        return web.json_response({
+            'is_available': True,
+            'balance_infos': [{'currency': 'CNY', 'total_balance': '100.00', 'granted_balance': '0.00', 'topped_up_balance': '100.00'}]
+        })
+
+    async def handle_completions(self, request):
+        body = await request.json()
+        self.requests += 1
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.injected_errors += 1
+            headers = {'Retry-After': str(self.retry_after)} if self.retry_after is not None else {}
+            return web.json_response({'error': {'message': 'injected error'}}, status=self.error_status, headers=headers)
+        model = body.get('model', 'deepseek-chat')
+        prompt_tokens = sum(len(str(m.get('content', ''))) for m in body.get('messages', [])) // 2 + 1
+        reasoning = self.reasoning_tokens if model == 'deepseek-reasoner' else 0
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': self.reply_tokens + reasoning,
+            'total_tokens': prompt_tokens + self.reply_tokens + reasoning,
+            'prompt_cache_hit_tokens': prompt_tokens // 2,
+            'prompt_cache_miss_tokens': prompt_tokens - prompt_tokens // 2
+        }
+        if body.get('stream'):
+            self.stream_requests += 1
+            return await self._stream(request, model, reasoning, usage)
+        await asyncio.sleep(self.first_token_latency + self._generation_seconds(self.reply_tokens + reasoning))
+        message = {'role': 'assistant', 'content': self._reply_text(self.reply_tokens)}
+        if reasoning:
+            message['reasoning_content'] = self._reply_text(reasoning)
+        return web.json_response({
+            'id': f"mock-{self.requests}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}],
+            'usage': usage
+        })
+
+    async def _stream(self, request, model, reasoning, usage):
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        await asyncio.sleep(self.first_token_latency)
+        interval = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+        for field, count in (('reasoning_content', reasoning), ('content', self.reply_tokens)):
+            for i in range(count):
+                delta = {'reasoning_content': None, 'content': None}
+                delta[field] = self._token(i)
+                await response.write(self._event({'model': model, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]}))
+                if interval:
+                    await asyncio.sleep(interval)
+        await response.write(self._event({'model': model, 'choices': [{'index': 0, 'delta': {'content': ''}, 'finish_reason': 'stop'}], 'usage': usage}))
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+    def _generation_seconds(self, tokens):
+        return tokens / self.tokens_per_second if self.tokens_per_second > 0 else 0
+
+    @staticmethod
+    def _token(i):
+        return f"词{i} "
+
+    def _reply_text(self, tokens):
+        return ''.join(self._token(i) for i in range(tokens))
+
+    @staticmethod
+    def _event(data):
+        return b'data: ' + json.dumps(data, ensure_ascii=False).encode('utf-8') + b'\n\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='离线 DeepSeek 替身服务')
+    parser.add_argument('--port', type=int, default=8801)
+    parser.add_argument('--first-token-latency', type=float, default=0.5)
+    parser.add_argument('--tokens-per-second', type=float, default=50.0)
+    parser.add_argument('--reply-tokens', type=int, default=40)
+    parser.add_argument('--reasoning-tokens', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-status', type=int, default=429, choices=(429, 503))
+    parser.add_argument('--retry-after', type=float, default=None)
+    args = parser.parse_args()
+    mock = MockDeepSeek(
+        first_token_latency=args.first_token_latency,
+        tokens_per_second=args.tokens_per_second,
+        reply_tokens=args.reply_tokens,
+        reasoning_tokens=args.reasoning_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after
+    )
+    web.run_app(mock.create_app(), host='127.0.0.1', port=args.port)
+
+
+if __name__ == '__main__':
+    main()
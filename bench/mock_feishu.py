@@ -0,0 +1,124 @@
+import argparse
+import itertools
+import json
+import time
+
+from aiohttp import web
+
+# 流式卡片未完成时正文末尾带有输入中标记，首个正文 token 到达前显示思考中占位
+STREAMING_MARKERS = ('▌', '思考中...')
+
+
+class MockFeishu:
+    """离线压测用的飞书开放接口替身
+
+    提供 tenant_access_token、发送消息（支持 uuid 幂等）和更新卡片接口，
+    记录每条消息的到达时间，并在用户可见的首次回复和最终回复时通知监听方。
+    """
+
+    TOKEN = 'mock-tenant-access-token'
+
+    def __init__(self):
+        self._message_ids = itertools.count(1)
+        # uuid -> message_id
+        self._uuids = {}
+        # message_id -> receive_id
+        self._receivers = {}
+        self._listeners = []
+        self.token_requests = 0
+        self.creates = 0
+        self.patches = 0
+        self.duplicate_uuids = 0
+        self.unauthorized = 0
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post('/open-apis/auth/v3/tenant_access_token/internal', self.handle_token)
+        app.router.add_post('/open-apis/im/v1/messages', self.handle_create)
+        app.router.add_patch('/open-apis/im/v1/messages/{message_id}', self.handle_patch)
+        app.router.add_get('/_stats', self.handle_stats)
+        return app
+
+    def add_listener(self, listener):
+        """注册回调 listener(receive_id, kind, finished, timestamp)，kind 为 text/card/patch"""
+        self._listeners.append(listener)
+
+    def stats(self):
+        return {
+            'token_requests': self.token_requests,
+            'creates': self.creates,
+            'patches': self.patches,
+            'duplicate_uuids': self.duplicate_uuids,
+            'unauthorized': self.unauthorized
+        }
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    async def handle_token(self, request):
+        self.token_requests += 1
+        return web.json_response({'code': 0, 'msg': 'ok', 'tenant_access_token': self.TOKEN, 'expire': 7200})
+
+    def _authorized(self, request):
+        if request.headers.get('Authorization') != f"Bearer {self.TOKEN}":
+            self.unauthorized += 1
+            return False
+        return True
+
+    async def handle_create(self, request):
+        if not self._authorized(request):
+            return web.json_response({'code': 99991663, 'msg': 'invalid tenant_access_token'}, status=400)
+        body = await request.json()
+        uuid = body.get('uuid')
+        if uuid and uuid in self._uuids:
+            # 与飞书一致：相同 uuid 只发送一次，返回首次发送的消息
+            self.duplicate_uuids += 1
+            return web.json_response({'code': 0, 'msg': 'success', 'data': {'message_id': self._uuids[uuid]}})
+        message_id = f"om_mock_{next(self._message_ids)}"
+        if uuid:
+            self._uuids[uuid] = message_id
+        receive_id = body.get('receive_id')
+        self._receivers[message_id] = receive_id
+        self.creates += 1
+        if body.get('msg_type') == 'interactive':
+            self._notify(receive_id, 'card', self._card_finished(body.get('content', '')))
+        else:
+            self._notify(receive_id, 'text', True)
+        return web.json_response({'code': 0, 'msg': 'success', 'data': {'message_id': message_id, 'msg_type': body.get('msg_type')}})
+
+    async def handle_patch(self, request):
+        if not self._authorized(request):
+            return web.json_response({'code': 99991663, 'msg': 'invalid tenant_access_token'}, status=400)
+        message_id = request.match_info['message_id']
+        body = await request.json()
+        self.patches += 1
+        receive_id = self._receivers.get(message_id)
+        if receive_id is not None:
+            self._notify(receive_id, 'patch', self._card_finished(body.get('content', '')))
+        return web.json_response({'code': 0, 'msg': 'success', 'data': {}})
+
+    @staticmethod
+    def _card_finished(content):
+        try:
+            card = json.loads(content)
+            # 只看正文，忽略可折叠的思考过程面板
+            text = ''.join(element.get('content', '') for element in card.get('body', {}).get('elements', []) if element.get('tag') == 'markdown')
+        except (TypeError, ValueError, AttributeError):
+            text = content
+        return not any(marker in text for marker in STREAMING_MARKERS)
+
+    def _notify(self, receive_id, kind, finished):
+        now = time.perf_counter()
+        for listener in self._listeners:
+            listener(receive_id, kind, finished, now)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='离线飞书开放接口替身服务')
+    parser.add_argument('--port', type=int, default=8802)
+    args = parser.parse_args()
+    web.run_app(MockFeishu().create_app(), host='127.0.0.1', port=args.port)
+
+
+if __name__ == '__main__':
+    main()
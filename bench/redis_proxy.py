@@ -0,0 +1,67 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RoundTripCountingProxy:
+    """统计 Redis 网络往返次数的 TCP 透传代理
+
+    每条连接上客户端在收到响应后再次发送数据记为一次往返，
+    pipeline 中的多条命令一次发送，只记一次。
+    """
+
+    def __init__(self, upstream_host, upstream_port, listen_host='127.0.0.1', listen_port=0):
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.round_trips = 0
+        self.bytes_sent = 0
+        self._server = None
+
+    @property
+    def port(self):
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.listen_host, self.listen_port)
+        return self
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, client_reader, client_writer):
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(self.upstream_host, self.upstream_port)
+        except OSError as e:
+            logger.error(f"连接上游 Redis 失败: {str(e)}")
+            client_writer.close()
+            return
+        # 每条连接上一次请求发出后、收到响应前的后续数据属于同一次往返
+        state = {'awaiting_response': False}
+        await asyncio.gather(
+            self._pipe(client_reader, upstream_writer, state, upstream=True),
+            self._pipe(upstream_reader, client_writer, state, upstream=False),
+            return_exceptions=True
+        )
+
+    async def _pipe(self, reader, writer, state, upstream):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                if upstream:
+                    if not state['awaiting_response']:
+                        self.round_trips += 1
+                        state['awaiting_response'] = True
+                    self.bytes_sent += len(data)
+                else:
+                    state['awaiting_response'] = False
+                writer.write(data)
+                await writer.drain()
+        finally:
+            writer.close()
@@ -0,0 +1,278 @@
+"""离线压测：在本地启动 DeepSeek、飞书替身和 Redis 往返计数代理，以子进程运行机器人并回放事件
+
+用法示例：
+    python bench/run_bench.py --fake-redis --users 20 --messages 5 --output baseline.json
+    python bench/run_bench.py --fake-redis --stream --compare baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import aiohttp
+from aiohttp import web
+
+from load_generator import FeishuEventFactory, LoadGenerator
+from mock_deepseek import MockDeepSeek
+from mock_feishu import MockFeishu
+from redis_proxy import RoundTripCountingProxy
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENCRYPT_KEY = 'bench-encrypt-key'
+VERIFICATION_TOKEN = 'bench-verification-token'
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_redis():
+    """在后台线程启动 fakeredis 的 TCP 服务，返回端口"""
+    try:
+        from fakeredis import TcpFakeServer
+    except ImportError:
+        sys.exit('--fake-redis 需要安装 fakeredis：pip install -r bench/requirements.txt')
+    port = free_port()
+    server = TcpFakeServer(('127.0.0.1', port), server_type='redis')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return port
+
+
+async def start_site(app):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner, port
+
+
+def bot_environment(args, bot_port, redis_port, deepseek_port, feishu_port):
+    env = dict(os.environ)
+    env.update({
+        'PORT': str(bot_port),
+        'SERVER': args.server,
+        'SERVER_WORKERS': str(args.server_workers),
+        'REDIS_HOST': '127.0.0.1',
+        'REDIS_PORT': str(redis_port),
+        'REDIS_DB': str(args.redis_db),
+        'DEEPSEEK_API_KEY': 'bench-deepseek-key',
+        'DEEPSEEK_API_URL': f"http://127.0.0.1:{deepseek_port}/chat/completions",
+        'FEISHU_APP_ID': 'cli_bench',
+        'FEISHU_APP_SECRET': 'bench-secret',
+        'FEISHU_ENCRYPT_KEY': ENCRYPT_KEY,
+        'FEISHU_VERIFICATION_TOKEN': VERIFICATION_TOKEN,
+        'FEISHU_API_BASE_URL': f"http://127.0.0.1:{feishu_port}/open-apis",
+        'STREAM_REPLY_MODE': 'true' if args.stream else 'false'
+    })
+    for item in args.bot_env:
+        key, _, value = item.partition('=')
+        env[key] = value
+    return env
+
+
+async def wait_ready(url, process, timeout):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"机器人进程已退出，返回码: {process.returncode}")
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"机器人在 {timeout} 秒内未就绪")
+
+
+def stop_process(process, timeout=15):
+    if process.poll() is not None:
+        return
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def run(args):
+    redis_port = start_fake_redis() if args.fake_redis else args.redis_port
+    proxy = await RoundTripCountingProxy(args.redis_host if not args.fake_redis else '127.0.0.1', redis_port).start()
+
+    deepseek = MockDeepSeek(
+        first_token_latency=args.first_token_latency,
+        tokens_per_second=args.tokens_per_second,
+        reply_tokens=args.reply_tokens,
+        reasoning_tokens=args.reasoning_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        retry_after=args.retry_after,
+        seed=args.seed
+    )
+    feishu = MockFeishu()
+    deepseek_runner, deepseek_port = await start_site(deepseek.create_app())
+    feishu_runner, feishu_port = await start_site(feishu.create_app())
+
+    bot_port = free_port()
+    log_file = tempfile.NamedTemporaryFile(prefix='bench-bot-', suffix='.log', delete=False)
+    process = subprocess.Popen(
+        [sys.executable, 'app.py'],
+        cwd=REPO_ROOT,
+        env=bot_environment(args, bot_port, proxy.port, deepseek_port, feishu_port),
+        stdout=log_file,
+        stderr=subprocess.STDOUT
+    )
+    try:
+        await wait_ready(f"http://127.0.0.1:{bot_port}/readyz", process, args.startup_timeout)
+        generator = LoadGenerator(
+            f"http://127.0.0.1:{bot_port}/feishu/callback",
+            FeishuEventFactory(ENCRYPT_KEY, VERIFICATION_TOKEN),
+            users=args.users,
+            messages_per_user=args.messages,
+            duplicate_rate=args.duplicate_rate,
+            think_time=args.think_time,
+            reply_timeout=args.reply_timeout,
+            seed=args.seed
+        )
+        feishu.add_listener(generator.on_feishu_message)
+        # 启动阶段的连接检查不计入
+        round_trips_before = proxy.round_trips
+        await generator.run()
+        # 等待重推事件的处理结果落地，便于发现重复回复
+        await asyncio.sleep(args.settle_time)
+        round_trips = proxy.round_trips - round_trips_before
+    finally:
+        stop_process(process)
+        await proxy.close()
+        await deepseek_runner.cleanup()
+        await feishu_runner.cleanup()
+        log_file.close()
+
+    report = generator.summary()
+    report['redis_round_trips'] = round_trips
+    report['redis_round_trips_per_message'] = round(round_trips / report['completed'], 2) if report['completed'] else None
+    report['deepseek'] = deepseek.stats()
+    report['feishu'] = feishu.stats()
+    report['config'] = {
+        'server': args.server,
+        'server_workers': args.server_workers,
+        'stream': args.stream,
+        'users': args.users,
+        'messages': args.messages,
+        'duplicate_rate': args.duplicate_rate,
+        'first_token_latency': args.first_token_latency,
+        'tokens_per_second': args.tokens_per_second,
+        'reply_tokens': args.reply_tokens,
+        'error_rate': args.error_rate,
+        'bot_env': args.bot_env
+    }
+    report['bot_log'] = log_file.name
+    return report
+
+
+# 对比时关注的指标，值越小越好的指标为 True
+COMPARE_METRICS = [
+    ('throughput_per_second', False),
+    ('latency_seconds.p50', True),
+    ('latency_seconds.p95', True),
+    ('latency_seconds.p99', True),
+    ('ttft_seconds.p50', True),
+    ('ttft_seconds.p95', True),
+    ('ttft_seconds.p99', True),
+    ('redis_round_trips_per_message', True),
+    ('timeouts', True),
+    ('unexpected_replies', True)
+]
+
+
+def lookup(report, path):
+    value = report
+    for part in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def print_report(report, baseline=None):
+    latency = report['latency_seconds']
+    ttft = report['ttft_seconds']
+    print(f"消息数: {report['messages']}，完成: {report['completed']}，超时: {report['timeouts']}，耗时: {report['duration_seconds']} 秒")
+    print(f"吞吐量: {report['throughput_per_second']} 条/秒")
+    print(f"端到端延迟(秒): p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} mean={latency['mean']} max={latency['max']}")
+    print(f"首 token 延迟(秒): p50={ttft['p50']} p95={ttft['p95']} p99={ttft['p99']} mean={ttft['mean']} max={ttft['max']}")
+    print(f"Redis 往返: {report['redis_round_trips']}，每条消息: {report['redis_round_trips_per_message']}")
+    print(f"回调状态码: {report['callback_status']}，重推事件: {report['duplicates_posted']}，重复回复: {report['unexpected_replies']}")
+    print(f"DeepSeek 替身: {report['deepseek']}")
+    print(f"飞书替身: {report['feishu']}")
+    print(f"机器人日志: {report['bot_log']}")
+    if baseline is None:
+        return
+    print()
+    print(f"{'指标':<32}{'基线':>12}{'本次':>12}{'变化':>10}")
+    for path, lower_is_better in COMPARE_METRICS:
+        old, new = lookup(baseline, path), lookup(report, path)
+        if old is None or new is None:
+            change = '-'
+        elif old == 0:
+            change = '0.0%' if new == 0 else 'n/a'
+        else:
+            delta = (new - old) / old * 100
+            better = delta < 0 if lower_is_better else delta > 0
+            change = f"{delta:+.1f}%{' ✓' if better and abs(delta) >= 1 else ''}"
+        print(f"{path:<32}{str(old):>12}{str(new):>12}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='离线压测：回放飞书消息事件，统计吞吐、延迟和 Redis 往返')
+    parser.add_argument('--users', type=int, default=20, help='并发虚拟用户数')
+    parser.add_argument('--messages', type=int, default=5, help='每个用户发送的消息数')
+    parser.add_argument('--duplicate-rate', type=float, default=0.1, help='重推同一事件的比例')
+    parser.add_argument('--think-time', type=float, default=0.0, help='收到回复后到下一条消息的间隔秒数')
+    parser.add_argument('--reply-timeout', type=float, default=60.0, help='等待回复的最长秒数')
+    parser.add_argument('--settle-time', type=float, default=1.0, help='压测结束后等待重推事件处理的秒数')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--stream', action='store_true', help='开启流式卡片回复（STREAM_REPLY_MODE=true）')
+    parser.add_argument('--server', default='waitress', choices=('waitress', 'gunicorn', 'uvicorn'))
+    parser.add_argument('--server-workers', type=int, default=1)
+    parser.add_argument('--bot-env', action='append', default=[], metavar='KEY=VALUE', help='传给机器人进程的额外环境变量，可重复')
+    parser.add_argument('--startup-timeout', type=float, default=60.0)
+    parser.add_argument('--fake-redis', action='store_true', help='使用进程内 fakeredis 代替真实 Redis')
+    parser.add_argument('--redis-host', default='127.0.0.1')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--redis-db', type=int, default=0)
+    parser.add_argument('--first-token-latency', type=float, default=0.3, help='DeepSeek 替身首 token 延迟秒数')
+    parser.add_argument('--tokens-per-second', type=float, default=100.0, help='DeepSeek 替身输出速率')
+    parser.add_argument('--reply-tokens', type=int, default=40)
+    parser.add_argument('--reasoning-tokens', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='DeepSeek 替身注入 429/503 的比例')
+    parser.add_argument('--error-status', type=int, default=429, choices=(429, 503))
+    parser.add_argument('--retry-after', type=float, default=None)
+    parser.add_argument('--output', help='把结果写入 JSON 文件，可作为后续对比的基线')
+    parser.add_argument('--compare', help='与基线 JSON 文件对比')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+    report = asyncio.run(run(args))
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
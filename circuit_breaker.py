@@ -0,0 +1,160 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from metrics import CIRCUIT_REJECTED, CIRCUIT_STATE
+
+logger = logging.getLogger(__name__)
+
+# 熔断器状态，数值用于 Prometheus 指标
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，调用被立即拒绝"""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} 熔断中，{retry_after:.1f} 秒后重新探测")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """按滑动窗口错误率熔断的断路器
+
+    关闭状态下统计最近 window 秒内的调用结果，调用数达到 min_calls 且失败率达到 failure_rate 时打开；
+    打开期间立即拒绝调用，open_seconds 后进入半开状态，放行最多 half_open_calls 个探测调用，
+    探测成功则关闭，失败则重新打开。回调线程与事件循环线程可能同时访问，状态变更加锁。
+    """
+
+    def __init__(self, name, failure_rate=0.5, min_calls=10, window=30, open_seconds=30, half_open_calls=1,
+                 is_failure=None):
+        """
+        Args:
+            name: 依赖名称，用于日志和指标
+            failure_rate: 打开熔断的失败率阈值（0-1）
+            min_calls: 窗口内至少有多少次调用才计算失败率
+            window: 滑动窗口长度（秒），按秒分桶统计
+            open_seconds: 打开后多久进入半开状态（秒）
+            half_open_calls: 半开状态下同时放行的探测调用数
+            is_failure: 判断异常是否计为依赖故障的函数，为 None 时所有异常都计为故障；
+                不计为故障的异常（如参数错误）说明依赖仍在正常响应，按成功统计
+        """
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.is_failure = is_failure or (lambda e: True)
+        self.state = CLOSED
+        # [秒, 成功数, 失败数]
+        self._buckets = deque()
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+        self.rejected = 0
+        CIRCUIT_STATE.labels(name).set(STATE_VALUES[CLOSED])
+
+    def allow(self):
+        """检查是否放行本次调用，熔断中抛出 CircuitOpenError
+
+        放行后必须调用一次 record，半开状态的探测名额在 record 时归还。
+        """
+        with self._lock:
+            if self.state == OPEN:
+                remaining = self._opened_at + self.open_seconds - time.monotonic()
+                if remaining > 0:
+                    self._reject(remaining)
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    self._reject(0.0)
+                self._probes += 1
+
+    def record(self, ok):
+        """记录一次调用结果
+
+        Args:
+            ok: True 为成功，False 为依赖故障，None 为调用被取消等无法判断的情况，只归还探测名额
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+                if ok is True:
+                    self._transition(CLOSED)
+                elif ok is False:
+                    logger.error("%s 探测失败，继续熔断 %s 秒", self.name, self.open_seconds)
+                    self._transition(OPEN)
+                return
+            if ok is None or self.state == OPEN:
+                return
+            now = int(time.monotonic())
+            self._prune(now)
+            if not self._buckets or self._buckets[-1][0] != now:
+                self._buckets.append([now, 0, 0])
+            self._buckets[-1][1 if ok else 2] += 1
+            if not ok:
+                self._check_failure_rate(now)
+
+    def record_exception(self, exc):
+        """按 is_failure 记录异常结束的调用"""
+        self.record(False if self.is_failure(exc) else True)
+
+    async def call(self, func, *args, **kwargs):
+        """在熔断保护下执行协程函数"""
+        self.allow()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            self.record_exception(e)
+            raise
+        except BaseException:
+            self.record(None)
+            raise
+        self.record(True)
+        return result
+
+    def _prune(self, now):
+        """移除滑出窗口的分桶，分桶数不超过 window 个"""
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            self._buckets.popleft()
+
+    def _check_failure_rate(self, now):
+        successes = sum(bucket[1] for bucket in self._buckets)
+        failures = sum(bucket[2] for bucket in self._buckets)
+        total = successes + failures
+        if total >= self.min_calls and failures >= total * self.failure_rate:
+            logger.error("%s 最近 %s 秒失败率 %s/%s，打开熔断 %s 秒", self.name, self.window, failures, total, self.open_seconds)
+            self._transition(OPEN)
+
+    def _transition(self, state):
+        if state == self.state:
+            return
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        elif state == CLOSED:
+            logger.info("%s 探测成功，关闭熔断", self.name)
+        self._buckets.clear()
+        self._probes = 0
+        self.state = state
+        CIRCUIT_STATE.labels(self.name).set(STATE_VALUES[state])
+
+    def _reject(self, retry_after):
+        self.rejected += 1
+        CIRCUIT_REJECTED.labels(self.name).inc()
+        raise CircuitOpenError(self.name, retry_after)
+
+    def stats(self):
+        with self._lock:
+            self._prune(int(time.monotonic()))
+            return {
+                'state': self.state,
+                'calls': sum(bucket[1] + bucket[2] for bucket in self._buckets),
+                'failures': sum(bucket[2] for bucket in self._buckets),
+                'rejected': self.rejected
+            }
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 每条消息在 role 等结构上的额外开销（估算值）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 固定的系统提示词，作为每次请求的第一条消息，是 DeepSeek 前缀缓存命中的基础；修改内容时同步递增版本号
+SYSTEM_PROMPT_VERSION = 'v1'
+SYSTEM_PROMPT = (
+    "你是部署在飞书中的智能助手。请用简洁、准确的中文回答用户的问题，"
+    "需要时使用 Markdown 格式；不确定的内容如实说明，不要编造。"
+)
+
+
+def estimate_tokens(text):
+    """离线快速估算文本 token 数
+
+    按 DeepSeek 官方的换算比例：1 个英文字符约 0.3 token，1 个中文字符约 0.6 token。
+    只做一次 UTF-8 编码，通过字节数与字符数之差推算多字节字符数量，无需逐字符遍历。
+    """
+    if not text:
+        return 0
+    chars = len(text)
+    # 中文等字符在 UTF-8 中占 3 字节，每个贡献 2 个额外字节
+    wide = (len(text.encode('utf-8')) - chars) // 2
+    return int((chars - wide) * 0.3 + wide * 0.6) + 1
+
+
+def estimate_message_tokens(message):
+    return estimate_tokens(message.get('content') or '') + MESSAGE_OVERHEAD_TOKENS
+
+
+class ContextBuilder:
+    """按 token 预算组装发送给 DeepSeek 的对话上下文，尽量保持请求前缀不变以命中 DeepSeek 上下文缓存
+
+    消息顺序固定为：系统提示词、滚动摘要、只追加的对话历史、当前消息。历史未超出预算时原样全部发送，
+    相邻两次请求的前缀完全一致；接近 token 预算或对话存储的条数上限时才压缩一次，
+    一次性移除较早的大段消息，只保留预算的 compact_ratio，而不是每轮从头部滑掉一两条。
+    被移除的消息在后台由 deepseek-chat 与已有摘要合并成新的滚动摘要，未配置摘要时直接丢弃。
+    压缩提前一轮在后台进行，本轮仍发送完整历史，新摘要与压缩后的历史在下一轮同时生效，前缀只变化一次。
+    """
+
+    # 历史达到预算的该比例时提前在后台压缩
+    PREPARE_RATIO = 0.8
+
+    SUMMARY_PROMPT = (
+        "请把下面的对话内容与已有摘要合并，生成一份新的对话摘要，"
+        "保留用户的身份、偏好、关键事实、结论和未解决的问题，不超过{max_chars}字，只输出摘要本身。\n\n"
+        "已有摘要：\n{summary}\n\n"
+        "需要合并的对话：\n{conversation}"
+    )
+
+    # 送去生成摘要时单条消息最多保留的字符数，避免超长粘贴内容拖慢摘要生成
+    SUMMARY_TURN_MAX_CHARS = 2000
+
+    def __init__(self, conversation_store, summarizer=None, token_budget=6000, summary_max_chars=1500,
+                 system_prompt=SYSTEM_PROMPT, compact_ratio=0.5):
+        """
+        Args:
+            conversation_store: 对话历史存储，用于保存摘要并移除已折叠的消息
+            summarizer: 生成摘要的协程函数，接收提示词返回文本；为 None 时压缩时直接丢弃较早的消息
+            token_budget: 提示词（系统提示词 + 摘要 + 历史 + 当前消息）的 token 预算
+            summary_max_chars: 摘要最大字符数
+            system_prompt: 固定的系统提示词，为空时不发送
+            compact_ratio: 压缩后保留的历史占预算（及条数上限）的比例，越小压缩越少发生
+        """
+        self.conversation_store = conversation_store
+        self.summarizer = summarizer
+        self.token_budget = token_budget
+        self.summary_max_chars = summary_max_chars
+        self.system_message = {"role": "system", "content": system_prompt} if system_prompt else None
+        self.compact_ratio = compact_ratio
+        # 用户 -> 正在生成摘要的任务，避免同一用户重复发起摘要任务，清除上下文时据此取消
+        self._folding = {}
+
+    async def build(self, user_open_id, context, summary, user_msg):
+        """按预算组装上下文
+
+        Args:
+            user_open_id: 用户 ID
+            context: 对话历史，按时间顺序排列
+            summary: 较早消息的摘要，可为 None
+            user_msg: 当前用户消息
+
+        Returns:
+            (发送给模型的上下文列表, 本次裁剪掉的 token 数)
+        """
+        messages = [self.system_message] if self.system_message else []
+        if summary:
+            messages.append({"role": "system", "content": f"以下是与该用户此前对话的摘要：\n{summary}"})
+        budget = (self.token_budget - estimate_tokens(user_msg) - MESSAGE_OVERHEAD_TOKENS
+                  - sum(estimate_message_tokens(message) for message in messages))
+        # 每轮回复后追加一问一答两条消息，超出条数上限时对话存储会从头部逐条滑掉，需在此之前压缩
+        max_turns = self.conversation_store.max_turns
+        history_tokens = sum(estimate_message_tokens(turn) for turn in context)
+        if history_tokens <= budget * self.PREPARE_RATIO and len(context) + 4 <= max_turns:
+            messages.extend(context)
+            return messages, 0
+
+        # 压缩后的历史再追加两轮仍不应触发下一次压缩
+        turn_target = max(2, min(int(max_turns * self.compact_ratio), max_turns - 6))
+        kept = self._compact(context, budget * self.compact_ratio, turn_target)
+        folded = context[:len(context) - len(kept)]
+        if folded and user_open_id:
+            self._schedule_fold(user_open_id, summary, folded)
+        if history_tokens <= budget and len(context) + 2 <= max_turns:
+            # 尚未超出上限：本轮发送完整历史，压缩在后台完成后下一轮生效
+            messages.extend(context)
+            return messages, 0
+
+        trimmed_tokens = sum(estimate_message_tokens(turn) for turn in folded)
+        logger.info("上下文超出预算 %s tokens 或 %s 条，本轮裁剪 %s 条消息，约 %s tokens，用户: %s",
+                    self.token_budget, max_turns, len(folded), trimmed_tokens, user_open_id)
+        messages.extend(kept)
+        return messages, trimmed_tokens
+
+    @staticmethod
+    def _compact(context, token_target, turn_target):
+        """从最新的消息向前保留，直到达到压缩目标"""
+        kept = []
+        used = 0
+        for turn in reversed(context):
+            tokens = estimate_message_tokens(turn)
+            if used + tokens > token_target or len(kept) >= turn_target:
+                break
+            kept.append(turn)
+            used += tokens
+        kept.reverse()
+        # 保证历史以用户消息开头，避免出现孤立的机器人回复
+        while kept and kept[0].get('role') != 'user':
+            kept.pop(0)
+        return kept
+
+    def cancel(self, user_open_id):
+        """取消用户进行中的摘要任务，清除上下文前调用，避免旧摘要在清除后写回"""
+        task = self._folding.pop(user_open_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+            logger.info("已取消进行中的对话摘要，用户: %s", user_open_id)
+
+    def _schedule_fold(self, user_open_id, summary, folded):
+        if user_open_id in self._folding:
+            return
+        # 持有任务引用，防止后台任务被提前回收
+        task = asyncio.get_running_loop().create_task(self._fold(user_open_id, summary, folded))
+        self._folding[user_open_id] = task
+
+    async def _fold(self, user_open_id, summary, folded):
+        """把被裁剪的消息与已有摘要合并为新摘要，并从历史中移除这些消息"""
+        try:
+            if not self.summarizer:
+                # 不生成摘要时只移除消息，保留原摘要
+                removed = await self.conversation_store.compact(user_open_id, None, folded)
+                logger.info("已从对话历史中移除 %s/%s 条较早的消息，用户: %s", removed, len(folded), user_open_id)
+                return
+            lines = []
+            for turn in folded:
+                speaker = '用户' if turn.get('role') == 'user' else '助手'
+                lines.append(f"{speaker}: {(turn.get('content') or '')[:self.SUMMARY_TURN_MAX_CHARS]}")
+            prompt = self.SUMMARY_PROMPT.format(
+                max_chars=self.summary_max_chars,
+                summary=summary or '无',
+                conversation='\n'.join(lines)
+            )
+            new_summary = (await self.summarizer(prompt) or '').strip()[:self.summary_max_chars]
+            if not new_summary:
+                logger.warning("生成对话摘要为空，跳过折叠，用户: %s", user_open_id)
+                return
+            # 对话存储只移除仍在历史头部的消息，历史在此期间被清除时不会写回旧摘要
+            removed = await self.conversation_store.compact(user_open_id, new_summary, folded, base_summary=summary)
+            logger.info("已折叠 %s 条消息到对话摘要，从历史中移除 %s 条，约 %s tokens，用户: %s",
+                        len(folded), removed, sum(estimate_message_tokens(turn) for turn in folded), user_open_id)
+        except Exception as e:
+            logger.error("生成对话摘要失败，用户: %s, 错误: %s", user_open_id, e)
+        finally:
+            # 被 cancel 移除后可能已有新的摘要任务登记，只移除自己
+            if self._folding.get(user_open_id) is asyncio.current_task():
+                del self._folding[user_open_id]
@@ -0,0 +1,288 @@
+import json
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# 折叠较早的消息：只移除历史头部仍与被折叠消息一致的部分，历史被清除后不再写回旧摘要。
+# 生成摘要期间历史可能因条数上限从头部滑掉若干条，此时按剩余的重叠部分移除，避免多删新消息。
+# KEYS: 历史列表、摘要；ARGV: 新摘要（空串表示保留原摘要）、折叠所基于的原摘要（空串表示没有）、摘要 TTL、被折叠的消息
+COMPACT_SCRIPT = """
+local n = #ARGV - 3
+local head = redis.call('LRANGE', KEYS[1], 0, n - 1)
+local removed = 0
+for shift = 0, n - 1 do
+    local m = n - shift
+    if #head >= m then
+        local match = true
+        for i = 1, m do
+            if head[i] ~= ARGV[3 + shift + i] then
+                match = false
+                break
+            end
+        end
+        if match then
+            removed = m
+            break
+        end
+    end
+end
+if removed > 0 then
+    redis.call('LTRIM', KEYS[1], removed, -1)
+end
+if ARGV[1] ~= '' then
+    local current = redis.call('GET', KEYS[2]) or ''
+    if removed > 0 or (ARGV[2] ~= '' and current == ARGV[2]) then
+        redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[3])
+    end
+end
+return removed
+"""
+
+
+# 迁移旧版 context:{open_id} 字符串键中的历史：旧键仍存在时删除并把其中的消息插入历史头部，多个进程同时迁移时只生效一次。
+# KEYS: 旧版上下文键、历史列表；ARGV: 最多保留的消息条数、TTL、按追加时相同方式序列化的旧版消息
+MIGRATE_SCRIPT = """
+if redis.call('DEL', KEYS[1]) == 0 then
+    return 0
+end
+for i = #ARGV, 3, -1 do
+    redis.call('LPUSH', KEYS[2], ARGV[i])
+end
+if #ARGV > 2 then
+    redis.call('LTRIM', KEYS[2], -tonumber(ARGV[1]), -1)
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+end
+return 1
+"""
+
+
+def head_overlap(head, folded):
+    """历史头部与被折叠消息的重叠条数：历史从头部滑掉 shift 条后，头部应等于 folded[shift:]"""
+    for shift in range(len(folded)):
+        remaining = folded[shift:]
+        if head[:len(remaining)] == remaining:
+            return len(remaining)
+    return 0
+
+
+class ConversationStore:
+    """对话历史存储接口，按用户保存 user/assistant 双方的消息
+
+    每条消息为 {'role': 角色, 'content': 内容}，追加为 O(1)，读取最多返回 max_turns 条。
+    较早的消息可以折叠为一段滚动摘要，与对话历史一起保存。
+    支持 pipeline 的实现可以把读写命令合并进调用方的 Redis pipeline，减少网络往返。
+    """
+
+    def __init__(self, max_turns=20, ttl=86400):
+        """
+        Args:
+            max_turns: 每个用户最多保留的消息条数
+            ttl: 对话历史在最后一次写入后的保留秒数
+        """
+        self.max_turns = max_turns
+        self.ttl = ttl
+
+    async def load(self, user_open_id):
+        """读取用户最近的对话历史"""
+        raise NotImplementedError
+
+    async def append(self, user_open_id, turns):
+        """追加若干条消息"""
+        raise NotImplementedError
+
+    async def clear(self, user_open_id):
+        """清除用户的对话历史及摘要"""
+        raise NotImplementedError
+
+    async def load_summary(self, user_open_id):
+        """读取较早消息的滚动摘要，没有时返回 None"""
+        raise NotImplementedError
+
+    async def compact(self, user_open_id, summary, folded, base_summary=None):
+        """保存新的滚动摘要，并从历史头部移除已折叠进摘要的消息
+
+        历史在生成摘要期间被清除时不做任何修改；因条数上限滑掉了部分消息时只移除仍在历史中的部分。
+
+        Args:
+            summary: 新摘要，为 None 时保留原摘要
+            folded: 被折叠的消息，即生成摘要时历史头部的若干条
+            base_summary: 生成新摘要时所基于的原摘要
+
+        Returns:
+            实际移除的消息条数
+        """
+        raise NotImplementedError
+
+    def queue_load(self, pipe, user_open_id):
+        """把读取历史和摘要的命令加入 Redis pipeline，返回加入的命令数，不支持时返回 0，由调用方改用 load()"""
+        return 0
+
+    async def decode_load(self, user_open_id, results):
+        """解析 queue_load 对应的 pipeline 结果，返回 (对话历史, 摘要)"""
+        raise NotImplementedError
+
+    def queue_append(self, pipe, user_open_id, turns):
+        """把追加命令加入 Redis pipeline，不支持时返回 False，由调用方改用 append()"""
+        return False
+
+
+class RedisConversationStore(ConversationStore):
+    """基于 Redis 列表的对话历史，每个用户一个列表，RPUSH + LTRIM + EXPIRE 在同一 pipeline 中完成
+
+    旧版本把只含用户消息的历史以 JSON 字符串保存在 context:{open_id}，读取历史时一并检查，
+    存在时迁移到列表并删除，迁移只在旧键存在时多一次往返。
+    """
+
+    def __init__(self, redis_store, max_turns=20, ttl=86400, key_prefix='conversation', legacy_key_prefix='context'):
+        """
+        Args:
+            redis_store: AsyncRedisStore 实例，提供与事件循环绑定的客户端
+            key_prefix: 列表键前缀，完整键为 {key_prefix}:{user_open_id}
+            legacy_key_prefix: 旧版历史的字符串键前缀，为 None 时不迁移
+        """
+        super().__init__(max_turns=max_turns, ttl=ttl)
+        self.redis_store = redis_store
+        self.key_prefix = key_prefix
+        self.legacy_key_prefix = legacy_key_prefix
+
+    def key(self, user_open_id):
+        return f"{self.key_prefix}:{user_open_id}"
+
+    def legacy_key(self, user_open_id):
+        return f"{self.legacy_key_prefix}:{user_open_id}"
+
+    def summary_key(self, user_open_id):
+        return f"{self.key_prefix}_summary:{user_open_id}"
+
+    def queue_load(self, pipe, user_open_id):
+        pipe.lrange(self.key(user_open_id), -self.max_turns, -1)
+        pipe.get(self.summary_key(user_open_id))
+        if self.legacy_key_prefix is None:
+            return 2
+        pipe.get(self.legacy_key(user_open_id))
+        return 3
+
+    async def decode_load(self, user_open_id, results):
+        turns, summary = self._decode_turns(results[0]), results[1] or None
+        if len(results) > 2 and results[2] is not None:
+            turns = await self._migrate_legacy(user_open_id, results[2], turns)
+        return turns, summary
+
+    async def _migrate_legacy(self, user_open_id, raw, turns):
+        """把旧版历史插入列表头部并删除旧键，返回合并后的历史"""
+        try:
+            legacy = [turn for turn in json.loads(raw) if isinstance(turn, dict) and 'role' in turn and 'content' in turn]
+        except (TypeError, ValueError):
+            legacy = []
+        # 与追加时相同的序列化方式，折叠时才能与列表中的元素逐字节比较
+        migrated = await self.redis_store.client.eval(
+            MIGRATE_SCRIPT, 2, self.legacy_key(user_open_id), self.key(user_open_id), self.max_turns, self.ttl,
+            *[json.dumps(turn, ensure_ascii=False) for turn in legacy]
+        )
+        if migrated:
+            logger.info("已迁移用户 %s 的旧版对话历史 %s 条", user_open_id, len(legacy))
+        return (legacy + turns)[-self.max_turns:]
+
+    def _decode_turns(self, raw):
+        turns = []
+        for item in raw or []:
+            try:
+                turns.append(json.loads(item))
+            except (TypeError, json.JSONDecodeError):
+                # 对话内容不写入日志，只记录类型和长度
+                logger.error("解析对话历史失败，已跳过 %s 类型、长度 %s 的记录", type(item).__name__, len(str(item)))
+        return turns
+
+    def queue_append(self, pipe, user_open_id, turns):
+        if not turns:
+            return True
+        key = self.key(user_open_id)
+        pipe.rpush(key, *[json.dumps(turn, ensure_ascii=False) for turn in turns])
+        pipe.ltrim(key, -self.max_turns, -1)
+        pipe.expire(key, self.ttl)
+        # 摘要与历史同步续期
+        pipe.expire(self.summary_key(user_open_id), self.ttl)
+        return True
+
+    async def load(self, user_open_id):
+        pipe = self.redis_store.client.pipeline(transaction=False)
+        self.queue_load(pipe, user_open_id)
+        turns, _ = await self.decode_load(user_open_id, await pipe.execute())
+        return turns
+
+    async def load_summary(self, user_open_id):
+        return await self.redis_store.client.get(self.summary_key(user_open_id)) or None
+
+    async def compact(self, user_open_id, summary, folded, base_summary=None):
+        if not folded:
+            return 0
+        # 与追加时相同的序列化方式，保证能与列表中的元素逐字节比较
+        return int(await self.redis_store.client.eval(
+            COMPACT_SCRIPT, 2, self.key(user_open_id), self.summary_key(user_open_id),
+            summary or '', base_summary or '', self.ttl,
+            *[json.dumps(turn, ensure_ascii=False) for turn in folded]
+        ))
+
+    async def append(self, user_open_id, turns):
+        pipe = self.redis_store.client.pipeline(transaction=False)
+        self.queue_append(pipe, user_open_id, turns)
+        await pipe.execute()
+
+    async def clear(self, user_open_id):
+        keys = [self.key(user_open_id), self.summary_key(user_open_id)]
+        if self.legacy_key_prefix is not None:
+            keys.append(self.legacy_key(user_open_id))
+        await self.redis_store.client.delete(*keys)
+
+
+class MemoryConversationStore(ConversationStore):
+    """进程内对话历史，用于开发和测试环境，多进程部署时各进程互不共享"""
+
+    def __init__(self, max_turns=20, ttl=86400):
+        super().__init__(max_turns=max_turns, ttl=ttl)
+        # user_open_id -> (最后写入时间, deque)
+        self._conversations = {}
+        # user_open_id -> 滚动摘要
+        self._summaries = {}
+
+    def _get(self, user_open_id):
+        entry = self._conversations.get(user_open_id)
+        if entry is None:
+            return None
+        updated_at, turns = entry
+        if time.monotonic() - updated_at > self.ttl:
+            del self._conversations[user_open_id]
+            self._summaries.pop(user_open_id, None)
+            return None
+        return turns
+
+    async def load(self, user_open_id):
+        turns = self._get(user_open_id)
+        return [dict(turn) for turn in turns] if turns else []
+
+    async def append(self, user_open_id, turns):
+        if not turns:
+            return
+        existing = self._get(user_open_id)
+        if existing is None:
+            existing = deque(maxlen=self.max_turns)
+        existing.extend(dict(turn) for turn in turns)
+        self._conversations[user_open_id] = (time.monotonic(), existing)
+
+    async def clear(self, user_open_id):
+        self._conversations.pop(user_open_id, None)
+        self._summaries.pop(user_open_id, None)
+
+    async def load_summary(self, user_open_id):
+        return self._summaries.get(user_open_id)
+
+    async def compact(self, user_open_id, summary, folded, base_summary=None):
+        turns = self._get(user_open_id)
+        removed = head_overlap(list(turns)[:len(folded)], list(folded)) if turns else 0
+        for _ in range(removed):
+            turns.popleft()
+        if summary and (removed or (base_summary and self._summaries.get(user_open_id) == base_summary)):
+            self._summaries[user_open_id] = summary
+        return removed
@@ -1,11 +1,75 @@
+import asyncio
 import aiohttp
 import json
 import logging
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+from context_builder import estimate_message_tokens, estimate_tokens
+from hedging import hedge
+from inflight import tracking
+from metrics import (DEEPSEEK_HTTP_STATUS, DEEPSEEK_LATENCY_SECONDS, DEEPSEEK_TTFT_SECONDS, USAGE_FIELDS, record_prompt_cache,
+                     record_usage)
+from singleflight import SingleFlight
+from sse_parser import CONTENT, REASONING, USAGE, ChatStreamDecoder
 
 logger = logging.getLogger(__name__)
 
+CHAT_MODEL = 'deepseek-chat'
+REASONER_MODEL = 'deepseek-reasoner'
+# 日志中的模型简称
+MODEL_LABELS = {CHAT_MODEL: 'V3模型', REASONER_MODEL: 'R1模型'}
+
+
+class DeepSeekAPIError(Exception):
+    """DeepSeek API 返回非 200 状态码"""
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def is_deepseek_failure(exc):
+    """判断异常是否说明 DeepSeek 服务故障，供熔断器统计
+
+    连接错误、读取超时和 5xx 计为故障；4xx（含 429 限流）说明服务仍在正常响应，不计为故障。
+    """
+    if isinstance(exc, DeepSeekAPIError):
+        return exc.status is None or exc.status >= 500
+    return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
 class DeepSeekClient:
-    def __init__(self, api_key, api_url):
+    def __init__(self, api_key, api_url, pool_limit=100, pool_limit_per_host=30, dns_cache_ttl=300,
+                 keepalive_timeout=60, connect_timeout=10, read_timeout=300, verify_ssl=True,
+                 singleflight=None, balance_cache_ttl=30, balance_stale_ttl=300,
+                 rate_limiter=None, completion_token_estimate=1000, payload_logger=None,
+                 circuit_breaker=None, hedge_tracker=None, non_stream_hedge_tracker=None):
+        """
+        Args:
+            api_key: DeepSeek API 密钥
+            api_url: 对话补全接口地址
+            pool_limit: 连接池最大连接数
+            pool_limit_per_host: 单个主机最大连接数
+            dns_cache_ttl: DNS 解析缓存时间（秒）
+            keepalive_timeout: 空闲连接保活时间（秒）
+            connect_timeout: 建立连接超时（秒）
+            read_timeout: 两次读取之间的最长等待（秒），推理模型首包较慢，不宜过小
+            verify_ssl: 是否校验服务端证书
+            singleflight: SingleFlight 实例，合并并发的相同非流式请求和余额查询，为 None 时不合并
+            balance_cache_ttl: 余额缓存新鲜期（秒），期内直接返回缓存
+            balance_stale_ttl: 余额缓存最长可用期（秒），过了新鲜期但未超过该值时先返回旧值并在后台刷新
+            rate_limiter: RateLimiter 实例，负责 RPM/TPM 排队、并发控制和 429/5xx 重试，为 None 时不限流不重试
+            completion_token_estimate: 估算 TPM 时为每次请求预留的回复 token 数
+            payload_logger: PayloadLogger 实例，采样记录脱敏后的请求和响应载荷，为 None 时不记录
+            circuit_breaker: CircuitBreaker 实例，DeepSeek 持续故障时立即拒绝请求，为 None 时不熔断
+            hedge_tracker: LatencyTracker 实例，deepseek-chat 流式请求超过其给出的首包分位耗时仍未返回时
+                再发出一个相同请求，取先返回的结果；为 None 时不对冲
+            non_stream_hedge_tracker: 非流式请求使用的 LatencyTracker，按完整回复耗时统计，
+                与流式首包耗时分开记录；为 None 时非流式请求不对冲
+        """
         self.api_key = api_key
         self.api_url = api_url
         self.headers = {
@@ -14,9 +78,84 @@ class DeepSeekClient:
         }
         # // 添加余额查询API地址
         self.balance_api_url = "https://api.deepseek.com/user/balance"
+        self.pool_limit = pool_limit
+        self.pool_limit_per_host = pool_limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.verify_ssl = verify_ssl
+        # 长连接会话与所属事件循环，首次请求时懒创建
+        self._session = None
+        self._session_loop = None
+        self.singleflight = singleflight
+        self.balance_cache_ttl = balance_cache_ttl
+        self.balance_stale_ttl = balance_stale_ttl
+        # (获取时间, 余额结果)
+        self._balance_cache = None
+        self._balance_refresh_task = None
+        self.rate_limiter = rate_limiter
+        self.payload_logger = payload_logger
+        self.completion_token_estimate = completion_token_estimate
+        self.circuit_breaker = circuit_breaker
+        self.hedge_tracker = hedge_tracker
+        self.non_stream_hedge_tracker = non_stream_hedge_tracker
+
+    async def _get_session(self):
+        """获取当前事件循环上的共享会话，必要时重新创建"""
+        loop = asyncio.get_running_loop()
+        if self._session is not None and not self._session.closed and self._session_loop is loop:
+            return self._session
+        if self._session is not None and not self._session.closed:
+            # 会话绑定在其他事件循环上，无法在当前循环复用
+            logger.warning("DeepSeek 会话所属事件循环已变化，重新创建连接池")
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_limit,
+            limit_per_host=self.pool_limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout,
+            ssl=self.verify_ssl
+        )
+        timeout = aiohttp.ClientTimeout(total=None, connect=self.connect_timeout, sock_read=self.read_timeout)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self._session_loop = loop
+        logger.info("已创建 DeepSeek 连接池，最大连接数: %s, 单主机: %s", self.pool_limit, self.pool_limit_per_host)
+        return self._session
+
+    async def start(self):
+        """预先创建连接池，供应用启动时调用"""
+        await self._get_session()
+
+    async def warm_up(self):
+        """预先建立到 DeepSeek 的连接
+
+        向 API 所在主机发一个 HEAD 请求，完成 DNS 解析和 TCP/TLS 握手，连接留在连接池中供首条消息复用；
+        只关心连接能否建立，不检查状态码。
+        """
+        session = await self._get_session()
+        parts = urlsplit(self.api_url)
+        async with session.head(f"{parts.scheme}://{parts.netloc}/", allow_redirects=False) as response:
+            await response.read()
+        logger.info("已预先建立到 %s 的连接", parts.netloc)
+
+    async def close(self):
+        """关闭连接池，供应用关闭时调用"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("DeepSeek 连接池已关闭")
+        self._session = None
+        self._session_loop = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
 
     def _handle_http_error(self, status_code, response_text):
         """处理HTTP错误状态码"""
+        DEEPSEEK_HTTP_STATUS.labels(str(status_code)).inc()
         error_info = {
             400: ("格式错误", "请求体格式错误", "请根据错误信息提示修改请求体"),
             401: ("认证失败", "API key 错误，认证失败", "请检查您的 API key 是否正确，如没有 API key，请先 创建 API key"),
@@ -36,149 +175,290 @@ class DeepSeekClient:
         logger.error(error_msg)
         return error_msg
 
-    async def chat(self, user_msg, temperature=1.0):
-        payload = {
-            "model": "deepseek-chat",
-            "messages": [{
-                "role": "user",
-                "content": user_msg
-            }],
-            "temperature": temperature  # 添加温度参数
-        }
-        connector = aiohttp.TCPConnector(verify_ssl=False)
-        logger.info(f"发送请求到 DeepSeek API，URL: {self.api_url}, Payload: {payload}")
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.post(self.api_url, headers=self.headers, data=json.dumps(payload)) as response:
-                logger.info(f"收到 DeepSeek API 响应，状态码: {response.status}")
-                if response.status == 200:
-                    result = await response.json()
-                    logger.info(f"DeepSeek API 响应内容: {result}")
-                    return result['choices'][0]['message']['content']
-                else:
-                    response_text = await response.text()
-                    error_msg = self._handle_http_error(response.status, response_text)
-                    raise Exception(error_msg)
-                     
-    def reason(self, user_msg, stream=False, context=None, temperature=1.0):
+    async def _coalesce(self, key, coro_func):
+        """通过 singleflight 合并相同请求，未配置时直接执行"""
+        if self.singleflight is None:
+            return await coro_func()
+        return await self.singleflight.do(key, coro_func)
+
+    def _estimate_request_tokens(self, payload):
+        prompt_tokens = sum(estimate_tokens(message.get('content') or '') for message in payload.get('messages', []))
+        return prompt_tokens + self.completion_token_estimate
+
+    @asynccontextmanager
+    async def _completion_response(self, payload, label):
+        """发送补全请求，返回状态码为 200 的响应
+
+        配置了限流器时先排队获取发送许可，遇到 429/5xx 按退避策略重试；
+        流式响应在整个读取期间占用并发名额。配置了熔断器时每次尝试前检查熔断状态，
+        熔断中立即抛出 CircuitOpenError，不再排队或重试；流式读取中断同样计为一次故障。
+        """
+        attempt = 0
+        estimated_tokens = self._estimate_request_tokens(payload) if self.rate_limiter else 0
+        breaker = self.circuit_breaker
+        while True:
+            if breaker:
+                breaker.allow()
+            # None 表示被取消等无法判断服务状态的结束方式
+            outcome = None
+            try:
+                async with self._rate_limit_slot(estimated_tokens):
+                    session = await self._get_session()
+                    logger.info("发送请求到 DeepSeek API%s，模型: %s, 消息数: %s", label, payload['model'], len(payload['messages']))
+                    if self.payload_logger:
+                        self.payload_logger.log(logger, "DeepSeek API%s 请求载荷", payload, label)
+                    # 响应登记到当前生成，生成被取消时直接关闭连接
+                    async with session.post(self.api_url, headers=self.headers, data=json.dumps(payload)) as response, \
+                            tracking(response):
+                        logger.info("收到 DeepSeek API%s 响应，状态码: %s", label, response.status)
+                        if response.status == 200:
+                            DEEPSEEK_HTTP_STATUS.labels('200').inc()
+                            if self.rate_limiter:
+                                self.rate_limiter.record_success()
+                            yield response
+                            outcome = True
+                            return
+                        response_text = await response.text()
+                        error = DeepSeekAPIError(
+                            self._handle_http_error(response.status, response_text),
+                            status=response.status,
+                            retry_after=response.headers.get('Retry-After')
+                        )
+                outcome = not is_deepseek_failure(error)
+            except Exception as e:
+                outcome = not is_deepseek_failure(e)
+                raise
+            finally:
+                if breaker:
+                    breaker.record(outcome)
+            if not self.rate_limiter:
+                raise error
+            self.rate_limiter.record_failure(error.status)
+            if not self.rate_limiter.should_retry(error.status, attempt):
+                raise error
+            delay = self.rate_limiter.retry_delay(attempt, error.retry_after)
+            attempt += 1
+            logger.warning("DeepSeek API%s 返回 %s，%.1f 秒后第 %s 次重试", label, error.status, delay, attempt)
+            await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def _rate_limit_slot(self, estimated_tokens):
+        if self.rate_limiter is None:
+            yield
+        else:
+            async with self.rate_limiter.slot(estimated_tokens):
+                yield
+
+    async def _request_completion(self, payload, label, usage=None):
+        """发送非流式补全请求并返回回复内容，usage 不为 None 时写入响应中的 usage 字段"""
+        model = payload['model']
+        start = time.perf_counter()
+        try:
+            async with self._completion_response(payload, label) as response:
+                result = await response.json()
+        finally:
+            elapsed = time.perf_counter() - start
+            DEEPSEEK_LATENCY_SECONDS.labels(model, 'false').observe(elapsed)
+        if self.payload_logger:
+            self.payload_logger.log(logger, "DeepSeek API%s 响应内容", result, label)
+        record_usage(model, result.get('usage'))
+        # 非流式请求的首 token 即完整回复
+        self._record_prompt_cache(model, 'false', result.get('usage'), elapsed, label)
+        if usage is not None and result.get('usage'):
+            usage.update(result['usage'])
+        return result['choices'][0]['message']['content']
+
+    def chat(self, user_msg, temperature=1.0, context=None, stream=False, usage=None, hedge=True):
+        """使用 deepseek-chat 模型回复，响应快，适合简单对话和摘要
+
+        参数与返回值同 complete
+        """
+        return self.complete(user_msg, model=CHAT_MODEL, stream=stream, context=context, temperature=temperature, usage=usage,
+                             hedge=hedge)
+
+    def reason(self, user_msg, stream=False, context=None, temperature=1.0, usage=None):
         """使用 DeepSeek-R1-0528 模型进行推理的入口方法
-        
+
+        参数与返回值同 complete
+        """
+        return self.complete(user_msg, model=REASONER_MODEL, stream=stream, context=context, temperature=temperature, usage=usage)
+
+    def complete(self, user_msg, model=REASONER_MODEL, stream=False, context=None, temperature=1.0, usage=None, hedge=True):
+        """对话补全入口方法
+
         Args:
             user_msg: 用户当前消息
+            model: 模型名称，deepseek-chat 或 deepseek-reasoner
             stream: 是否使用流式回复
             context: 对话上下文，格式为包含{'role':角色, 'content':内容}的列表
                      角色可以是'user'或'assistant'
             temperature: 控制生成文本的随机性，范围通常为0.0-2.0，默认1.0
-        
+            usage: 可选字典，请求完成后写入响应中的 usage 字段（prompt_tokens、completion_tokens 等）；
+                   并发的相同非流式请求合并时只有实际发出请求的调用方能拿到
+            hedge: 是否允许对冲请求，摘要等后台请求不在意延迟，应传 False 避免额外开销
+
         Returns:
             如果stream=True，返回异步生成器；如果stream=False，返回协程对象
         """
+        hedge = hedge and model == CHAT_MODEL
         if stream:
-            return self.stream_reason(user_msg, context, temperature)
+            if hedge and self.hedge_tracker is not None:
+                return self._hedged_stream_completion(model, user_msg, context, temperature, usage)
+            return self._stream_completion(model, user_msg, context, temperature, usage)
         else:
-            return self.non_stream_reason(user_msg, context, temperature)
-            
+            return self._non_stream_completion(model, user_msg, context, temperature, usage, hedge=hedge)
+
     async def stream_reason(self, user_msg, context=None, temperature=1.0):
         """流式推理（异步生成器）"""
-        async for chunk in self._reason_stream(user_msg, context, temperature):
+        async for chunk in self._stream_completion(REASONER_MODEL, user_msg, context, temperature):
             yield chunk
-              
+
     async def non_stream_reason(self, user_msg, context=None, temperature=1.0):
         """非流式推理"""
-        return await self._reason_non_stream(user_msg, context, temperature)
-            
-    async def _reason_stream(self, user_msg, context=None, temperature=1.0):
-        """流式推理（异步生成器）"""
-        # 初始化上下文为空列表
-        if context is None:
-            context = []
-            
-        # 构造完整的消息列表（上下文 + 当前消息）
-        messages = context.copy()
-        messages.append({
-            "role": "user",
-            "content": user_msg
-        })
-        
-        payload = {
-            "model": "deepseek-reasoner",  # 指定 R1 模型
-            "messages": messages,
-            "stream": True,  # 支持流式回复
-            "temperature": temperature  # 添加温度参数
-        }
-        connector = aiohttp.TCPConnector(verify_ssl=False)
-        logger.info(f"发送请求到 DeepSeek API (R1模型-流式)，URL: {self.api_url}, Payload: {payload}")
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.post(self.api_url, headers=self.headers, data=json.dumps(payload)) as response:
-                logger.info(f"收到 DeepSeek API (R1模型-流式) 响应，状态码: {response.status}")
-                if response.status == 200:
-                    async for chunk in self._process_stream(response):
-                        yield chunk
-                else:
-                    response_text = await response.text()
-                    error_msg = self._handle_http_error(response.status, response_text)
-                    raise Exception(error_msg)
-            
-
-
-                     
-    async def _reason_non_stream(self, user_msg, context=None, temperature=1.0):
-        """非流式推理"""
-        # 初始化上下文为空列表
-        if context is None:
-            context = []
-            
+        return await self._non_stream_completion(REASONER_MODEL, user_msg, context, temperature)
+
+    @staticmethod
+    def _build_payload(model, user_msg, context, temperature, stream):
         # 构造完整的消息列表（上下文 + 当前消息）
-        messages = context.copy()
+        messages = list(context or [])
         messages.append({
             "role": "user",
             "content": user_msg
         })
-        
-        payload = {
-            "model": "deepseek-reasoner",  # 指定 R1 模型
+        return {
+            "model": model,
             "messages": messages,
-            "stream": False,  # 非流式回复
-            "temperature": temperature  # 添加温度参数
+            "stream": stream,
+            "temperature": temperature
         }
-        connector = aiohttp.TCPConnector(verify_ssl=False)
-        logger.info(f"发送请求到 DeepSeek API (R1模型-非流式)，URL: {self.api_url}, Payload: {payload}")
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.post(self.api_url, headers=self.headers, data=json.dumps(payload)) as response:
-                logger.info(f"收到 DeepSeek API (R1模型-非流式) 响应，状态码: {response.status}")
-                if response.status == 200:
-                    result = await response.json()
-                    logger.info(f"DeepSeek API (R1模型-非流式) 响应内容: {result}")
-                    return result['choices'][0]['message']['content']
-                else:
-                    response_text = await response.text()
-                    error_msg = self._handle_http_error(response.status, response_text)
-                    raise Exception(error_msg)
-                     
-    async def _process_stream(self, response):
-        """处理流式响应"""
-        async for chunk in response.content:
-            if chunk:
-                try:
-                    chunk_str = chunk.decode('utf-8')
-                    # 处理 SSE 格式的响应
-                    if chunk_str.startswith('data: '):
-                        # 去除 'data: ' 前缀
-                        data_str = chunk_str[6:]
-                        if data_str.strip() == '[DONE]':
-                            break
-                        try:
-                            data = json.loads(data_str)
-                            if 'choices' in data and len(data['choices']) > 0:
-                                delta = data['choices'][0].get('delta', {})
-                                if 'content' in delta:
-                                    yield {'content': delta['content']}
-                        except json.JSONDecodeError as e:
-                            logger.error(f"解析流式数据JSON错误: {str(e)}, 原始数据: {data_str}")
-                except Exception as e:
-                    logger.error(f"处理流式数据错误: {str(e)}")
+
+    async def _stream_completion(self, model, user_msg, context=None, temperature=1.0, usage=None):
+        """流式补全（异步生成器）"""
+        payload = self._build_payload(model, user_msg, context, temperature, True)
+        # 限流重试只发生在收到首个数据之前，开始输出后不再重试
+        start = time.perf_counter()
+        ttft = None
+        usage = {} if usage is None else usage
+        received = {}
+        opened = False
+        generated = []
+        label = f" ({MODEL_LABELS.get(model, model)}-流式)"
+        try:
+            async with self._completion_response(payload, label) as response:
+                opened = True
+                async for chunk in self._process_stream(response, received):
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                        DEEPSEEK_TTFT_SECONDS.labels(model, 'true').observe(ttft)
+                    generated.append(chunk.get('content') or chunk.get('reasoning_content') or '')
+                    yield chunk
+        finally:
+            if received:
+                usage.update(received)
+            elif opened:
+                # 生成被取消或中断时收不到 usage，按已发送的提示词和已收到的输出估算实际消耗
+                prompt_tokens = sum(estimate_message_tokens(message) for message in payload['messages'])
+                completion_tokens = estimate_tokens(''.join(generated))
+                usage['prompt_tokens'] = usage.get('prompt_tokens', 0) + prompt_tokens
+                usage['completion_tokens'] = usage.get('completion_tokens', 0) + completion_tokens
+                logger.info("DeepSeek API%s 未返回 usage，按估算记录 prompt %s / completion %s tokens", label, prompt_tokens, completion_tokens)
+            DEEPSEEK_LATENCY_SECONDS.labels(model, 'true').observe(time.perf_counter() - start)
+            record_usage(model, usage)
+            self._record_prompt_cache(model, 'true', usage, ttft, label)
+
+    async def _non_stream_completion(self, model, user_msg, context=None, temperature=1.0, usage=None, hedge=False):
+        """非流式补全"""
+        payload = self._build_payload(model, user_msg, context, temperature, False)
+        label = f" ({MODEL_LABELS.get(model, model)}-非流式)"
+        if hedge and self.non_stream_hedge_tracker is not None:
+            request = self._hedged_request_completion
+        else:
+            request = self._request_completion
+        # 并发的相同请求（相同模型、上下文与提问）只请求一次上游
+        return await self._coalesce('completion:' + SingleFlight.make_key(payload), lambda: request(payload, label, usage))
+
+    async def _hedged_request_completion(self, payload, label, usage=None):
+        """非流式对冲请求：以完整回复的返回时间计"""
+        _, content = await hedge(
+            lambda attempt: self._request_completion(payload, label + ('-对冲' if attempt else ''), usage),
+            self.non_stream_hedge_tracker)
+        return content
+
+    async def _hedged_stream_completion(self, model, user_msg, context=None, temperature=1.0, usage=None):
+        """流式对冲请求（异步生成器）：首个数据块超时未到达时再发出一个相同请求，后续只读取先到达的一路"""
+        streams = []
+        leg_usages = []
+
+        async def first_chunk(attempt):
+            # 每一路单独统计用量，落后的一路被取消时按估算记录，结束后两路累加，对冲消耗的 token 同样计入额度
+            leg_usage = {}
+            leg_usages.append(leg_usage)
+            stream = self._stream_completion(model, user_msg, context, temperature, leg_usage)
+            streams.append(stream)
+            try:
+                return stream, await stream.__anext__()
+            except StopAsyncIteration:
+                return stream, None
+
+        try:
+            _, (stream, chunk) = await hedge(first_chunk, self.hedge_tracker)
+            if chunk is None:
+                return
+            yield chunk
+            async for chunk in stream:
+                yield chunk
+        finally:
+            # 落后的一路已在 hedge 中取消，这里关闭全部生成器，释放对应连接
+            for stream in streams:
+                await stream.aclose()
+            if usage is not None:
+                for leg_usage in leg_usages:
+                    for field, _ in USAGE_FIELDS:
+                        if leg_usage.get(field):
+                            usage[field] = usage.get(field, 0) + leg_usage[field]
+
+    @staticmethod
+    def _record_prompt_cache(model, stream, usage, ttft, label):
+        """记录并输出本次请求 prompt 命中 DeepSeek 上下文缓存的情况"""
+        cached = record_prompt_cache(model, stream, usage, ttft)
+        if cached:
+            hit, total = cached
+            if ttft is None:
+                logger.info("DeepSeek API%s prompt 缓存命中 %s/%s tokens (%.0f%%)", label, hit, total, hit / total * 100)
+            else:
+                logger.info("DeepSeek API%s prompt 缓存命中 %s/%s tokens (%.0f%%)，首 token 耗时 %.2f 秒",
+                            label, hit, total, hit / total * 100, ttft)
+
+    async def _process_stream(self, response, usage=None):
+        """处理流式响应，按完整的 SSE 事件解码，不受 TCP 分包影响
+
+        Args:
+            usage: 可选字典，流结束时写入最后一个数据块中的 usage 字段
+        """
+        decoder = ChatStreamDecoder()
+        async for data in response.content.iter_any():
+            for chunk in self._stream_chunks(decoder.feed(data), usage):
+                yield chunk
+            if decoder.done:
+                return
+        for chunk in self._stream_chunks(decoder.flush(), usage):
+            yield chunk
+
+    @staticmethod
+    def _stream_chunks(deltas, usage):
+        for kind, value in deltas:
+            if kind == REASONING:
+                yield {'reasoning_content': value}
+            elif kind == CONTENT:
+                yield {'content': value}
+            elif kind == USAGE and usage is not None:
+                usage.update(value)
 
     async def get_balance(self):
-        """查询账号余额
+        """查询账号余额，带短期缓存
+
+        缓存新鲜时直接返回；过了新鲜期但仍在可用期内时返回旧值并在后台刷新；
+        否则同步请求上游，并发的查询合并为一次。
 
         Returns:
             dict: 包含余额信息的字典，格式如下：
@@ -187,16 +467,44 @@ class DeepSeekClient:
                     "balance_infos": [ ... ]  // 余额详情列表
                 }
         """
-        connector = aiohttp.TCPConnector(verify_ssl=False)
-        logger.info(f"发送余额查询请求到 DeepSeek API，URL: {self.balance_api_url}")
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.get(self.balance_api_url, headers=self.headers) as response:
-                logger.info(f"收到余额查询响应，状态码: {response.status}")
-                if response.status == 200:
-                    result = await response.json()
-                    logger.info(f"余额查询结果: {result}")
-                    return result
-                else:
-                    response_text = await response.text()
-                    error_msg = self._handle_http_error(response.status, response_text)
-                    raise Exception(error_msg)
\ No newline at end of file
+        if self._balance_cache is not None:
+            fetched_at, result = self._balance_cache
+            age = time.monotonic() - fetched_at
+            if age < self.balance_cache_ttl:
+                return result
+            if age < self.balance_stale_ttl:
+                self._refresh_balance_in_background()
+                return result
+        return await self._refresh_balance()
+
+    def _refresh_balance_in_background(self):
+        if self._balance_refresh_task is not None and not self._balance_refresh_task.done():
+            return
+        self._balance_refresh_task = asyncio.get_running_loop().create_task(self._refresh_balance())
+        self._balance_refresh_task.add_done_callback(self._on_balance_refreshed)
+
+    @staticmethod
+    def _on_balance_refreshed(task):
+        # 后台刷新失败时保留旧值，只记录日志
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("后台刷新余额失败: %s", task.exception())
+
+    async def _refresh_balance(self):
+        result = await self._coalesce('balance', self._request_balance)
+        self._balance_cache = (time.monotonic(), result)
+        return result
+
+    async def _request_balance(self):
+        session = await self._get_session()
+        logger.info("发送余额查询请求到 DeepSeek API，URL: %s", self.balance_api_url)
+        async with session.get(self.balance_api_url, headers=self.headers) as response:
+            logger.info("收到余额查询响应，状态码: %s", response.status)
+            if response.status == 200:
+                DEEPSEEK_HTTP_STATUS.labels('200').inc()
+                result = await response.json()
+                logger.info("余额查询结果: %s", result)
+                return result
+            else:
+                response_text = await response.text()
+                error_msg = self._handle_http_error(response.status, response_text)
+                raise DeepSeekAPIError(error_msg, status=response.status)
\ No newline at end of file
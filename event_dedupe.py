@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+from circuit_breaker import CircuitOpenError
+from metrics import DEDUPE_RESULTS
+
+logger = logging.getLogger(__name__)
+
+# 去重结果
+CLAIMED = 'claimed'
+DUPLICATE = 'duplicate'
+FAILED = 'failed'
+
+
+class EventDeduplicator:
+    """两级事件去重
+
+    进程内带过期时间的 LRU 集合作为第一级，飞书重推风暴在本地即可拦截，不产生网络往返；
+    Redis SET NX 作为多进程共享的第二级，与读取对话历史在同一次往返中完成。
+    只在连接/超时错误时重试，SET NX 返回失败说明确实是重复事件，立即返回。
+    Redis 不可用时按 fail_open 决定继续处理（仅靠本地去重）还是放弃处理；
+    配置了熔断器时，熔断期间不再等待超时和重试，直接按 Redis 不可用处理。
+    """
+
+    def __init__(self, redis_store, conversation_store, event_expire=3600, max_entries=10000, local_ttl=600,
+                 fail_open=True, max_retries=3, retry_interval=0.1, circuit_breaker=None):
+        """
+        Args:
+            redis_store: AsyncRedisStore 实例
+            conversation_store: 对话历史存储，去重时一并预取历史
+            event_expire: Redis 去重键过期秒数
+            max_entries: 进程内最多记录的事件数
+            local_ttl: 进程内记录的过期秒数
+            fail_open: Redis 不可用时是否继续处理事件
+            max_retries: Redis 连接错误时的最大尝试次数
+            retry_interval: 两次尝试之间的等待秒数
+            circuit_breaker: Redis 熔断器，为 None 时不熔断
+        """
+        self.redis_store = redis_store
+        self.conversation_store = conversation_store
+        self.event_expire = event_expire
+        self.max_entries = max_entries
+        self.local_ttl = local_ttl
+        self.fail_open = fail_open
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self.circuit_breaker = circuit_breaker
+        # event_id -> 过期时间；Stream 模式下由多个回调线程访问，需要加锁
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self.local_duplicates = 0
+        self.redis_duplicates = 0
+        self.claimed = 0
+        self.redis_errors = 0
+
+    def check_local(self, event_id):
+        """检查并记录进程内已见过的事件，返回 True 表示重复"""
+        now = time.monotonic()
+        with self._lock:
+            expire_at = self._local.get(event_id)
+            if expire_at is not None and expire_at >= now:
+                self.local_duplicates += 1
+                DEDUPE_RESULTS.labels('local_duplicate').inc()
+                return True
+            self._local[event_id] = now + self.local_ttl
+            self._local.move_to_end(event_id)
+            while len(self._local) > self.max_entries:
+                self._local.popitem(last=False)
+            return False
+
+    def seen(self, event_id):
+        """只查询进程内是否见过该事件，不记录"""
+        with self._lock:
+            expire_at = self._local.get(event_id)
+            return expire_at is not None and expire_at >= time.monotonic()
+
+    def forget(self, event_id):
+        """处理未能完成时移除本地记录，使飞书重推的同一事件可以再次处理"""
+        with self._lock:
+            self._local.pop(event_id, None)
+
+    async def claim(self, event_id, user_open_id):
+        """认领事件并预取对话历史
+
+        Returns:
+            (CLAIMED/DUPLICATE/FAILED, 对话历史列表, 摘要或 None)
+        """
+        if self.check_local(event_id):
+            return DUPLICATE, [], None
+        try:
+            claimed, context, summary = await self._with_retries(
+                self.redis_store.claim_event_and_load_context,
+                event_id, user_open_id, self.event_expire, self.conversation_store)
+        except Exception as e:
+            self.redis_errors += 1
+            if not self.fail_open:
+                DEDUPE_RESULTS.labels('redis_error_closed').inc()
+                logger.error("Redis去重失败，放弃处理事件 %s: %s", event_id, e)
+                self.forget(event_id)
+                return FAILED, [], None
+            DEDUPE_RESULTS.labels('redis_error_open').inc()
+            logger.error("Redis去重失败，仅依赖进程内去重继续处理事件 %s: %s", event_id, e)
+            if isinstance(e, CircuitOpenError) and getattr(self.conversation_store, 'redis_store', None) is self.redis_store:
+                # 对话历史也在熔断中的 Redis 上，不再尝试读取
+                return CLAIMED, [], None
+            context, summary = await self._load_context_fallback(user_open_id)
+            return CLAIMED, context, summary
+        if not claimed:
+            self.redis_duplicates += 1
+            DEDUPE_RESULTS.labels('redis_duplicate').inc()
+            return DUPLICATE, [], None
+        self.claimed += 1
+        DEDUPE_RESULTS.labels('claimed').inc()
+        return CLAIMED, context, summary
+
+    async def load_context(self, user_open_id):
+        """读取对话历史，用于入队时已完成去重的事件；重试后仍失败时抛出异常"""
+        return await self._with_retries(self.redis_store.load_context, user_open_id, self.conversation_store)
+
+    async def _with_retries(self, func, *args):
+        attempt = 0
+        while True:
+            try:
+                if self.circuit_breaker is None:
+                    return await func(*args)
+                # 熔断中抛出 CircuitOpenError，不再重试
+                return await self.circuit_breaker.call(func, *args)
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                attempt += 1
+                if attempt >= self.max_retries:
+                    raise
+                logger.warning("Redis连接错误，第 %s 次重试: %s", attempt, e)
+                await asyncio.sleep(self.retry_interval)
+
+    async def _load_context_fallback(self, user_open_id):
+        # 对话历史存放在 Redis 时多半同样不可用，此时按无上下文处理
+        if not user_open_id:
+            return [], None
+        try:
+            return await self.conversation_store.load(user_open_id), await self.conversation_store.load_summary(user_open_id)
+        except Exception as e:
+            logger.warning("读取对话历史失败，按无上下文处理: %s", e)
+            return [], None
+
+    def stats(self):
+        return {
+            'local_duplicates': self.local_duplicates,
+            'redis_duplicates': self.redis_duplicates,
+            'claimed': self.claimed,
+            'redis_errors': self.redis_errors,
+            'local_entries': len(self._local)
+        }
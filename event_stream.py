@@ -0,0 +1,302 @@
+import asyncio
+import logging
+import os
+import socket
+
+import redis
+
+from scheduler import KeyedScheduler
+
+logger = logging.getLogger(__name__)
+
+# 原子地完成事件去重并写入 Stream，避免去重键已设置但事件未入队导致消息丢失
+PUBLISH_SCRIPT = """
+if redis.call('SET', KEYS[1], 'processed', 'NX', 'EX', ARGV[1]) then
+    return redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], '*', 'event_id', ARGV[3], 'key', ARGV[4], 'payload', ARGV[5])
+end
+return false
+"""
+
+
+class EventStreamPublisher:
+    """回调节点使用的事件写入器，经校验的事件去重后写入 Redis Stream
+
+    使用同步 Redis 客户端，写入成功后回调才应答飞书，保证应答过的事件不会丢失。
+    """
+
+    def __init__(self, redis_client, stream_key='feishu:events', maxlen=100000, event_expire=3600):
+        """
+        Args:
+            redis_client: 同步 Redis 客户端
+            stream_key: 事件 Stream 键
+            maxlen: Stream 近似最大长度，超出后裁剪最早的已处理事件
+            event_expire: 去重键过期时间（秒）
+        """
+        self.redis_client = redis_client
+        self.stream_key = stream_key
+        self.maxlen = maxlen
+        self.event_expire = event_expire
+        self._script = redis_client.register_script(PUBLISH_SCRIPT)
+
+    def publish(self, event_id, key, payload):
+        """写入事件，重复事件返回 None，否则返回 Stream 条目 ID
+
+        Args:
+            event_id: 事件 ID，用于去重
+            key: 保序键（发送者 open_id），消费端按该键保证同一用户的消息按顺序处理
+            payload: 事件 JSON 字符串
+        """
+        entry_id = self._script(
+            keys=[f"event:{event_id}", self.stream_key],
+            args=[self.event_expire, self.maxlen, event_id, key or '', payload]
+        )
+        return entry_id or None
+
+
+class EventStreamConsumer:
+    """工作进程使用的 Redis Stream 消费者
+
+    通过消费组读取事件，按保序键交给 KeyedScheduler 并发处理，处理成功后 XACK。
+    处理失败的事件留在待确认列表中，空闲超过 claim_idle 秒后由任一消费者通过
+    XAUTOCLAIM 重新领取；投递次数超过 max_deliveries 的事件转入死信 Stream。
+    处理中的事件定期续期，避免长耗时的推理请求被其他消费者误领取。
+    """
+
+    def __init__(self, redis_store, stream_key='feishu:events', group='bot-workers', consumer=None,
+                 dead_letter_key='feishu:events:dead', concurrency=16, batch_size=16, block=5.0,
+                 claim_idle=60.0, max_deliveries=3, dead_letter_maxlen=10000):
+        """
+        Args:
+            redis_store: AsyncRedisStore 实例
+            stream_key: 事件 Stream 键
+            group: 消费组名称
+            consumer: 消费者名称，默认 主机名-进程号
+            dead_letter_key: 死信 Stream 键
+            concurrency: 并发处理的事件数上限
+            batch_size: 单次读取的最大事件数
+            block: 无新事件时单次阻塞读取的秒数
+            claim_idle: 待确认事件空闲超过该秒数后视为消费者已崩溃，可被重新领取
+            max_deliveries: 单个事件的最大投递次数，超过后转入死信 Stream
+            dead_letter_maxlen: 死信 Stream 近似最大长度
+        """
+        self.redis_store = redis_store
+        self.stream_key = stream_key
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.dead_letter_key = dead_letter_key
+        self.batch_size = batch_size
+        self.block = block
+        self.claim_idle = claim_idle
+        self.max_deliveries = max_deliveries
+        self.dead_letter_maxlen = dead_letter_maxlen
+        # 已领取的事件都必须进入调度器，不设单键上限，总量满时暂停读取
+        max_pending = concurrency + batch_size
+        self._scheduler = KeyedScheduler(
+            concurrency=concurrency,
+            max_pending=max_pending,
+            max_pending_per_key=max_pending,
+            name='stream-consumer'
+        )
+        # 已领取但尚未确认的条目 ID
+        self._in_flight = set()
+        self._running = False
+        self._handler = None
+        self._on_dead_letter = None
+        self._on_receive = None
+        self.processed = 0
+        self.failed = 0
+        self.dead_lettered = 0
+
+    async def ensure_group(self):
+        """创建消费组（Stream 不存在时一并创建），已存在时忽略"""
+        try:
+            await self.redis_store.client.xgroup_create(self.stream_key, self.group, id='0', mkstream=True)
+            logger.info("已创建消费组 %s，Stream: %s", self.group, self.stream_key)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    async def run(self, handler, on_dead_letter=None, on_receive=None):
+        """持续消费事件直到 stop() 被调用
+
+        Args:
+            handler: 协程函数 handler(fields)，fields 为条目字段字典，抛出异常表示处理失败
+            on_dead_letter: 可选协程函数 on_dead_letter(fields, deliveries)，事件转入死信后调用
+            on_receive: 可选函数 on_receive(fields)，新读取的事件进入按键排队之前同步调用，
+                用于 /停止 等需要立即作用于同一用户进行中任务的处理，抛出的异常只记录不影响消费
+        """
+        await self.ensure_group()
+        self._scheduler.start()
+        self._running = True
+        self._handler = handler
+        self._on_dead_letter = on_dead_letter
+        self._on_receive = on_receive
+        loop = asyncio.get_running_loop()
+        background = [loop.create_task(self._keep_alive_loop()), loop.create_task(self._claim_loop())]
+        logger.info("Stream 消费者 %s 已启动，消费组: %s", self.consumer, self.group)
+        try:
+            while self._running:
+                try:
+                    await self._read_new()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error("读取事件 Stream 失败: %s", e)
+                    await asyncio.sleep(1)
+        finally:
+            for task in background:
+                task.cancel()
+            await asyncio.gather(*background, return_exceptions=True)
+
+    def stop(self):
+        """停止读取新事件，已领取的事件仍会处理完"""
+        self._running = False
+
+    async def drain(self, timeout=None):
+        """等待已领取的事件处理完毕并停止调度器，超时返回 False"""
+        drained = await self._scheduler.join(timeout=timeout)
+        await self._scheduler.stop()
+        return drained
+
+    async def _read_new(self):
+        # 调度器没有空位时 put 会等待，从而暂停读取，未读取的事件留在 Stream 中由其他消费者处理
+        response = await self.redis_store.client.xreadgroup(
+            self.group, self.consumer, {self.stream_key: '>'},
+            count=self.batch_size, block=int(self.block * 1000)
+        )
+        for _, entries in response or []:
+            for entry_id, fields in entries:
+                if self._on_receive is not None:
+                    # 同一用户的事件在调度器中排在进行中的任务之后，需要立即生效的处理在入队前完成
+                    try:
+                        self._on_receive(fields)
+                    except Exception as e:
+                        logger.error("事件 %s 入队前处理失败: %s", fields.get('event_id'), e)
+                await self._dispatch(entry_id, fields)
+
+    async def _dispatch(self, entry_id, fields):
+        self._in_flight.add(entry_id)
+        await self._scheduler.put(fields.get('key') or None, self._process, (entry_id, fields))
+
+    async def _process(self, entry_id, fields):
+        try:
+            await self._handler(fields)
+        except Exception as e:
+            # 不确认，空闲超时后重新投递
+            self.failed += 1
+            logger.exception("处理事件 %s 失败，等待重新投递: %s", fields.get('event_id'), e)
+            self._in_flight.discard(entry_id)
+            return
+        try:
+            await self.redis_store.client.xack(self.stream_key, self.group, entry_id)
+            self.processed += 1
+        except Exception as e:
+            # 确认失败时事件会被重新投递，由消息处理侧的幂等机制兜底
+            logger.error("确认事件 %s 失败: %s", entry_id, e)
+        finally:
+            self._in_flight.discard(entry_id)
+
+    async def _keep_alive_loop(self):
+        """定期重置处理中条目的空闲时间，JUSTID 不会增加投递次数"""
+        while True:
+            await asyncio.sleep(max(self.claim_idle / 3, 0.1))
+            if not self._in_flight:
+                continue
+            try:
+                await self.redis_store.client.xclaim(
+                    self.stream_key, self.group, self.consumer, min_idle_time=0,
+                    message_ids=list(self._in_flight), justid=True
+                )
+            except Exception as e:
+                logger.error("续期处理中的事件失败: %s", e)
+
+    async def _claim_loop(self):
+        while True:
+            try:
+                await self._claim_stale()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("领取超时事件失败: %s", e)
+            await asyncio.sleep(max(self.claim_idle / 2, 0.1))
+
+    async def _claim_stale(self):
+        """领取崩溃消费者或处理失败遗留的事件，投递次数超限的转入死信"""
+        client = self.redis_store.client
+        start_id = '0-0'
+        while self._running:
+            result = await client.xautoclaim(
+                self.stream_key, self.group, self.consumer,
+                min_idle_time=int(self.claim_idle * 1000), start_id=start_id, count=self.batch_size
+            )
+            start_id, entries = result[0], result[1]
+            # 已被裁剪删除的条目无法处理，直接确认
+            deleted = result[2] if len(result) > 2 else []
+            entries = [(entry_id, fields) for entry_id, fields in entries if fields is not None and entry_id not in self._in_flight]
+            if deleted:
+                await client.xack(self.stream_key, self.group, *deleted)
+            if entries:
+                pending = await client.xpending_range(
+                    self.stream_key, self.group, min=entries[0][0], max=entries[-1][0], count=len(entries) * 2
+                )
+                deliveries = {item['message_id']: item['times_delivered'] for item in pending}
+                for entry_id, fields in entries:
+                    times = deliveries.get(entry_id, 1)
+                    if times > self.max_deliveries:
+                        await self._dead_letter(entry_id, fields, times)
+                    else:
+                        logger.warning("重新领取事件 %s，第 %s 次投递", fields.get('event_id'), times)
+                        await self._dispatch(entry_id, fields)
+            if start_id in ('0-0', b'0-0'):
+                return
+
+    async def _dead_letter(self, entry_id, fields, deliveries):
+        client = self.redis_store.client
+        pipe = client.pipeline(transaction=True)
+        pipe.xadd(self.dead_letter_key, dict(fields, source_id=entry_id, deliveries=deliveries),
+                  maxlen=self.dead_letter_maxlen, approximate=True)
+        pipe.xack(self.stream_key, self.group, entry_id)
+        await pipe.execute()
+        self.dead_lettered += 1
+        logger.error("事件 %s 投递 %s 次仍失败，已转入死信 Stream %s", fields.get('event_id'), deliveries, self.dead_letter_key)
+        if self._on_dead_letter is not None:
+            try:
+                await self._on_dead_letter(fields, deliveries)
+            except Exception as e:
+                logger.error("死信回调执行失败: %s", e)
+
+    async def dead_letters(self, count=100):
+        """列出死信 Stream 中最早的 count 条事件"""
+        return await self.redis_store.client.xrange(self.dead_letter_key, count=count)
+
+    async def replay(self, entry_ids=None, count=100):
+        """把死信事件重新写回事件 Stream 并从死信中删除
+
+        Args:
+            entry_ids: 指定重放的死信条目 ID，为空时重放最早的 count 条
+        Returns:
+            重放的事件数
+        """
+        client = self.redis_store.client
+        if entry_ids:
+            entries = []
+            for entry_id in entry_ids:
+                entries.extend(await client.xrange(self.dead_letter_key, min=entry_id, max=entry_id))
+        else:
+            entries = await client.xrange(self.dead_letter_key, count=count)
+        for entry_id, fields in entries:
+            fields = {k: v for k, v in fields.items() if k not in ('source_id', 'deliveries')}
+            pipe = client.pipeline(transaction=True)
+            pipe.xadd(self.stream_key, fields)
+            pipe.xdel(self.dead_letter_key, entry_id)
+            await pipe.execute()
+            logger.info("已重放死信事件 %s", fields.get('event_id'))
+        return len(entries)
+
+    def stats(self):
+        return {
+            'processed': self.processed,
+            'failed': self.failed,
+            'dead_lettered': self.dead_lettered,
+            'in_flight': len(self._in_flight)
+        }
@@ -0,0 +1,203 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import OrderedDict
+
+import aiohttp
+
+from metrics import FEISHU_RETRIES, FEISHU_SEND_SECONDS, timed
+from rate_limiter import TokenBucket, acquire_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class FeishuAPIError(Exception):
+    """飞书开放接口返回错误"""
+
+    def __init__(self, message, status=None, code=None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+
+class FeishuSender:
+    """非阻塞的飞书消息发送器
+
+    使用长连接池直接调用飞书开放接口，缓存 tenant_access_token 并在过期前刷新，
+    按应用和接收者两个维度限频，失败时指数退避重试。发送消息时携带 uuid，
+    飞书对相同 uuid 的请求 1 小时内至多成功发送一条，重试不会产生重复消息。
+    """
+
+    DEFAULT_BASE_URL = 'https://open.feishu.cn/open-apis'
+    # 频率限制
+    RATE_LIMIT_CODES = (99991400,)
+    # tenant_access_token 无效或过期，刷新后重试
+    TOKEN_INVALID_CODES = (99991661, 99991663, 99991668)
+    RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+    # 接收者限频桶的最大数量，超出时淘汰最久未使用的
+    MAX_RECIPIENT_BUCKETS = 10000
+
+    def __init__(self, app_id, app_secret, base_url=None, pool_limit=50, connect_timeout=5, read_timeout=15,
+                 app_qps=50, recipient_qps=5, max_retries=3, base_delay=0.2, max_delay=5.0, token_refresh_margin=300):
+        """
+        Args:
+            app_id: 飞书应用 ID
+            app_secret: 飞书应用密钥
+            base_url: 开放接口地址，默认 https://open.feishu.cn/open-apis
+            pool_limit: 连接池最大连接数
+            connect_timeout: 建立连接超时（秒）
+            read_timeout: 读取超时（秒）
+            app_qps: 应用维度每秒请求上限，飞书发送消息接口为 50 QPS
+            recipient_qps: 同一接收者每秒消息上限，飞书为 5 QPS
+            max_retries: 最大重试次数
+            base_delay: 指数退避的初始等待秒数
+            max_delay: 单次等待的最长秒数
+            token_refresh_margin: 提前刷新 tenant_access_token 的秒数
+        """
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.base_url = (base_url or self.DEFAULT_BASE_URL).rstrip('/')
+        self.pool_limit = pool_limit
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.recipient_qps = recipient_qps
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.token_refresh_margin = token_refresh_margin
+        self._app_bucket = TokenBucket(app_qps * 60, burst=app_qps)
+        self._recipient_buckets = OrderedDict()
+        self._session = None
+        self._session_loop = None
+        self._token = None
+        self._token_expire_at = 0.0
+        self._token_lock = None
+        self.retries = 0
+
+    async def _get_session(self):
+        loop = asyncio.get_running_loop()
+        if self._session is not None and not self._session.closed and self._session_loop is loop:
+            return self._session
+        connector = aiohttp.TCPConnector(limit=self.pool_limit, ttl_dns_cache=300, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=None, connect=self.connect_timeout, sock_read=self.read_timeout)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self._session_loop = loop
+        self._token_lock = asyncio.Lock()
+        return self._session
+
+    async def start(self):
+        """创建连接池并预取 tenant_access_token，供应用启动时调用"""
+        await self._get_session()
+        try:
+            await self.get_tenant_access_token()
+        except Exception as e:
+            logger.warning("预取 tenant_access_token 失败，将在首次发送时重试: %s", e)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._session_loop = None
+
+    async def get_tenant_access_token(self, force_refresh=False):
+        """获取 tenant_access_token，过期前 token_refresh_margin 秒自动刷新"""
+        if not force_refresh and self._token and time.monotonic() < self._token_expire_at - self.token_refresh_margin:
+            return self._token
+        session = await self._get_session()
+        async with self._token_lock:
+            # 等锁期间可能已被其他协程刷新
+            if not force_refresh and self._token and time.monotonic() < self._token_expire_at - self.token_refresh_margin:
+                return self._token
+            url = f"{self.base_url}/auth/v3/tenant_access_token/internal"
+            async with session.post(url, json={"app_id": self.app_id, "app_secret": self.app_secret}) as response:
+                result = await response.json(content_type=None)
+            if result.get('code') != 0:
+                raise FeishuAPIError(f"获取 tenant_access_token 失败: {result.get('msg')}", status=response.status, code=result.get('code'))
+            self._token = result['tenant_access_token']
+            self._token_expire_at = time.monotonic() + int(result.get('expire', 7200))
+            logger.info("已刷新 tenant_access_token，有效期 %s 秒", result.get('expire'))
+            return self._token
+
+    def _recipient_bucket(self, receive_id):
+        bucket = self._recipient_buckets.get(receive_id)
+        if bucket is None:
+            bucket = TokenBucket(self.recipient_qps * 60, burst=self.recipient_qps)
+            self._recipient_buckets[receive_id] = bucket
+            if len(self._recipient_buckets) > self.MAX_RECIPIENT_BUCKETS:
+                self._recipient_buckets.popitem(last=False)
+        else:
+            self._recipient_buckets.move_to_end(receive_id)
+        return bucket
+
+    def _retry_delay(self, attempt, reset=None):
+        self.retries += 1
+        FEISHU_RETRIES.inc()
+        if reset:
+            try:
+                return min(self.max_delay, float(reset))
+            except ValueError:
+                pass
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+
+    async def _request(self, method, path, params=None, body=None, recipient=None):
+        """调用开放接口，限频、刷新 token 并按需重试，返回响应中的 data"""
+        attempt = 0
+        while True:
+            await acquire_tokens(self._app_bucket, 1)
+            if recipient:
+                await acquire_tokens(self._recipient_bucket(recipient), 1)
+            session = await self._get_session()
+            reset = None
+            try:
+                token = await self.get_tenant_access_token()
+                headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json; charset=utf-8"}
+                async with session.request(method, f"{self.base_url}{path}", params=params, json=body, headers=headers) as response:
+                    status = response.status
+                    reset = response.headers.get('x-ogw-ratelimit-reset')
+                    try:
+                        result = await response.json(content_type=None)
+                    except (json.JSONDecodeError, aiohttp.ContentTypeError):
+                        result = {'code': -1, 'msg': await response.text()}
+                code = result.get('code')
+                if status == 200 and code == 0:
+                    return result.get('data') or {}
+                error = FeishuAPIError(f"飞书接口 {path} 调用失败: {result.get('msg')}, 错误码: {code}, 状态码: {status}", status=status, code=code)
+                if code in self.TOKEN_INVALID_CODES:
+                    self._token = None
+                    retryable = True
+                else:
+                    retryable = status in self.RETRYABLE_STATUS or code in self.RATE_LIMIT_CODES
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = FeishuAPIError(f"飞书接口 {path} 网络异常: {str(e)}")
+                retryable = True
+            if not retryable or attempt >= self.max_retries:
+                raise error
+            delay = self._retry_delay(attempt, reset)
+            attempt += 1
+            logger.warning("%s，%.2f 秒后第 %s 次重试", error, delay, attempt)
+            await asyncio.sleep(delay)
+
+    async def send_message(self, receive_id, msg_type, content, receive_id_type='open_id', uuid=None):
+        """发送消息并返回消息 ID
+
+        Args:
+            content: 消息内容 JSON 字符串
+            uuid: 幂等键，相同 uuid 的消息 1 小时内只会发送一次，最长 50 个字符
+        """
+        body = {"receive_id": receive_id, "msg_type": msg_type, "content": content}
+        if uuid:
+            body["uuid"] = uuid
+        with timed(FEISHU_SEND_SECONDS, 'send'):
+            data = await self._request('POST', '/im/v1/messages', params={"receive_id_type": receive_id_type}, body=body, recipient=receive_id)
+        return data.get('message_id')
+
+    async def send_text(self, receive_id, text, receive_id_type='open_id', uuid=None):
+        return await self.send_message(receive_id, 'text', json.dumps({"text": text}, ensure_ascii=False), receive_id_type, uuid)
+
+    async def patch_message(self, message_id, content):
+        """更新已发送的卡片消息"""
+        with timed(FEISHU_SEND_SECONDS, 'patch'):
+            await self._request('PATCH', f'/im/v1/messages/{message_id}', body={"content": content})
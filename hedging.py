@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from metrics import DEEPSEEK_HEDGES
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """记录最近若干次首包耗时，按分位数给出对冲请求的等待时间"""
+
+    def __init__(self, percentile=0.95, window=200, min_samples=20, min_delay=0.5, max_delay=10.0):
+        """
+        Args:
+            percentile: 取最近耗时的哪个分位数作为对冲等待时间（0-1）
+            window: 保留的最近样本数
+            min_samples: 样本不足时使用 max_delay
+            min_delay: 对冲等待时间下限（秒），避免抖动时大量发出对冲请求
+            max_delay: 对冲等待时间上限（秒）
+        """
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def delay(self):
+        """当前的对冲等待时间（秒）"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return self.max_delay
+            ordered = sorted(self._samples)
+        value = ordered[min(len(ordered) - 1, max(0, math.ceil(self.percentile * len(ordered)) - 1))]
+        return min(self.max_delay, max(self.min_delay, value))
+
+
+async def hedge(start, tracker):
+    """发出请求，超过 tracker 给出的等待时间仍未返回时再发出一个相同请求，取先成功的结果
+
+    Args:
+        start: start(attempt) 返回第 attempt 次（0 或 1）尝试的协程
+        tracker: LatencyTracker，记录调用方实际等待的时间
+
+    Returns:
+        (获胜的尝试序号, 结果)；两次尝试都失败时抛出首个请求的异常
+    """
+    begin = time.perf_counter()
+    tasks = [asyncio.ensure_future(start(0))]
+    try:
+        delay = tracker.delay()
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            DEEPSEEK_HEDGES.labels('fired').inc()
+            logger.info("首包超过 %.2f 秒未返回，发出对冲请求", delay)
+            tasks.append(asyncio.ensure_future(start(1)))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                if task in done and task.exception() is None:
+                    attempt = tasks.index(task)
+                    if attempt:
+                        DEEPSEEK_HEDGES.labels('won').inc()
+                    tracker.observe(time.perf_counter() - begin)
+                    return attempt, task.result()
+        raise tasks[0].exception()
+    finally:
+        # 取消落后的请求并等待其释放连接，之后调用方才能安全关闭对应的生成器
+        losers = [task for task in tasks if not task.done()]
+        for task in losers:
+            task.cancel()
+        if losers:
+            await asyncio.gather(*losers, return_exceptions=True)
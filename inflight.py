@@ -0,0 +1,152 @@
+import asyncio
+import contextvars
+import logging
+import time
+from contextlib import asynccontextmanager
+
+from metrics import GENERATIONS_CANCELLED
+
+logger = logging.getLogger(__name__)
+
+# 取消原因
+STOP = 'stop'
+CLEAR = 'clear'
+SUPERSEDED = 'superseded'
+
+# 当前协程所属的生成，DeepSeek 客户端据此登记打开的响应
+_current_generation = contextvars.ContextVar('current_generation', default=None)
+
+
+class GenerationCancelled(Exception):
+    """生成被 /停止、清除上下文或新消息取消"""
+
+    def __init__(self, reason):
+        super().__init__(f"生成已取消: {reason}")
+        self.reason = reason
+
+
+class _Generation:
+    __slots__ = ('key', 'event_id', 'task', 'responses', 'started_at', 'reason')
+
+    def __init__(self, key, event_id, task):
+        self.key = key
+        self.event_id = event_id
+        self.task = task
+        self.responses = set()
+        self.started_at = time.monotonic()
+        self.reason = None
+
+
+@asynccontextmanager
+async def tracking(response):
+    """在读取期间把上游 aiohttp 响应登记到当前生成，取消时直接关闭连接，DeepSeek 随即停止生成"""
+    generation = _current_generation.get()
+    if generation is None:
+        yield response
+        return
+    generation.responses.add(response)
+    try:
+        yield response
+    finally:
+        generation.responses.discard(response)
+
+
+class InflightRegistry:
+    """按用户登记进行中的生成，支持随时取消
+
+    每次生成在独立的子任务中运行，取消时关闭其上游响应并取消子任务，调用方收到 GenerationCancelled
+    后立即返回，工作池的 worker 随即空出来处理下一条消息。所有方法都需要在同一个事件循环线程上调用。
+    """
+
+    def __init__(self, stop_notice_ttl=60.0):
+        """
+        Args:
+            stop_notice_ttl: /停止 取消的记录保留秒数，供稍后处理的 /停止 指令回复取消结果
+        """
+        self.stop_notice_ttl = stop_notice_ttl
+        # 用户 -> [_Generation, ...]
+        self._generations = {}
+        # 用户 -> (取消的生成数, 取消时间)
+        self._stopped = {}
+        self.cancelled = 0
+
+    async def run(self, key, event_id, coro):
+        """在子任务中执行一次生成并登记，返回 coro 的结果
+
+        Raises:
+            GenerationCancelled: 生成被 cancel 取消
+        """
+        if key is None:
+            return await coro
+        generation = _Generation(key, event_id, None)
+        task = generation.task = asyncio.ensure_future(self._bound(generation, coro))
+        self._generations.setdefault(key, []).append(generation)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if generation.reason is not None and task.cancelled():
+                raise GenerationCancelled(generation.reason) from None
+            raise
+        finally:
+            generations = self._generations.get(key)
+            if generations is not None:
+                if generation in generations:
+                    generations.remove(generation)
+                if not generations:
+                    del self._generations[key]
+
+    @staticmethod
+    async def _bound(generation, coro):
+        # 子任务运行在复制出的上下文中，这里的设置不会影响调用方
+        _current_generation.set(generation)
+        return await coro
+
+    def active(self, key):
+        """用户进行中的生成数"""
+        return len(self._generations.get(key, ()))
+
+    def cancel(self, key, reason, exclude_event_id=None):
+        """取消用户进行中的生成，返回取消的数量
+
+        Args:
+            reason: STOP / CLEAR / SUPERSEDED
+            exclude_event_id: 不取消由该事件发起的生成，避免飞书重推同一事件时取消其自身
+        """
+        count = 0
+        for generation in list(self._generations.get(key, ())):
+            if generation.reason is not None or generation.task.done():
+                continue
+            if exclude_event_id is not None and generation.event_id == exclude_event_id:
+                continue
+            generation.reason = reason
+            for response in list(generation.responses):
+                response.close()
+            generation.task.cancel()
+            count += 1
+            GENERATIONS_CANCELLED.labels(reason).inc()
+            logger.info("已取消用户 %s 进行中的生成，原因: %s，已运行 %.1f 秒，关闭上游连接 %s 个",
+                        key, reason, time.monotonic() - generation.started_at, len(generation.responses))
+        self.cancelled += count
+        if reason == STOP:
+            self.mark_stopped(key, count)
+        return count
+
+    def mark_stopped(self, key, count):
+        """记录由 /停止 取消的生成数，供稍后处理的 /停止 指令回复；尚未登记的生成（如等待合并的消息）由调用方计入"""
+        if not count:
+            return
+        now = time.monotonic()
+        previous = self._stopped.get(key)
+        self._stopped[key] = ((previous[0] if previous else 0) + count, now)
+        if len(self._stopped) > 1000:
+            self._stopped = {k: v for k, v in self._stopped.items() if now - v[1] < self.stop_notice_ttl}
+
+    def pop_stopped(self, key):
+        """取走最近由 /停止 取消的生成数，供 /停止 指令回复"""
+        stopped = self._stopped.pop(key, None)
+        if stopped is None or time.monotonic() - stopped[1] >= self.stop_notice_ttl:
+            return 0
+        return stopped[0]
+
+    def stats(self):
+        return {'active': sum(len(generations) for generations in self._generations.values()), 'cancelled': self.cancelled}
@@ -0,0 +1,203 @@
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import time
+
+# 当前处理的事件 ID，随协程上下文传递，所有日志记录自动携带
+event_id_var = contextvars.ContextVar('event_id', default=None)
+
+# 会泄露用户内容的字段，结构化载荷中只保留长度
+SENSITIVE_TEXT_FIELDS = frozenset(('content', 'reasoning_content', 'text', 'user_msg', 'summary'))
+SECRET_PATTERNS = [
+    (re.compile(r'sk-[A-Za-z0-9]{8,}'), 'sk-***'),
+    (re.compile(r'(Bearer\s+)[A-Za-z0-9._\-]+'), r'\1***'),
+    (re.compile(r'((?:api_key|app_secret|encrypt_key|verification_token|tenant_access_token)["\']?\s*[:=]\s*["\']?)[^"\'\s,}]+', re.I), r'\1***')
+]
+# LogRecord 的标准属性，其余属性视为 extra 字段输出
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None)).keys()) | {'message', 'asctime', 'event_id'}
+
+_listener = None
+_exception_formatter = logging.Formatter()
+
+
+def bind_event_id(event_id):
+    """设置当前上下文的事件 ID，返回用于 reset_event_id 的令牌"""
+    return event_id_var.set(event_id)
+
+
+def reset_event_id(token):
+    event_id_var.reset(token)
+
+
+def redact_secrets(text):
+    """替换文本中的 API Key、Bearer 令牌等凭证"""
+    if 'sk-' not in text and 'Bearer' not in text and '_key' not in text and 'secret' not in text and 'token' not in text:
+        return text
+    for pattern, replacement in SECRET_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def redact_payload(value, redact_text=True):
+    """递归复制载荷，消息正文只保留长度，凭证字段打码"""
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            if redact_text and key in SENSITIVE_TEXT_FIELDS and isinstance(item, str):
+                result[key] = f"<{len(item)} chars>"
+            else:
+                result[key] = redact_payload(item, redact_text)
+        return result
+    if isinstance(value, list):
+        return [redact_payload(item, redact_text) for item in value]
+    if isinstance(value, str):
+        return redact_secrets(value)
+    return value
+
+
+class PayloadLogger:
+    """按比例采样、截断并脱敏后以 DEBUG 级别记录请求/响应载荷
+
+    未启用 DEBUG 或未被采样时不做任何序列化，避免在热路径上格式化整段对话。
+    """
+
+    def __init__(self, sample_rate=0.01, max_chars=2000, redact_text=True):
+        """
+        Args:
+            sample_rate: 记录载荷的比例（0-1）
+            max_chars: 单条载荷的最大字符数，超出部分截断
+            redact_text: 是否隐去消息正文，只保留长度
+        """
+        self.sample_rate = sample_rate
+        self.max_chars = max_chars
+        self.redact_text = redact_text
+
+    def log(self, logger, message, payload, *args):
+        """message 与 args 按 logging 的 % 格式延迟合并"""
+        if not self.sample_rate or not logger.isEnabledFor(logging.DEBUG):
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        text = json.dumps(redact_payload(payload, self.redact_text), ensure_ascii=False, default=str)
+        if len(text) > self.max_chars:
+            text = f"{text[:self.max_chars]}...(共 {len(text)} 字符)"
+        logger.debug(message, *args, extra={'payload': text})
+
+
+class ContextFilter(logging.Filter):
+    """为记录附加当前事件 ID"""
+
+    def filter(self, record):
+        record.event_id = event_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON"""
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        event_id = getattr(record, 'event_id', None)
+        if event_id:
+            entry['event_id'] = event_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        if record.stack_info:
+            entry['stack_info'] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """与原有文本格式一致，附带事件 ID 和载荷"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    def format(self, record):
+        text = super().format(record)
+        event_id = getattr(record, 'event_id', None)
+        if event_id:
+            text += f" [event_id={event_id}]"
+        payload = getattr(record, 'payload', None)
+        if payload is not None:
+            text += f" payload={payload}"
+        return text
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """队列满时丢弃记录，不阻塞业务线程"""
+
+    def prepare(self, record):
+        # 调用线程只合并参数并打码，保留 extra 字段，JSON/文本格式化交给后台线程
+        record = copy.copy(record)
+        record.msg = redact_secrets(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            record.exc_text = redact_secrets(_exception_formatter.formatException(record.exc_info))
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def setup_logging(level=logging.INFO, log_format='json', log_file=None, queue_size=10000):
+    """配置根日志：记录在调用线程中入队，由后台线程格式化并写入文件和控制台
+
+    Args:
+        level: 日志级别
+        log_format: json 或 text
+        log_file: 日志文件路径，为 None 时只输出到控制台
+        queue_size: 日志队列长度，队列满时丢弃新记录而不阻塞业务线程
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+    formatter = JsonFormatter() if log_format == 'json' else TextFormatter()
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+        handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = _NonBlockingQueueHandler(queue.Queue(queue_size))
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """停止后台写日志线程，写完队列中剩余的记录"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import time
+
+from metrics import COALESCER_EVENTS
+from scheduler import QueueFullError
+
+logger = logging.getLogger(__name__)
+
+
+class _UserBatch:
+    __slots__ = ('items', 'first_at', 'timer', 'task', 'queued', 'generation', 'running_items', 'running_first_at',
+                 'started')
+
+    def __init__(self):
+        self.items = []
+        self.first_at = 0.0
+        self.timer = None
+        self.task = None
+        # 已提交到调度器、尚未开始执行；每次取出或放回消息时递增 generation，使排队中的旧任务失效
+        self.queued = False
+        self.generation = 0
+        self.running_items = []
+        self.running_first_at = 0.0
+        self.started = False
+
+
+class MessageCoalescer:
+    """按用户合并短时间内连续发送的消息，只调用一次模型、回复一次
+
+    每条新消息都会把合并窗口重新计时，但从第一条消息起最多等待 max_wait；
+    同一用户同一时间只有一次生成。合并窗口结束后的消息按用户键提交到调度器，
+    受全局并发上限约束，并与同一用户排队中的指令保持顺序。
+    生成尚未收到首个 token 时又来了新消息（或被 interrupt），取消本次生成，连同新消息重新合并；
+    已开始输出时新消息留到下一轮。cancel 丢弃用户所有尚未回复的消息。所有方法都需要在同一个事件循环线程上调用。
+    """
+
+    def __init__(self, process, window=1.5, max_wait=6.0, max_messages=10, schedule=None):
+        """
+        Args:
+            process: 协程函数 process(key, items, mark_started)，items 为合并的消息列表，
+                收到首个 token 后须调用 mark_started()，之后不再被取消
+            window: 最后一条消息之后的静默秒数，期间没有新消息即开始处理
+            max_wait: 从第一条消息起的最长等待秒数
+            max_messages: 单次最多合并的消息数，达到后立即处理
+            schedule: 不等待地提交任务的函数 schedule(key, coro_func, args)，队列满时抛出 QueueFullError；
+                为 None 时直接在事件循环上创建任务
+        """
+        self.process = process
+        self.schedule = schedule
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self._batches = {}
+        self.messages = 0
+        self.batches = 0
+        self.restarts = 0
+
+    def submit(self, key, item):
+        """加入一条消息，立即返回，由合并窗口结束后的后台任务处理"""
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _UserBatch()
+        self.messages += 1
+        # 首个 token 前有新消息：取消排队中或进行中的生成，连同新消息重新合并，最长等待仍从最早的消息算起
+        self._restart(batch)
+        if not batch.items:
+            batch.first_at = time.monotonic()
+        batch.items.append(item)
+        self._schedule(key, batch)
+
+    def interrupt(self, key):
+        """新消息到达但尚未入队时调用：取消尚未开始输出的生成，放回等待列表并重新计时
+
+        同一用户的消息与合并后的生成在调度器中排同一个队，新消息排在生成之后，
+        因此需要在回调中提前打断，新消息处理后再一起合并。
+        """
+        batch = self._batches.get(key)
+        if batch is not None and self._restart(batch):
+            self._schedule(key, batch)
+
+    def cancel(self, key):
+        """丢弃用户等待合并、排队中和进行中的消息，返回丢弃的批次数（0 或 1）
+
+        /停止、/清除上下文 时调用，被丢弃的消息不再回复，也不会在清除之后写回对话历史。
+        """
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return 0
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        # 先解除登记再取消，_run 据此静默结束，排队中的旧任务随 generation 递增失效
+        task, batch.task = batch.task, None
+        if task is not None:
+            task.cancel()
+        dropped = bool(batch.items or batch.queued or task is not None)
+        batch.generation += 1
+        batch.queued = False
+        batch.items = []
+        batch.running_items = []
+        if dropped:
+            COALESCER_EVENTS.labels('cancelled').inc()
+        return int(dropped)
+
+    def _restart(self, batch):
+        if (batch.task is None and not batch.queued) or batch.started:
+            return False
+        if batch.task is not None:
+            batch.task.cancel()
+            batch.task = None
+        self._restore(batch)
+        self.restarts += 1
+        COALESCER_EVENTS.labels('restart').inc()
+        return True
+
+    @staticmethod
+    def _restore(batch):
+        """把已取出的消息放回等待列表，排队中的旧任务随之失效"""
+        batch.generation += 1
+        batch.queued = False
+        batch.items = batch.running_items + batch.items
+        batch.first_at = batch.running_first_at
+        batch.running_items = []
+
+    def _schedule(self, key, batch):
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        if batch.task is not None or batch.queued:
+            # 本轮已开始输出或已在排队，结束后再处理新消息
+            return
+        if len(batch.items) >= self.max_messages:
+            delay = 0
+        else:
+            delay = max(0.0, min(self.window, batch.first_at + self.max_wait - time.monotonic()))
+        batch.timer = asyncio.get_running_loop().call_later(delay, self._flush, key)
+
+    def _flush(self, key, direct=False):
+        batch = self._batches[key]
+        batch.timer = None
+        batch.running_items, batch.items = batch.items, []
+        batch.running_first_at = batch.first_at
+        batch.started = False
+        batch.generation += 1
+        if direct or self.schedule is None:
+            self._start(key, batch)
+        else:
+            try:
+                batch.queued = True
+                self.schedule(key, self._run_scheduled, (key, batch, batch.generation))
+            except QueueFullError as e:
+                # 队列满时放回等待列表，一个合并窗口后重试
+                logger.warning("合并消息入队失败，%s 秒后重试: %s", self.window, e)
+                self._restore(batch)
+                batch.timer = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+                return
+        self.batches += 1
+        COALESCER_EVENTS.labels('batch').inc()
+        if len(batch.running_items) > 1:
+            COALESCER_EVENTS.labels('merged').inc(len(batch.running_items) - 1)
+
+    def _start(self, key, batch):
+        batch.queued = False
+        batch.task = asyncio.get_running_loop().create_task(self._run(key, batch, batch.running_items))
+        return batch.task
+
+    async def _run_scheduled(self, key, batch, generation):
+        """由调度器 worker 执行，占用一个并发名额直到生成结束"""
+        if batch.generation != generation or not batch.queued:
+            # 排队期间被新消息打断，消息已放回等待列表
+            return
+        # 生成在子任务中运行，被新消息取消时不影响调度器的 worker
+        await asyncio.wait([self._start(key, batch)])
+
+    async def _run(self, key, batch, items):
+        task = asyncio.current_task()
+
+        def mark_started():
+            if batch.task is task:
+                batch.started = True
+
+        try:
+            await self.process(key, items, mark_started)
+        except asyncio.CancelledError:
+            # 被新消息取消时静默结束，其他取消（如关闭服务）继续向上传递
+            if batch.task is task:
+                raise
+        except Exception as e:
+            logger.exception("处理合并消息失败: %s", e)
+        finally:
+            if batch.task is task:
+                batch.task = None
+                batch.running_items = []
+                if batch.items:
+                    self._schedule(key, batch)
+                elif batch.timer is None and not batch.queued:
+                    self._batches.pop(key, None)
+
+    async def drain(self, timeout=None):
+        """立即处理所有等待中的消息并等待生成结束，返回是否在超时前全部完成
+
+        在调度器停止后调用，等待中及滞留在调度器中的消息直接在事件循环上处理。
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._batches:
+            for key, batch in list(self._batches.items()):
+                if batch.task is not None:
+                    continue
+                if batch.queued:
+                    self._restore(batch)
+                if batch.timer is not None:
+                    batch.timer.cancel()
+                    batch.timer = None
+                if batch.items:
+                    self._flush(key, direct=True)
+                else:
+                    self._batches.pop(key, None)
+            tasks = [batch.task for batch in self._batches.values() if batch.task is not None]
+            if not tasks:
+                break
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            await asyncio.wait(tasks, timeout=remaining)
+        return True
+
+    def stats(self):
+        return {
+            'messages': self.messages,
+            'batches': self.batches,
+            'restarts': self.restarts,
+            'pending_users': len(self._batches)
+        }
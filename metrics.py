@@ -0,0 +1,144 @@
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# 覆盖毫秒级的 Redis 往返到分钟级的推理请求
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+# 消息处理链路各阶段（stage 标签）：
+#   event_parse: 解析飞书事件、提取消息内容和发送者
+#   redis_dedupe: Redis 去重，与读取对话历史和摘要合并为同一次往返
+#   context_load: 单独从 Redis 读取对话历史，仅连续消息合并后的批次使用
+#   context_build: 按 token 预算裁剪历史并组装提示词，不访问 Redis
+#   deepseek: 调用 DeepSeek 生成回复，流式模式下包含卡片渲染
+#   feishu_send: 以普通消息发送回复
+#   total: 单条消息从收到到处理完成
+#   coalesced_batch: 合并后的一批消息从读取历史到发送回复
+STAGE_SECONDS = Histogram(
+    'feishu_bot_stage_seconds', '消息处理各阶段耗时（秒）', ['stage'], buckets=LATENCY_BUCKETS)
+EVENTS = Counter(
+    'feishu_bot_events_total', '收到的消息事件数，按处理结果区分', ['outcome'])
+DUPLICATE_EVENTS = Counter(
+    'feishu_bot_duplicate_events_total', '命中去重而跳过的重复事件数')
+DEDUPE_RESULTS = Counter(
+    'feishu_bot_dedupe_total', '事件去重结果：local_duplicate/redis_duplicate/claimed/redis_error_open/redis_error_closed',
+    ['result'])
+
+QUEUE_DEPTH = Gauge(
+    'feishu_bot_queue_depth', '排队中及执行中的任务数', ['queue'], multiprocess_mode='livesum')
+COALESCER_EVENTS = Counter(
+    'feishu_bot_coalescer_total', '连续消息合并：batch 为调用模型的批次数，merged 为并入其他消息的条数，restart 为首 token 前被新消息打断的生成数，cancelled 为被 /停止 或清除上下文丢弃的批次数',
+    ['result'])
+QUEUE_WAIT_SECONDS = Histogram(
+    'feishu_bot_queue_wait_seconds', '任务从入队到开始执行的等待时间（秒）', ['queue'], buckets=LATENCY_BUCKETS)
+
+DEEPSEEK_TTFT_SECONDS = Histogram(
+    'feishu_bot_deepseek_ttft_seconds', 'DeepSeek 首个 token 耗时（秒），包含限流排队', ['model', 'stream'],
+    buckets=LATENCY_BUCKETS)
+DEEPSEEK_LATENCY_SECONDS = Histogram(
+    'feishu_bot_deepseek_latency_seconds', 'DeepSeek 请求总耗时（秒），包含限流排队和重试', ['model', 'stream'],
+    buckets=LATENCY_BUCKETS)
+DEEPSEEK_HTTP_STATUS = Counter(
+    'feishu_bot_deepseek_http_status_total', 'DeepSeek 接口响应状态码', ['status'])
+DEEPSEEK_TOKENS = Counter(
+    'feishu_bot_deepseek_tokens_total', 'DeepSeek usage 中的 token 数', ['model', 'type'])
+
+PROMPT_CACHE_HIT_RATIO = Histogram(
+    'feishu_bot_prompt_cache_hit_ratio', '每次请求 prompt 中命中 DeepSeek 上下文缓存的 token 比例', ['model'],
+    buckets=(0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1))
+PROMPT_CACHE_TTFT_SECONDS = Histogram(
+    'feishu_bot_prompt_cache_ttft_seconds', '按前缀缓存命中情况区分的首 token 耗时（秒），cache 为 hit 表示过半 prompt 命中缓存',
+    ['model', 'stream', 'cache'], buckets=LATENCY_BUCKETS)
+RESPONSE_CACHE_RESULTS = Counter(
+    'feishu_bot_response_cache_total', '回复缓存：local_hit/redis_hit/miss 为查询结果，skipped 为不可缓存的请求数，oversized 为超长未缓存的回复数',
+    ['result'])
+CONTEXT_TRIMMED_TOKENS = Counter(
+    'feishu_bot_context_trimmed_tokens_total', '超出上下文预算而在本轮请求中裁剪掉的历史 token 数（估算值）')
+DEEPSEEK_HEDGES = Counter(
+    'feishu_bot_deepseek_hedges_total', 'deepseek-chat 对冲请求：fired 为发出的对冲请求数，won 为对冲请求先返回的次数', ['result'])
+
+CIRCUIT_STATE = Gauge(
+    'feishu_bot_circuit_state', '熔断器状态：0 关闭，1 半开，2 打开', ['dependency'], multiprocess_mode='max')
+CIRCUIT_REJECTED = Counter(
+    'feishu_bot_circuit_rejected_total', '熔断打开期间被立即拒绝的调用数', ['dependency'])
+
+USAGE_FLUSHES = Counter(
+    'feishu_bot_usage_flush_total', '用量统计批量写入 Redis 的次数，按结果区分', ['result'])
+QUOTA_EXCEEDED = Counter(
+    'feishu_bot_quota_exceeded_total', '超出每日 token 额度而拒绝的消息数', ['scope'])
+
+ROUTE_DECISIONS = Counter(
+    'feishu_bot_model_route_total', '模型路由选择次数，按路由和选择依据区分', ['route', 'reason'])
+ROUTE_SECONDS = Histogram(
+    'feishu_bot_model_route_seconds', '各路由从请求模型到回复完成的耗时（秒），用于调整路由阈值', ['route', 'stream'],
+    buckets=LATENCY_BUCKETS)
+
+GENERATIONS_CANCELLED = Counter(
+    'feishu_bot_generations_cancelled_total', '被取消的进行中生成数，按原因区分', ['reason'])
+
+STARTUP_SECONDS = Gauge(
+    'feishu_bot_startup_seconds', '启动各阶段耗时（秒）：import 为导入 app 模块，warmup 为预热', ['phase'],
+    multiprocess_mode='max')
+READY = Gauge(
+    'feishu_bot_ready', '最近一次就绪检查是否通过：1 就绪，0 未就绪', multiprocess_mode='min')
+
+FEISHU_SEND_SECONDS = Histogram(
+    'feishu_bot_feishu_send_seconds', '飞书消息接口调用耗时（秒），包含限频等待和重试', ['operation'],
+    buckets=LATENCY_BUCKETS)
+FEISHU_RETRIES = Counter(
+    'feishu_bot_feishu_retries_total', '飞书消息接口重试次数')
+
+# usage 字段到 token 类型标签的映射
+USAGE_FIELDS = (
+    ('prompt_tokens', 'prompt'),
+    ('completion_tokens', 'completion'),
+    ('prompt_cache_hit_tokens', 'cache_hit'),
+    ('prompt_cache_miss_tokens', 'cache_miss'),
+)
+
+
+@contextmanager
+def timed(histogram, *labels):
+    """记录代码块耗时到直方图，异常退出时同样记录"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(*labels).observe(time.perf_counter() - start)
+
+
+def record_usage(model, usage):
+    """累计 DeepSeek 响应 usage 字段中的 token 数"""
+    if not usage:
+        return
+    for field, token_type in USAGE_FIELDS:
+        value = usage.get(field)
+        if value:
+            DEEPSEEK_TOKENS.labels(model, token_type).inc(value)
+
+
+def record_prompt_cache(model, stream, usage, ttft):
+    """记录单次请求的前缀缓存命中比例及对应的首 token 耗时，返回 (命中 token 数, prompt token 数)"""
+    hit = (usage or {}).get('prompt_cache_hit_tokens')
+    miss = (usage or {}).get('prompt_cache_miss_tokens')
+    if hit is None or miss is None or hit + miss <= 0:
+        return None
+    ratio = hit / (hit + miss)
+    PROMPT_CACHE_HIT_RATIO.labels(model).observe(ratio)
+    if ttft is not None:
+        PROMPT_CACHE_TTFT_SECONDS.labels(model, stream, 'hit' if ratio >= 0.5 else 'miss').observe(ttft)
+    return hit, hit + miss
+
+
+def render():
+    """生成 /metrics 响应，返回 (响应体, Content-Type)
+
+    设置了 PROMETHEUS_MULTIPROC_DIR 时汇总同一主机上所有 worker 进程的指标。
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,92 @@
+import logging
+import re
+from collections import namedtuple
+
+from deepseek_client import CHAT_MODEL, REASONER_MODEL
+
+logger = logging.getLogger(__name__)
+
+# 路由名称
+FAST = 'fast'
+DEEP = 'deep'
+ROUTE_MODELS = {FAST: CHAT_MODEL, DEEP: REASONER_MODEL}
+
+# name: 路由名称；model: 模型；reason: 选择依据（prefix/chat_default/default/length/code/math/keyword/simple）；text: 去掉路由前缀后的消息
+Route = namedtuple('Route', ['name', 'model', 'reason', 'text'])
+
+
+class ModelRouter:
+    """根据本地规则在 deepseek-chat 和 deepseek-reasoner 之间选择模型
+
+    优先级：消息前缀（/深度思考、/快速） > 会话默认路由 > 全局默认路由 > 启发式规则。
+    启发式规则只看消息本身：较长、包含代码或数学推导、出现需要推理的关键词时走推理模型，
+    其余简短消息走响应更快的对话模型。
+    """
+
+    PREFIXES = (('/深度思考', DEEP), ('/快速', FAST))
+    CODE_PATTERN = re.compile(
+        r'```|`[^`\n]+`|\b(?:def|class|function|return|import|select|from|where|const|let|var|public|static|void)\b.*[(){};=]'
+        r'|#include|=>|->|\w+\([^)]*\)\s*[{:]', re.I)
+    MATH_PATTERN = re.compile(
+        r'\$[^$]+\$|\\(?:frac|sum|int|sqrt|lim)|[∑∫√∞≤≥≠±×÷]|\d\s*[+*/^=<>]\s*\(?\d|\d\s+-\s+\d|[a-z]\s*[\^=]\s*\d|\d\s*[a-z]\s*[-+=]', re.I)
+    KEYWORDS = (
+        '为什么', '证明', '推导', '计算', '求解', '方程', '积分', '导数', '概率', '算法', '复杂度', '分析', '比较',
+        '设计', '方案', '优化', '调试', '报错', '原因', '区别', '步骤', '规划', '推理', '翻译', '总结'
+    )
+
+    def __init__(self, default_route='auto', fast_max_chars=60, chat_defaults=None):
+        """
+        Args:
+            default_route: 全局默认路由，auto 表示按启发式规则选择，fast/deep 表示固定使用对应模型
+            fast_max_chars: 超过该字数的消息走推理模型
+            chat_defaults: {open_id 或 chat_id: 'fast'/'deep'} 的会话默认路由
+        """
+        if default_route not in ('auto', FAST, DEEP):
+            raise ValueError(f"无效的默认路由: {default_route}")
+        self.default_route = default_route
+        self.fast_max_chars = fast_max_chars
+        self.chat_defaults = dict(chat_defaults or {})
+
+    @staticmethod
+    def parse_chat_defaults(value):
+        """解析 'ou_xxx:deep,oc_yyy:fast' 格式的会话默认路由配置"""
+        defaults = {}
+        for item in (value or '').split(','):
+            chat_id, _, route = item.strip().partition(':')
+            route = route.strip().lower()
+            if chat_id and route in ROUTE_MODELS:
+                defaults[chat_id.strip()] = route
+            elif item.strip():
+                logger.warning("忽略无效的会话默认路由配置: %s", item)
+        return defaults
+
+    def route(self, user_msg, chat_id=None, user_open_id=None):
+        """选择模型，返回 Route
+
+        Args:
+            chat_id: 消息所在会话（oc_），优先匹配会话默认路由
+            user_open_id: 发送者（ou_），会话未配置时按用户匹配
+        """
+        text = user_msg.strip()
+        for prefix, name in self.PREFIXES:
+            if text.startswith(prefix):
+                return self._route(name, 'prefix', text[len(prefix):].strip())
+        name = (self.chat_defaults.get(chat_id) if chat_id else None) or \
+            (self.chat_defaults.get(user_open_id) if user_open_id else None)
+        if name:
+            return self._route(name, 'chat_default', text)
+        if self.default_route != 'auto':
+            return self._route(self.default_route, 'default', text)
+        if len(text) > self.fast_max_chars:
+            return self._route(DEEP, 'length', text)
+        if self.CODE_PATTERN.search(text):
+            return self._route(DEEP, 'code', text)
+        if self.MATH_PATTERN.search(text):
+            return self._route(DEEP, 'math', text)
+        if any(keyword in text for keyword in self.KEYWORDS):
+            return self._route(DEEP, 'keyword', text)
+        return self._route(FAST, 'simple', text)
+
+    @staticmethod
+    def _route(name, reason, text):
+        return Route(name, ROUTE_MODELS[name], reason, text)
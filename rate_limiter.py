@@ -0,0 +1,214 @@
+import asyncio
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+
+# 原子地补充并扣减令牌，令牌不足时不扣减，返回需要等待的毫秒数；使用 Redis 服务端时钟避免多机时钟偏差
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = math.ceil((requested - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate) + 1000)
+return wait
+"""
+
+
+class TokenBucket:
+    """进程内令牌桶，按每分钟额度匀速补充"""
+
+    def __init__(self, per_minute, burst=None):
+        """
+        Args:
+            per_minute: 每分钟补充的令牌数
+            burst: 桶容量（允许的瞬时突发量），默认等于每分钟额度
+        """
+        self.capacity = float(burst if burst is not None else per_minute)
+        self.rate = float(per_minute) / 60.0
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    async def try_take(self, amount):
+        """尝试扣减令牌，成功返回 0，否则返回需要等待的秒数"""
+        amount = min(amount, self.capacity)
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+        if self._tokens >= amount:
+            self._tokens -= amount
+            return 0
+        return (amount - self._tokens) / self.rate
+
+
+class RedisTokenBucket:
+    """基于 Redis + Lua 的共享令牌桶，多个进程/副本共同遵守同一个账号级额度"""
+
+    def __init__(self, redis_store, key, per_minute):
+        self.redis_store = redis_store
+        self.key = key
+        self.capacity = float(per_minute)
+        # Lua 脚本中按毫秒计算
+        self.rate_ms = self.capacity / 60000.0
+
+    async def try_take(self, amount):
+        amount = min(amount, self.capacity)
+        wait_ms = await self.redis_store.client.eval(TOKEN_BUCKET_SCRIPT, 1, self.key, self.capacity, self.rate_ms, amount)
+        return int(wait_ms) / 1000.0
+
+
+async def acquire_tokens(bucket, amount):
+    """从令牌桶扣减令牌，不足时等待补充"""
+    while True:
+        try:
+            wait = await bucket.try_take(amount)
+        except Exception as e:
+            # 共享令牌桶不可用时放行，由服务端限流兜底
+            logger.error("令牌桶检查失败，跳过限流: %s", e)
+            return
+        if wait <= 0:
+            return
+        await asyncio.sleep(wait)
+
+
+class AIMDConcurrencyLimiter:
+    """加性增、乘性减的并发上限
+
+    每次成功把上限增加 increase_step / 当前上限（约每轮增加 increase_step），
+    遇到限流时把上限乘以 decrease_factor，最低不低于 min_limit。
+    """
+
+    def __init__(self, max_limit, min_limit=1, increase_step=1.0, decrease_factor=0.5):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        # 在首次使用时创建，保证与调用方的事件循环绑定
+        self._condition = None
+
+    async def acquire(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < max(int(self.limit), self.min_limit))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        if self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + self.increase_step / self.limit)
+
+    def on_throttled(self):
+        previous = self.limit
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        if int(previous) != int(self.limit):
+            logger.warning("DeepSeek 触发限流，并发上限由 %d 降为 %d", previous, self.limit)
+
+
+class RateLimiter:
+    """DeepSeek 客户端侧限流器
+
+    请求前按 RPM 与估算 TPM 令牌桶排队，并通过 AIMD 并发上限控制在途请求数；
+    遇到 429/5xx 时按指数退避加随机抖动重试，优先遵守 Retry-After。
+    """
+
+    RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+    THROTTLE_STATUS = (429, 503)
+
+    def __init__(self, rpm=0, tpm=0, max_concurrency=50, max_retries=3, base_delay=1.0, max_delay=20.0,
+                 redis_store=None, key_prefix='ratelimit:deepseek'):
+        """
+        Args:
+            rpm: 每分钟请求数上限，0 表示不限制
+            tpm: 每分钟 token 数上限（估算值），0 表示不限制
+            max_concurrency: 在途请求数上限，限流时自动下调
+            max_retries: 可重试错误的最大重试次数
+            base_delay: 指数退避的初始等待秒数
+            max_delay: 单次等待的最长秒数
+            redis_store: AsyncRedisStore 实例，设置后 RPM/TPM 令牌桶在多个进程之间共享
+            key_prefix: Redis 令牌桶键前缀
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.concurrency = AIMDConcurrencyLimiter(max_concurrency)
+        self._buckets = []
+        for name, per_minute in (('rpm', rpm), ('tpm', tpm)):
+            if per_minute <= 0:
+                self._buckets.append(None)
+            elif redis_store is not None:
+                self._buckets.append(RedisTokenBucket(redis_store, f"{key_prefix}:{name}", per_minute))
+            else:
+                self._buckets.append(TokenBucket(per_minute))
+        self.throttled = 0
+        self.retries = 0
+
+    @asynccontextmanager
+    async def slot(self, estimated_tokens=0):
+        """获取一次请求的发送许可，退出时释放并发名额"""
+        rpm_bucket, tpm_bucket = self._buckets
+        if rpm_bucket is not None:
+            await acquire_tokens(rpm_bucket, 1)
+        if tpm_bucket is not None and estimated_tokens > 0:
+            await acquire_tokens(tpm_bucket, estimated_tokens)
+        await self.concurrency.acquire()
+        try:
+            yield
+        finally:
+            await self.concurrency.release()
+
+    def should_retry(self, status, attempt):
+        return status in self.RETRYABLE_STATUS and attempt < self.max_retries
+
+    def record_success(self):
+        self.concurrency.on_success()
+
+    def record_failure(self, status):
+        if status in self.THROTTLE_STATUS:
+            self.throttled += 1
+            self.concurrency.on_throttled()
+
+    def retry_delay(self, attempt, retry_after=None):
+        """计算第 attempt 次重试前的等待秒数，带 Retry-After 时以其为准"""
+        self.retries += 1
+        seconds = parse_retry_after(retry_after)
+        if seconds is not None:
+            return min(seconds, self.max_delay)
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        # 随机抖动，避免多个请求同时重试
+        return random.uniform(delay / 2, delay)
+
+
+def parse_retry_after(value):
+    """解析 Retry-After 头，支持秒数和 HTTP 日期两种格式"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import time
+
+from metrics import READY
+
+logger = logging.getLogger(__name__)
+
+# 检查通过时的结果
+OK = 'ok'
+
+
+class ReadinessProbe:
+    """并行执行就绪检查并缓存结果
+
+    存活检查（/healthz）只说明进程在运行；就绪检查（/readyz）要求预热已完成且所有依赖检查通过，
+    编排系统据此只把流量转发给已预热的实例。各项检查并行执行、单独限时，通过的结果缓存 cache_ttl 秒，
+    避免频繁的探针请求压到依赖上。
+    """
+
+    def __init__(self, timeout=2.0, cache_ttl=5.0):
+        """
+        Args:
+            timeout: 单项检查的超时时间（秒）
+            cache_ttl: 检查通过后结果的缓存秒数
+        """
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.warmed = False
+        self._checks = {}
+        # (检查时间, {检查名: 结果})
+        self._cached = None
+
+    def add_check(self, name, coro_func):
+        """注册一项检查，coro_func 抛出异常或超时即视为未就绪"""
+        self._checks[name] = coro_func
+
+    def mark_warmed(self):
+        self.warmed = True
+
+    async def check(self):
+        """执行就绪检查
+
+        Returns:
+            (是否就绪, {检查名: 'ok' 或失败原因})
+        """
+        now = time.monotonic()
+        if self._cached is not None and now - self._cached[0] < self.cache_ttl:
+            results = dict(self._cached[1])
+        else:
+            names = list(self._checks)
+            outcomes = await asyncio.gather(*(self._run(name) for name in names))
+            results = dict(zip(names, outcomes))
+            # 只缓存通过的结果，依赖恢复后下一次探针即可重新就绪
+            self._cached = (now, dict(results)) if all(result == OK for result in results.values()) else None
+        results['warmup'] = OK if self.warmed else 'pending'
+        ready = all(result == OK for result in results.values())
+        READY.set(1 if ready else 0)
+        return ready, results
+
+    async def _run(self, name):
+        try:
+            await asyncio.wait_for(self._checks[name](), self.timeout)
+            return OK
+        except asyncio.TimeoutError:
+            result = f'timeout after {self.timeout}s'
+        except Exception as e:
+            result = f'{type(e).__name__}: {e}'
+        logger.warning("就绪检查 %s 未通过: %s", name, result)
+        return result
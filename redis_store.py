@@ -0,0 +1,110 @@
+import asyncio
+import json
+import logging
+
+import redis.asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRedisStore:
+    """基于 redis.asyncio 的异步 Redis 访问层
+
+    消息热路径上的多个命令通过非事务 pipeline 合并为一次网络往返：
+    去重 + 读取对话历史为一次，追加对话消息 + 记录异常为一次。
+    """
+
+    def __init__(self, host, port=6379, db=0, max_connections=32, pool_timeout=5,
+                 socket_connect_timeout=5, socket_timeout=5, health_check_interval=30):
+        """
+        Args:
+            host: Redis 主机地址
+            port: Redis 端口
+            db: Redis 数据库编号
+            max_connections: 连接池大小，建议不小于并发 worker 数
+            pool_timeout: 连接池耗尽时等待空闲连接的秒数
+            socket_connect_timeout: 建立连接超时（秒）
+            socket_timeout: 读写超时（秒）
+            health_check_interval: 空闲连接健康检查间隔（秒）
+        """
+        self._pool_kwargs = dict(
+            host=host,
+            port=port,
+            db=db,
+            max_connections=max_connections,
+            timeout=pool_timeout,
+            decode_responses=True,
+            socket_connect_timeout=socket_connect_timeout,
+            socket_timeout=socket_timeout,
+            retry_on_timeout=True,
+            health_check_interval=health_check_interval
+        )
+        self._client = None
+        self._client_loop = None
+
+    @property
+    def client(self):
+        """获取当前事件循环上的 Redis 客户端，连接池与事件循环绑定，循环变化时重建"""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            pool = aioredis.BlockingConnectionPool(**self._pool_kwargs)
+            self._client = aioredis.Redis(connection_pool=pool)
+            self._client_loop = loop
+        return self._client
+
+    async def close(self):
+        """关闭连接池，供应用关闭时调用"""
+        if self._client is not None:
+            try:
+                await self._client.aclose()
+            except Exception as e:
+                logger.error("关闭Redis连接池失败: %s", e)
+        self._client = None
+        self._client_loop = None
+
+    async def claim_event_and_load_context(self, event_id, user_open_id, event_expire, conversation_store):
+        """一次往返内完成事件去重并读取用户对话历史和摘要
+
+        对话历史存储不支持 pipeline（如内存存储）时，单独读取，不产生额外的 Redis 往返。
+
+        Returns:
+            (是否首次处理该事件, 对话历史列表, 较早消息的摘要或 None)
+        """
+        pipe = self.client.pipeline(transaction=False)
+        pipe.set(f"event:{event_id}", "processed", ex=event_expire, nx=True)
+        queued = conversation_store.queue_load(pipe, user_open_id) if user_open_id else 0
+        results = await pipe.execute()
+        claimed = bool(results[0])
+        context, summary = [], None
+        if queued:
+            context, summary = await conversation_store.decode_load(user_open_id, results[1:1 + queued])
+        elif user_open_id and claimed:
+            context = await conversation_store.load(user_open_id)
+            summary = await conversation_store.load_summary(user_open_id)
+        return claimed, context, summary
+
+    async def load_context(self, user_open_id, conversation_store):
+        """一次往返内读取用户对话历史和摘要，用于去重已在入队时完成的事件
+
+        Returns:
+            (对话历史列表, 较早消息的摘要或 None)
+        """
+        if not user_open_id:
+            return [], None
+        pipe = self.client.pipeline(transaction=False)
+        queued = conversation_store.queue_load(pipe, user_open_id)
+        if not queued:
+            return await conversation_store.load(user_open_id), await conversation_store.load_summary(user_open_id)
+        return await conversation_store.decode_load(user_open_id, await pipe.execute())
+
+    async def save_turns_and_error(self, conversation_store, user_open_id=None, turns=None,
+                                   error_event_id=None, error_info=None, error_expire=86400):
+        """一次往返内追加对话消息并记录异常事件，两者均可省略"""
+        pipe = self.client.pipeline(transaction=False)
+        if user_open_id and turns:
+            if not conversation_store.queue_append(pipe, user_open_id, turns):
+                await conversation_store.append(user_open_id, turns)
+        if error_event_id and error_info is not None:
+            pipe.set(f"error:event:{error_event_id}", json.dumps(error_info), ex=error_expire)
+        if len(pipe):
+            await pipe.execute()
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import re
+import time
+from collections import OrderedDict
+
+from metrics import RESPONSE_CACHE_RESULTS
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """重复提问的回复缓存
+
+    进程内 LRU 作为第一级，Redis 作为多进程共享的第二级，两级均带过期时间。
+    缓存键由规范化后的提问、模型、温度和上下文指纹共同决定。
+    """
+
+    _WHITESPACE = re.compile(r'\s+')
+    _TRAILING_PUNCTUATION = '?？!！。.~～ '
+
+    def __init__(self, redis_store=None, max_entries=1000, local_ttl=300, redis_ttl=3600,
+                 max_entry_chars=8000, max_temperature=0.5, max_context_turns=0, key_prefix='response_cache'):
+        """
+        Args:
+            redis_store: AsyncRedisStore 实例，为 None 时只使用进程内缓存
+            max_entries: 进程内 LRU 最大条目数
+            local_ttl: 进程内缓存过期秒数
+            redis_ttl: Redis 缓存过期秒数
+            max_entry_chars: 单条回复最大字符数，超出不缓存
+            max_temperature: 温度高于该值的请求回复随机性大，不缓存
+            max_context_turns: 上下文条数超过该值视为依赖上下文的请求，不缓存；默认只缓存无上下文的提问
+            key_prefix: Redis 键前缀
+        """
+        self.redis_store = redis_store
+        self.max_entries = max_entries
+        self.local_ttl = local_ttl
+        self.redis_ttl = redis_ttl
+        self.max_entry_chars = max_entry_chars
+        self.max_temperature = max_temperature
+        self.max_context_turns = max_context_turns
+        self.key_prefix = key_prefix
+        # key -> (过期时间, 回复)
+        self._local = OrderedDict()
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.oversized = 0
+
+    @classmethod
+    def normalize(cls, prompt):
+        """规范化提问：合并空白、忽略大小写和结尾标点"""
+        return cls._WHITESPACE.sub(' ', prompt).strip().casefold().rstrip(cls._TRAILING_PUNCTUATION)
+
+    @staticmethod
+    def context_fingerprint(context):
+        if not context:
+            return ''
+        payload = json.dumps([[turn.get('role'), turn.get('content')] for turn in context], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def cacheable(self, temperature, context):
+        """高温度或依赖上下文的请求不缓存
+
+        系统提示词和摘要等 system 消息不计入上下文条数，但仍计入缓存键，内容变化后不会命中旧的缓存。
+        """
+        turns = sum(1 for message in context or [] if message.get('role') != 'system')
+        if temperature > self.max_temperature or turns > self.max_context_turns:
+            self.skipped += 1
+            RESPONSE_CACHE_RESULTS.labels('skipped').inc()
+            return False
+        return True
+
+    def make_key(self, prompt, model, temperature, context=None):
+        payload = json.dumps([self.normalize(prompt), model, temperature, self.context_fingerprint(context)], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _redis_key(self, key):
+        return f"{self.key_prefix}:{key}"
+
+    def _get_local(self, key):
+        entry = self._local.get(key)
+        if entry is None:
+            return None
+        expire_at, value = entry
+        if expire_at < time.monotonic():
+            del self._local[key]
+            return None
+        self._local.move_to_end(key)
+        return value
+
+    def _set_local(self, key, value):
+        self._local[key] = (time.monotonic() + self.local_ttl, value)
+        self._local.move_to_end(key)
+        while len(self._local) > self.max_entries:
+            self._local.popitem(last=False)
+
+    async def get(self, key):
+        """依次查询进程内缓存和 Redis，Redis 命中时回填进程内缓存"""
+        value = self._get_local(key)
+        if value is not None:
+            self.local_hits += 1
+            RESPONSE_CACHE_RESULTS.labels('local_hit').inc()
+            return value
+        if self.redis_store is not None:
+            try:
+                value = await self.redis_store.client.get(self._redis_key(key))
+            except Exception as e:
+                logger.error("读取Redis回复缓存失败: %s", e)
+                value = None
+            if value is not None:
+                self.redis_hits += 1
+                RESPONSE_CACHE_RESULTS.labels('redis_hit').inc()
+                self._set_local(key, value)
+                return value
+        self.misses += 1
+        RESPONSE_CACHE_RESULTS.labels('miss').inc()
+        return None
+
+    async def set(self, key, value):
+        if not value:
+            return
+        if len(value) > self.max_entry_chars:
+            self.oversized += 1
+            RESPONSE_CACHE_RESULTS.labels('oversized').inc()
+            return
+        self._set_local(key, value)
+        if self.redis_store is not None:
+            try:
+                await self.redis_store.client.set(self._redis_key(key), value, ex=self.redis_ttl)
+            except Exception as e:
+                logger.error("写入Redis回复缓存失败: %s", e)
+
+    def stats(self):
+        """返回命中统计"""
+        lookups = self.local_hits + self.redis_hits + self.misses
+        return {
+            'local_hits': self.local_hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'skipped': self.skipped,
+            'oversized': self.oversized,
+            'hit_rate': (self.local_hits + self.redis_hits) / lookups if lookups else 0.0,
+            'local_entries': len(self._local)
+        }
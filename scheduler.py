@@ -0,0 +1,145 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import deque
+
+from metrics import QUEUE_DEPTH, QUEUE_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """工作队列已满，调用方应拒绝本次请求（飞书会自动重推事件）"""
+
+
+class KeyedScheduler:
+    """按键保序、跨键并行的任务调度器
+
+    同一个键（如用户 open_id）的任务按提交顺序逐个执行，不同键的任务由
+    concurrency 个 worker 并行执行。就绪的键按轮转方式排队，每个键每轮只执行
+    一个任务，加上单键排队上限，保证单个高频用户无法挤占其他用户。
+    键的队列清空后立即回收。必须在事件循环内调用 start() 后使用。
+    """
+
+    def __init__(self, concurrency=16, max_pending=200, max_pending_per_key=20, name='scheduler'):
+        """
+        Args:
+            concurrency: 全局并发上限（worker 数量）
+            max_pending: 所有键排队任务总数上限，超出后提交方等待
+            max_pending_per_key: 单个键排队任务上限，超出直接拒绝
+            name: 日志名称
+        """
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.max_pending_per_key = max_pending_per_key
+        self.name = name
+        # key -> 待执行任务队列，仅保存有任务的键
+        self._queues = {}
+        # 已在就绪队列中或正在执行的键，保证同一键不会被两个 worker 同时处理
+        self._scheduled = set()
+        self._ready = None
+        self._not_full = None
+        self._idle = None
+        self._pending = 0
+        self._workers = []
+        self._anonymous_keys = itertools.count()
+        self._depth = QUEUE_DEPTH.labels(name)
+        self._wait = QUEUE_WAIT_SECONDS.labels(name)
+
+    def start(self):
+        self._ready = asyncio.Queue()
+        self._not_full = asyncio.Condition()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._workers = [asyncio.get_running_loop().create_task(self._worker(i)) for i in range(self.concurrency)]
+
+    @property
+    def pending(self):
+        """排队中及执行中的任务总数"""
+        return self._pending
+
+    @property
+    def active_keys(self):
+        return len(self._queues)
+
+    async def put(self, key, coro_func, args=(), timeout=None):
+        """提交任务，由 worker 以 coro_func(*args) 方式执行
+
+        Args:
+            key: 保序键，为 None 时任务不与其他任务保序
+            timeout: 总队列满时最多等待的秒数，超时抛出 QueueFullError
+        """
+        key = self._check_key(key)
+        async with self._not_full:
+            try:
+                await asyncio.wait_for(self._not_full.wait_for(lambda: self._pending < self.max_pending), timeout=timeout)
+            except asyncio.TimeoutError:
+                raise QueueFullError(f"工作队列已满 ({self.max_pending})，拒绝新任务")
+            self._pending += 1
+            self._idle.clear()
+        self._enqueue(key, coro_func, args)
+
+    def put_nowait(self, key, coro_func, args=()):
+        """不等待地提交任务，队列已满时立即抛出 QueueFullError，只能在调度器所在的事件循环线程中调用"""
+        key = self._check_key(key)
+        if self._pending >= self.max_pending:
+            raise QueueFullError(f"工作队列已满 ({self.max_pending})，拒绝新任务")
+        self._pending += 1
+        self._idle.clear()
+        self._enqueue(key, coro_func, args)
+
+    def _check_key(self, key):
+        if key is None:
+            return ('anonymous', next(self._anonymous_keys))
+        queue = self._queues.get(key)
+        if queue is not None and len(queue) >= self.max_pending_per_key:
+            raise QueueFullError(f"单个会话排队任务已达上限 ({self.max_pending_per_key})，拒绝新任务")
+        return key
+
+    def _enqueue(self, key, coro_func, args):
+        self._depth.set(self._pending)
+        queue = self._queues.setdefault(key, deque())
+        queue.append((coro_func, args, time.monotonic()))
+        if key not in self._scheduled:
+            self._scheduled.add(key)
+            self._ready.put_nowait(key)
+
+    async def _worker(self, index):
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            coro_func, args, enqueued_at = queue.popleft()
+            self._wait.observe(time.monotonic() - enqueued_at)
+            try:
+                await coro_func(*args)
+            except Exception as e:
+                logger.exception("%s worker-%s 处理任务异常: %s", self.name, index, e)
+            finally:
+                if queue:
+                    # 放回就绪队列尾部，让其他键先执行
+                    self._ready.put_nowait(key)
+                else:
+                    del self._queues[key]
+                    self._scheduled.discard(key)
+                async with self._not_full:
+                    self._pending -= 1
+                    self._depth.set(self._pending)
+                    self._not_full.notify()
+                    if self._pending == 0:
+                        self._idle.set()
+
+    async def join(self, timeout=None):
+        """等待所有任务执行完毕，超时返回 False"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stop(self):
+        """取消所有 worker，未执行的任务被丢弃"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
@@ -0,0 +1,154 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class _LeaderCancelled(Exception):
+    """发起请求的协程被取消，等待方需要重新发起"""
+
+
+class SingleFlight:
+    """合并并发的相同请求，同一时刻每个键只有一个上游请求
+
+    进程内通过共享 Future 合并；配置 redis_store 后，还会通过 Redis 锁键和结果键
+    在多个进程之间协调：拿到锁的进程负责请求上游，其余进程轮询结果键。
+    结果需可 JSON 序列化。
+    """
+
+    def __init__(self, redis_store=None, lock_ttl=120, result_ttl=10, poll_interval=0.2, key_prefix='singleflight'):
+        """
+        Args:
+            redis_store: AsyncRedisStore 实例，为 None 时只在进程内合并
+            lock_ttl: Redis 锁键过期秒数，应大于单次上游请求的最长耗时
+            result_ttl: Redis 结果键保留秒数，供其他进程中等待的请求读取
+            poll_interval: 其他进程等待结果时的轮询间隔（秒）
+            key_prefix: Redis 键前缀
+        """
+        self.redis_store = redis_store
+        self.lock_ttl = lock_ttl
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.key_prefix = key_prefix
+        self._inflight = {}
+        self.leaders = 0
+        self.shared = 0
+        self.remote_shared = 0
+
+    @staticmethod
+    def make_key(payload):
+        """根据请求体生成合并键"""
+        data = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    async def do(self, key, coro_func):
+        """执行 coro_func()，并发的相同键请求共享同一个结果"""
+        while True:
+            future = self._inflight.get(key)
+            if future is None:
+                break
+            self.shared += 1
+            try:
+                # shield 保证等待方被取消时不会影响发起方
+                return await asyncio.shield(future)
+            except _LeaderCancelled:
+                continue
+
+        future = asyncio.get_running_loop().create_future()
+        # 没有等待方时也要取走异常，避免“exception was never retrieved”告警
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        self.leaders += 1
+        try:
+            result = await self._run(key, coro_func)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.set_exception(_LeaderCancelled())
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _run(self, key, coro_func):
+        if self.redis_store is None:
+            return await coro_func()
+        client = self.redis_store.client
+        lock_key = f"{self.key_prefix}:lock:{key}"
+        result_key = f"{self.key_prefix}:result:{key}"
+        token = uuid.uuid4().hex
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.get(result_key)
+            pipe.set(lock_key, token, nx=True, ex=self.lock_ttl)
+            cached, acquired = await pipe.execute()
+        except Exception as e:
+            logger.error("Redis请求合并协调失败，直接请求上游: %s", e)
+            return await coro_func()
+        if cached is not None:
+            self.remote_shared += 1
+            if acquired:
+                await self._release(lock_key, token)
+            return json.loads(cached)
+        if not acquired:
+            result = await self._wait_remote(lock_key, result_key)
+            if result is not None:
+                self.remote_shared += 1
+                return json.loads(result)
+            # 持锁进程失败或超时，由本进程自行请求
+            return await coro_func()
+        try:
+            result = await coro_func()
+        except BaseException:
+            await self._release(lock_key, token)
+            raise
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.set(result_key, json.dumps(result, ensure_ascii=False), ex=self.result_ttl)
+            pipe.delete(lock_key)
+            await pipe.execute()
+        except Exception as e:
+            logger.error("写入Redis合并结果失败: %s", e)
+        return result
+
+    async def _wait_remote(self, lock_key, result_key):
+        """等待其他进程写入结果，锁消失仍无结果或超时返回 None"""
+        client = self.redis_store.client
+        deadline = time.monotonic() + self.lock_ttl
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                pipe = client.pipeline(transaction=False)
+                pipe.get(result_key)
+                pipe.exists(lock_key)
+                result, locked = await pipe.execute()
+            except Exception as e:
+                logger.error("轮询Redis合并结果失败: %s", e)
+                return None
+            if result is not None:
+                return result
+            if not locked:
+                return None
+        return None
+
+    async def _release(self, lock_key, token):
+        try:
+            client = self.redis_store.client
+            if await client.get(lock_key) == token:
+                await client.delete(lock_key)
+        except Exception as e:
+            logger.error("释放Redis合并锁失败: %s", e)
+
+    def stats(self):
+        return {
+            'leaders': self.leaders,
+            'shared': self.shared,
+            'remote_shared': self.remote_shared,
+            'inflight': len(self._inflight)
+        }
@@ -0,0 +1,147 @@
+import json
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# 流式增量的类型
+CONTENT = 'content'
+REASONING = 'reasoning'
+FINISH_REASON = 'finish_reason'
+USAGE = 'usage'
+
+StreamDelta = namedtuple('StreamDelta', ['kind', 'value'])
+
+_DONE = '[DONE]'
+_json_decode = json.JSONDecoder().decode
+
+
+class SSEDecoder:
+    """增量 SSE 解码器，在字节缓冲上按空行切分事件
+
+    只解码完整的事件，跨多次 TCP 读取的事件会在收齐后一次返回；
+    支持多行 data 字段，忽略以冒号开头的注释（keep-alive）及 event/id/retry 字段。
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        # 已确认不含事件分隔符的前缀长度，避免每次从头查找
+        self._scanned = 0
+        self._pending_cr = False
+
+    def feed(self, data):
+        """写入新读到的字节，返回其中完整事件的 data 内容（str）列表"""
+        if not data:
+            return []
+        buffer = self._buffer
+        buffer += data
+        if self._pending_cr or b'\r' in data:
+            self._normalize_newlines()
+        events = []
+        start = 0
+        search_from = max(self._scanned - 1, 0)
+        while True:
+            end = buffer.find(b'\n\n', search_from)
+            if end < 0:
+                break
+            event = self._parse_event(buffer, start, end)
+            if event is not None:
+                events.append(event)
+            start = search_from = end + 2
+        if start:
+            del buffer[:start]
+        self._scanned = len(buffer)
+        return events
+
+    def flush(self):
+        """流结束时处理缓冲区中未以空行结尾的最后一个事件"""
+        buffer = self._buffer
+        event = self._parse_event(buffer, 0, len(buffer)) if buffer.strip() else None
+        buffer.clear()
+        self._scanned = 0
+        self._pending_cr = False
+        return [event] if event is not None else []
+
+    def _normalize_newlines(self):
+        # 统一为 \n；末尾单独的 \r 可能是 \r\n 的前半部分，等下一次读取再处理
+        buffer = self._buffer
+        self._pending_cr = buffer.endswith(b'\r')
+        if self._pending_cr:
+            del buffer[-1:]
+        buffer[:] = bytes(buffer).replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        if self._pending_cr:
+            buffer += b'\r'
+        self._scanned = 0
+
+    @staticmethod
+    def _parse_event(buffer, start, end):
+        # 单行 data 是最常见的情况，直接切片避免逐行拆分
+        if buffer.startswith(b'data:', start) and buffer.find(b'\n', start, end) < 0:
+            value_start = start + 5
+            if value_start < end and buffer[value_start] == 0x20:
+                value_start += 1
+            return buffer[value_start:end].decode('utf-8', 'replace')
+        data_lines = []
+        for line in bytes(buffer[start:end]).split(b'\n'):
+            if not line or line.startswith(b':'):
+                continue
+            field, _, value = line.partition(b':')
+            if field == b'data':
+                data_lines.append(value[1:] if value.startswith(b' ') else value)
+        if not data_lines:
+            return None
+        return b'\n'.join(data_lines).decode('utf-8', 'replace')
+
+
+class ChatStreamDecoder:
+    """把 OpenAI 兼容的 chat.completion.chunk 流解码为类型化的增量
+
+    每个完整事件可能产生 reasoning、content、finish_reason、usage 多个增量；
+    收到 [DONE] 后 done 为 True。
+    """
+
+    def __init__(self):
+        self._sse = SSEDecoder()
+        self.done = False
+        self.malformed = 0
+
+    def feed(self, data):
+        """写入新读到的字节，返回解码出的 StreamDelta 列表"""
+        return self._decode(self._sse.feed(data))
+
+    def flush(self):
+        return self._decode(self._sse.flush())
+
+    def _decode(self, events):
+        deltas = []
+        for event in events:
+            if self.done:
+                break
+            if event == _DONE:
+                self.done = True
+                break
+            try:
+                data = _json_decode(event)
+            except ValueError:
+                self.malformed += 1
+                logger.warning("忽略无法解析的流式事件，长度: %s", len(event))
+                continue
+            choices = data.get('choices')
+            if choices:
+                choice = choices[0]
+                delta = choice.get('delta')
+                if delta:
+                    # R1 模型先输出 reasoning_content，此时 content 为 null
+                    reasoning = delta.get('reasoning_content')
+                    if reasoning:
+                        deltas.append(StreamDelta(REASONING, reasoning))
+                    content = delta.get('content')
+                    if content:
+                        deltas.append(StreamDelta(CONTENT, content))
+                finish_reason = choice.get('finish_reason')
+                if finish_reason:
+                    deltas.append(StreamDelta(FINISH_REASON, finish_reason))
+            usage = data.get('usage')
+            if usage:
+                deltas.append(StreamDelta(USAGE, usage))
+        return deltas
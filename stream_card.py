@@ -0,0 +1,156 @@
+import asyncio
+import json
+import logging
+
+from feishu_sender import FeishuAPIError
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingCardReply:
+    """把流式回复渐进渲染到同一张可更新的飞书卡片
+
+    收到首个增量（正文或思考过程）时发送一张交互卡片，推理模型思考阶段先显示占位提示，
+    之后按时间和字数合并增量，通过 patch 接口更新卡片内容，流结束时做最后一次刷新。
+    """
+
+    # 思考过程仅展示末尾部分，避免卡片超出大小限制
+    MAX_REASONING_CHARS = 3000
+    MAX_CONTENT_CHARS = 20000
+    # 流正常结束但没有正文（如只输出了思考过程）时的提示
+    EMPTY_NOTICE = '⚠️ 未生成回复内容，请稍后再试'
+
+    def __init__(self, sender, receive_id, receive_id_type='open_id', update_interval=0.5,
+                 min_update_chars=20, show_reasoning=False, uuid=None):
+        """
+        Args:
+            sender: FeishuSender 实例
+            receive_id: 接收者 ID
+            receive_id_type: 接收者 ID 类型
+            update_interval: 两次卡片更新的最小间隔（秒），飞书单条消息更新限频 5 QPS
+            min_update_chars: 未超过两倍间隔时，累计新增字数达到该值才更新
+            show_reasoning: 是否展示可折叠的思考过程（R1 模型的 reasoning_content）
+            uuid: 发送卡片的幂等键，重试不会产生重复卡片
+        """
+        self.sender = sender
+        self.uuid = uuid
+        self.receive_id = receive_id
+        self.receive_id_type = receive_id_type
+        self.update_interval = update_interval
+        self.min_update_chars = min_update_chars
+        self.show_reasoning = show_reasoning
+        self.message_id = None
+        self._content = []
+        self._reasoning = []
+        self._pending_chars = 0
+        self._last_update = 0.0
+        self._finished = False
+
+    @property
+    def created(self):
+        return self.message_id is not None
+
+    @property
+    def content(self):
+        return ''.join(self._content)
+
+    @property
+    def reasoning(self):
+        return ''.join(self._reasoning)
+
+    def _build_card(self, finished=False, notice=None):
+        elements = []
+        reasoning = self.reasoning
+        if self.show_reasoning and reasoning:
+            if len(reasoning) > self.MAX_REASONING_CHARS:
+                reasoning = '...' + reasoning[-self.MAX_REASONING_CHARS:]
+            elements.append({
+                "tag": "collapsible_panel",
+                "expanded": False,
+                "header": {"title": {"tag": "markdown", "content": "💭 思考过程"}},
+                "elements": [{"tag": "markdown", "content": reasoning}]
+            })
+        content = self.content
+        if len(content) > self.MAX_CONTENT_CHARS:
+            content = content[:self.MAX_CONTENT_CHARS] + '\n\n...(内容过长已截断)'
+        if not content:
+            content = "🤔 思考中..." if not finished else ""
+        elif not finished:
+            content += " ▌"
+        if notice:
+            content = f"{content}\n\n{notice}" if content else notice
+        elements.append({"tag": "markdown", "content": content or " "})
+        return {
+            "schema": "2.0",
+            "config": {"update_multi": True},
+            "body": {"elements": elements}
+        }
+
+    async def _create(self):
+        self.message_id = await self.sender.send_message(
+            self.receive_id,
+            "interactive",
+            json.dumps(self._build_card(), ensure_ascii=False),
+            receive_id_type=self.receive_id_type,
+            uuid=self.uuid
+        )
+        self._pending_chars = 0
+        self._last_update = asyncio.get_running_loop().time()
+        logger.info("流式卡片已创建，消息ID: %s, 用户: %s", self.message_id, self.receive_id)
+
+    async def _update(self, finished=False, notice=None):
+        self._pending_chars = 0
+        self._last_update = asyncio.get_running_loop().time()
+        try:
+            await self.sender.patch_message(self.message_id, json.dumps(self._build_card(finished, notice), ensure_ascii=False))
+            return True
+        except FeishuAPIError as e:
+            # 中间更新失败不影响后续更新，最终刷新会带上全部内容
+            logger.warning("更新流式卡片失败: %s", e)
+            return False
+
+    def _should_update(self):
+        if self._pending_chars == 0:
+            return False
+        elapsed = asyncio.get_running_loop().time() - self._last_update
+        if elapsed < self.update_interval:
+            return False
+        return self._pending_chars >= self.min_update_chars or elapsed >= self.update_interval * 2
+
+    async def feed(self, chunk):
+        """追加一个流式增量，必要时创建或更新卡片"""
+        content = chunk.get('content') or ''
+        reasoning = chunk.get('reasoning_content') or ''
+        if content:
+            self._content.append(content)
+            self._pending_chars += len(content)
+        if reasoning:
+            self._reasoning.append(reasoning)
+            if self.show_reasoning:
+                self._pending_chars += len(reasoning)
+        if not self.created:
+            # 首个增量到达时立即发出卡片，不展示思考过程时先显示“思考中”占位，尽快给用户反馈
+            if content or reasoning:
+                await self._create()
+            return
+        if self._should_update():
+            await self._update()
+
+    async def finish(self, notice=None):
+        """流结束时做最后一次刷新，去掉输入中标记
+
+        Args:
+            notice: 附加在正文末尾的提示，例如生成中断的说明；没有正文且未指定时提示未生成回复
+        """
+        if self._finished:
+            return
+        self._finished = True
+        if not self.content and not notice:
+            notice = self.EMPTY_NOTICE
+        if not self.created:
+            await self._create()
+        # 最终刷新不受合并策略限制，但仍遵守最小更新间隔
+        wait = self.update_interval - (asyncio.get_running_loop().time() - self._last_update)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await self._update(finished=True, notice=notice)
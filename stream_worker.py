@@ -0,0 +1,124 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+
+# 工作进程只消费 Redis Stream 中的事件，不启动回调相关的工作池
+os.environ['APP_ROLE'] = 'stream-worker'
+
+import lark_oapi as lark
+from lark_oapi.api.im.v1 import P2ImMessageReceiveV1
+from prometheus_client import start_http_server
+
+import app as bot
+from event_stream import EventStreamConsumer
+
+logger = logging.getLogger(__name__)
+
+
+def build_consumer():
+    config = bot.config
+    return EventStreamConsumer(
+        bot.redis_store,
+        stream_key=bot.EVENT_STREAM_KEY,
+        group=config.get('EVENT_STREAM_GROUP', 'bot-workers'),
+        consumer=config.get('EVENT_STREAM_CONSUMER'),
+        dead_letter_key=config.get('EVENT_STREAM_DEAD_LETTER_KEY', f"{bot.EVENT_STREAM_KEY}:dead"),
+        concurrency=int(config.get('WORKER_POOL_SIZE', 16)),
+        batch_size=int(config.get('EVENT_STREAM_BATCH_SIZE', 16)),
+        claim_idle=float(config.get('EVENT_STREAM_CLAIM_IDLE', 60)),
+        max_deliveries=int(config.get('EVENT_STREAM_MAX_DELIVERIES', 3))
+    )
+
+
+async def handle_event(fields):
+    """处理一条 Stream 事件，失败时抛出异常，由消费者重新投递"""
+    data = lark.JSON.unmarshal(fields['payload'], P2ImMessageReceiveV1)
+    await bot.async_do_p2_im_message_receive_v1(data, from_stream=True)
+
+
+def preempt_event(fields):
+    """事件进入按用户排队之前调用，/停止、/清除上下文等立即取消该用户在本进程中进行中的生成"""
+    data = lark.JSON.unmarshal(fields['payload'], P2ImMessageReceiveV1)
+    bot.preempt_generation(data)
+
+
+async def notify_dead_letter(fields, deliveries):
+    """事件多次处理失败后告知用户，与普通模式下的错误提示一致"""
+    user_open_id = fields.get('key')
+    if user_open_id:
+        await bot.feishu_sender.send_text(user_open_id, '服务暂时不可用，请稍后再试', uuid=bot.message_uuid(fields.get('event_id')))
+
+
+async def run_worker(consumer):
+    # 工作进程不提供 HTTP 服务，指标通过独立端口暴露
+    metrics_port = int(bot.config.get('METRICS_PORT', 0))
+    if metrics_port:
+        start_http_server(metrics_port)
+        logger.info("指标服务已启动，端口: %s", metrics_port)
+    await bot.warm_up()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, consumer.stop)
+    shutdown_timeout = float(bot.config.get('WORKER_SHUTDOWN_TIMEOUT', 30))
+    try:
+        await consumer.run(handle_event, on_dead_letter=notify_dead_letter, on_receive=preempt_event)
+    finally:
+        # 未处理完的事件保持待确认状态，由其他消费者领取
+        if not await consumer.drain(timeout=shutdown_timeout):
+            logger.warning("事件未能在 %s 秒内处理完，剩余事件将由其他消费者领取", shutdown_timeout)
+        logger.info("Stream 消费者已停止，统计: %s", consumer.stats())
+        await bot.ds_client.close()
+        await bot.feishu_sender.close()
+        if bot.usage_accountant is not None:
+            await bot.usage_accountant.close()
+        await bot.redis_store.close()
+
+
+async def list_dead_letters(consumer, count):
+    try:
+        for entry_id, fields in await consumer.dead_letters(count=count):
+            print(json.dumps({
+                'id': entry_id,
+                'event_id': fields.get('event_id'),
+                'open_id': fields.get('key'),
+                'deliveries': fields.get('deliveries'),
+                'source_id': fields.get('source_id')
+            }, ensure_ascii=False))
+    finally:
+        await bot.redis_store.close()
+
+
+async def replay_dead_letters(consumer, entry_ids, count):
+    try:
+        replayed = await consumer.replay(entry_ids=entry_ids, count=count)
+        print(f"已重放 {replayed} 条死信事件")
+    finally:
+        await bot.redis_store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Redis Stream 事件消费进程及死信工具')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('run', help='消费事件（默认）')
+    list_parser = subparsers.add_parser('dead-letters', help='列出死信事件')
+    list_parser.add_argument('--count', type=int, default=20, help='最多列出的条数')
+    replay_parser = subparsers.add_parser('replay', help='把死信事件重新写回事件 Stream')
+    replay_parser.add_argument('ids', nargs='*', help='死信条目 ID，为空时按 --count 重放最早的死信')
+    replay_parser.add_argument('--count', type=int, default=100, help='未指定 ID 时重放的条数')
+    args = parser.parse_args()
+
+    consumer = build_consumer()
+    if args.command == 'dead-letters':
+        asyncio.run(list_dead_letters(consumer, args.count))
+    elif args.command == 'replay':
+        asyncio.run(replay_dead_letters(consumer, args.ids, args.count))
+    else:
+        bot.check_required_configs()
+        asyncio.run(run_worker(consumer))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import asyncio
+from types import SimpleNamespace
+
+from event_stream import EventStreamConsumer
+from inflight import STOP, GenerationCancelled, InflightRegistry
+
+
+class FakeStreamClient:
+    """按批次返回事件的最小 Redis Stream 客户端，每次 XREADGROUP 返回一批"""
+
+    def __init__(self, batches, interval=0.05):
+        self.batches = list(batches)
+        self.interval = interval
+        self.acked = []
+
+    async def xgroup_create(self, *args, **kwargs):
+        pass
+
+    async def xreadgroup(self, group, consumer, streams, count=None, block=None):
+        await asyncio.sleep(self.interval)
+        if not self.batches:
+            return []
+        return [('feishu:events', self.batches.pop(0))]
+
+    async def xack(self, stream, group, *entry_ids):
+        self.acked.extend(entry_ids)
+
+    async def xclaim(self, *args, **kwargs):
+        return []
+
+    async def xautoclaim(self, *args, **kwargs):
+        return ['0-0', [], []]
+
+
+def entry(entry_id, event_id, text, key='ou_1'):
+    return entry_id, {'event_id': event_id, 'key': key, 'text': text}
+
+
+async def consume(batches, on_receive=None, timeout=3.0):
+    """消费给定批次的事件，生成任务在同一用户键下排在 /停止 之前"""
+    registry = InflightRegistry()
+    results = {}
+
+    async def handler(fields):
+        if fields['text'] == '/停止':
+            results['stopped'] = registry.pop_stopped(fields['key'])
+            return
+        try:
+            await registry.run(fields['key'], fields['event_id'], asyncio.sleep(30))
+            results['generated'] = True
+        except GenerationCancelled as e:
+            results['cancelled'] = e.reason
+
+    client = FakeStreamClient(batches)
+    consumer = EventStreamConsumer(SimpleNamespace(client=client), block=0.05, claim_idle=60)
+    hook = (lambda fields: on_receive(registry, fields)) if on_receive else None
+    task = asyncio.ensure_future(consumer.run(handler, on_receive=hook))
+    deadline = asyncio.get_running_loop().time() + timeout
+    while 'stopped' not in results and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.02)
+    consumer.stop()
+    await task
+    await consumer.drain(timeout=0.1)
+    return results, client
+
+
+def stop_on_receive(registry, fields):
+    if fields['text'] == '/停止':
+        registry.cancel(fields['key'], STOP)
+
+
+def test_stop_cancels_generation_queued_under_same_key():
+    results, client = asyncio.run(consume(
+        [[entry('1-0', 'ev1', '写一篇长文')], [entry('2-0', 'ev2', '/停止')]],
+        on_receive=stop_on_receive
+    ))
+    assert results == {'cancelled': STOP, 'stopped': 1}
+    assert client.acked == ['1-0', '2-0']
+
+
+def test_on_receive_errors_do_not_block_dispatch():
+    def broken(registry, fields):
+        raise ValueError('bad payload')
+
+    results, client = asyncio.run(consume([[entry('1-0', 'ev1', '/停止')]], on_receive=broken))
+    assert results == {'stopped': 0}
+    assert client.acked == ['1-0']
@@ -0,0 +1,47 @@
+import asyncio
+import json
+
+from stream_card import StreamingCardReply
+
+
+class FakeSender:
+    """记录发出和更新的卡片正文"""
+
+    def __init__(self):
+        self.sent = []
+        self.patched = []
+
+    async def send_message(self, receive_id, msg_type, content, receive_id_type='open_id', uuid=None):
+        self.sent.append(card_text(content))
+        return 'om_1'
+
+    async def patch_message(self, message_id, content):
+        self.patched.append(card_text(content))
+
+
+def card_text(content):
+    return json.loads(content)['body']['elements'][-1]['content']
+
+
+async def stream(chunks, **kwargs):
+    sender = FakeSender()
+    card = StreamingCardReply(sender, 'ou_1', update_interval=0, **kwargs)
+    for chunk in chunks:
+        await card.feed(chunk)
+    await card.finish()
+    return card, sender
+
+
+def test_reasoning_creates_placeholder_card_before_answer():
+    chunks = [{'reasoning_content': '想'}] * 100 + [{'content': '答案'}]
+    card, sender = asyncio.run(stream(chunks))
+    assert sender.sent == ['🤔 思考中...']
+    assert sender.patched[-1] == '答案'
+    assert card.content == '答案'
+
+
+def test_reasoning_only_stream_finishes_with_empty_notice():
+    card, sender = asyncio.run(stream([{'reasoning_content': '想'}] * 3))
+    assert card.created
+    assert card.content == ''
+    assert sender.patched[-1] == StreamingCardReply.EMPTY_NOTICE
@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter
+
+from metrics import USAGE_FIELDS, USAGE_FLUSHES
+
+logger = logging.getLogger(__name__)
+
+# 用量统计范围
+USER = 'user'
+CHAT = 'chat'
+# 哈希中除 token 类型外额外记录的调用次数字段
+REQUESTS_FIELD = 'requests'
+
+
+def usage_total(values):
+    """输入与输出 token 合计，额度按该值计算"""
+    return int(values.get('prompt', 0)) + int(values.get('completion', 0))
+
+
+class UsageAccountant:
+    """按用户/会话/天累计 DeepSeek token 用量并检查每日额度
+
+    每次调用的 usage 先累计在进程内，由后台任务每 flush_interval 秒通过一次 pipeline 批量
+    HINCRBY 写入 Redis 哈希 usage:{user|chat}:{ID}:{YYYYMMDD}，不在消息热路径上单独写 Redis。
+    额度检查使用 Redis 中已写入的用量（短暂缓存）加上本进程尚未写入的增量，多进程部署时为软限制。
+    """
+
+    def __init__(self, redis_store, user_daily_limit=0, chat_daily_limit=0, flush_interval=5.0, cache_ttl=10.0,
+                 retention_days=35, key_prefix='usage', circuit_breaker=None):
+        """
+        Args:
+            redis_store: AsyncRedisStore 实例
+            user_daily_limit: 单个用户每日 token 额度（输入+输出），0 表示不限
+            chat_daily_limit: 单个会话每日 token 额度，0 表示不限
+            flush_interval: 批量写入 Redis 的间隔（秒）
+            cache_ttl: 额度检查时 Redis 已写入用量的缓存秒数
+            retention_days: 每日用量哈希的保留天数
+            key_prefix: Redis 键前缀
+            circuit_breaker: Redis 熔断器，为 None 时不熔断
+        """
+        self.redis_store = redis_store
+        self.user_daily_limit = user_daily_limit
+        self.chat_daily_limit = chat_daily_limit
+        self.flush_interval = flush_interval
+        self.cache_ttl = cache_ttl
+        self.retention_seconds = int(retention_days * 86400)
+        self.key_prefix = key_prefix
+        self.circuit_breaker = circuit_breaker
+        # Redis 键 -> 尚未写入的增量
+        self._pending = {}
+        # Redis 键 -> (读取时间, 已写入用量)
+        self._remote = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        # 写入与读取 Redis 互斥，读到的用量加上进程内增量不会漏算或重复计算
+        self._io_lock = None
+
+    def key(self, scope, scope_id, day=None):
+        return f"{self.key_prefix}:{scope}:{scope_id}:{day or time.strftime('%Y%m%d')}"
+
+    def _keys(self, user_open_id, chat_id, day=None):
+        keys = []
+        if user_open_id:
+            keys.append((USER, self.key(USER, user_open_id, day)))
+        if chat_id:
+            keys.append((CHAT, self.key(CHAT, chat_id, day)))
+        return keys
+
+    def record(self, user_open_id, chat_id, usage):
+        """累计一次 DeepSeek 调用的 usage，需在事件循环中调用，由后台任务批量写入 Redis"""
+        if not usage:
+            return
+        delta = Counter({REQUESTS_FIELD: 1})
+        for field, name in USAGE_FIELDS:
+            value = usage.get(field)
+            if value:
+                delta[name] += int(value)
+        with self._lock:
+            for _, key in self._keys(user_open_id, chat_id):
+                self._pending.setdefault(key, Counter()).update(delta)
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._flusher = loop.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        # 有待写入的用量时才运行，写完即退出，下次 record 时重新创建
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def _get_io_lock(self):
+        if self._io_lock is None:
+            self._io_lock = asyncio.Lock()
+        return self._io_lock
+
+    async def flush(self):
+        """把进程内累计的用量批量写入 Redis，失败时保留到下次写入"""
+        async with self._get_io_lock():
+            await self._flush_locked()
+
+    async def _flush_locked(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            await self._call_redis(self._write, pending)
+        except Exception as e:
+            USAGE_FLUSHES.labels('error').inc()
+            logger.error("写入用量统计失败，%s 个键留待下次写入: %s", len(pending), e)
+            with self._lock:
+                for key, delta in pending.items():
+                    self._pending.setdefault(key, Counter()).update(delta)
+            return
+        USAGE_FLUSHES.labels('ok').inc()
+        with self._lock:
+            for key, delta in pending.items():
+                cached = self._remote.get(key)
+                if cached is not None:
+                    self._remote[key] = (cached[0], cached[1] + usage_total(delta))
+
+    async def _write(self, pending):
+        pipe = self.redis_store.client.pipeline(transaction=False)
+        for key, delta in pending.items():
+            for field, value in delta.items():
+                pipe.hincrby(key, field, value)
+            pipe.expire(key, self.retention_seconds)
+        await pipe.execute()
+
+    async def _call_redis(self, func, *args):
+        if self.circuit_breaker is None:
+            return await func(*args)
+        return await self.circuit_breaker.call(func, *args)
+
+    async def check_quota(self, user_open_id, chat_id=None):
+        """检查今日额度
+
+        Returns:
+            未超额时为 None，否则为 (USER/CHAT, 已用 token 数, 额度)
+        """
+        limits = {USER: self.user_daily_limit, CHAT: self.chat_daily_limit}
+        keys = [(scope, key) for scope, key in self._keys(user_open_id, chat_id) if limits[scope] > 0]
+        if not keys:
+            return None
+        totals = await self._totals([key for _, key in keys])
+        for (scope, key), used in zip(keys, totals):
+            if used >= limits[scope]:
+                return scope, used, limits[scope]
+        return None
+
+    async def _totals(self, keys):
+        now = time.monotonic()
+        stale = [key for key in keys if key not in self._remote or now - self._remote[key][0] >= self.cache_ttl]
+        if stale:
+            try:
+                async with self._get_io_lock():
+                    values = await self._call_redis(self._read, stale)
+                with self._lock:
+                    for key, value in zip(stale, values):
+                        self._remote[key] = (now, usage_total(value))
+                    # 清理过期的缓存，避免长期运行时无限增长
+                    if len(self._remote) > 10000:
+                        self._remote = {k: v for k, v in self._remote.items() if now - v[0] < self.cache_ttl}
+            except Exception as e:
+                # 读取失败时放行，只按本进程的用量计算
+                logger.warning("读取用量统计失败，仅按本进程用量检查额度: %s", e)
+        with self._lock:
+            return [self._remote.get(key, (now, 0))[1] + usage_total(self._pending.get(key, {})) for key in keys]
+
+    async def _read(self, keys):
+        pipe = self.redis_store.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, 'prompt', 'completion')
+        results = await pipe.execute()
+        return [{'prompt': prompt or 0, 'completion': completion or 0} for prompt, completion in results]
+
+    async def get_usage(self, user_open_id, chat_id=None, day=None):
+        """读取某天的用量明细，包含本进程尚未写入的增量
+
+        Returns:
+            {USER/CHAT: {'requests': 次数, 'prompt': 输入, 'completion': 输出, 'cache_hit': 缓存命中, ...}}
+        """
+        keys = self._keys(user_open_id, chat_id, day)
+        pipe = self.redis_store.client.pipeline(transaction=False)
+        for _, key in keys:
+            pipe.hgetall(key)
+        async with self._get_io_lock():
+            results = await self._call_redis(pipe.execute)
+        usage = {}
+        with self._lock:
+            for (scope, key), stored in zip(keys, results):
+                values = Counter({field: int(value) for field, value in stored.items()})
+                values.update(self._pending.get(key, {}))
+                usage[scope] = values
+        return usage
+
+    async def close(self):
+        """停止后台任务并写入剩余用量，供应用关闭时调用"""
+        if self._flusher is not None and not self._flusher.done() and self._flusher.get_loop() is asyncio.get_running_loop():
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+        self._flusher = None
+        await self.flush()
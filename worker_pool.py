@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import threading
+
+from scheduler import KeyedScheduler, QueueFullError
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWorkerPool:
+    """在独立事件循环线程上运行的异步工作池
+
+    HTTP 回调线程只负责把任务放入有界队列并立即返回，
+    由固定数量的 asyncio worker 在同一个事件循环中并发消费队列。
+    同一会话键的任务严格按提交顺序执行，不同会话之间并行。
+    """
+
+    def __init__(self, worker_count=16, queue_size=200, submit_timeout=0.5, shutdown_timeout=30.0,
+                 max_pending_per_key=20, name='message-worker'):
+        """
+        Args:
+            worker_count: 并发 worker 数量，即跨会话的全局并发上限
+            queue_size: 队列最大深度，超出后触发背压
+            submit_timeout: 队列满时提交方最多等待的秒数，超时抛出 QueueFullError
+            shutdown_timeout: 关闭时等待队列排空的最长秒数，超时后丢弃剩余任务
+            max_pending_per_key: 单个会话最多排队的任务数，防止单个用户占满队列
+            name: 线程及日志名称
+        """
+        self.worker_count = worker_count
+        self.queue_size = queue_size
+        self.submit_timeout = submit_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.name = name
+        self.loop = None
+        self._scheduler = KeyedScheduler(
+            concurrency=worker_count,
+            max_pending=queue_size,
+            max_pending_per_key=max_pending_per_key,
+            name=name
+        )
+        self._thread = None
+        self._ready = threading.Event()
+        self._accepting = False
+        self._startup_hooks = []
+        self._shutdown_hooks = []
+
+    def add_startup_hook(self, coro_func):
+        """注册在事件循环启动后执行的协程函数（如创建连接池）"""
+        self._startup_hooks.append(coro_func)
+
+    def add_shutdown_hook(self, coro_func):
+        """注册在 worker 退出后、事件循环关闭前执行的协程函数（如关闭连接池）"""
+        self._shutdown_hooks.append(coro_func)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def qsize(self):
+        """当前排队中及执行中的任务数"""
+        return self._scheduler.pending
+
+    def start(self):
+        """启动事件循环线程和 worker，阻塞直到可以接收任务"""
+        if self.running:
+            return
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._run_loop, name=self.name, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        self._accepting = True
+        logger.info("工作池已启动，worker数: %s, 队列深度: %s", self.worker_count, self.queue_size)
+
+    def _run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        for hook in self._startup_hooks:
+            try:
+                self.loop.run_until_complete(hook())
+            except Exception as e:
+                logger.exception("工作池启动钩子执行失败: %s", e)
+        self.loop.run_until_complete(self._start_scheduler())
+        self._ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    async def _start_scheduler(self):
+        self._scheduler.start()
+
+    def submit(self, coro_func, *args, key=None):
+        """线程安全地提交任务，由 worker 以 coro_func(*args) 方式执行
+
+        相同 key 的任务按提交顺序串行执行，key 为 None 时不保序。
+        队列满时最多等待 submit_timeout 秒，仍无空位则抛出 QueueFullError。
+        """
+        if not self._accepting or not self.running:
+            raise QueueFullError("工作池未运行，拒绝新任务")
+        future = asyncio.run_coroutine_threadsafe(
+            self._scheduler.put(key, coro_func, args, timeout=self.submit_timeout),
+            self.loop
+        )
+        # 额外预留一点时间给跨线程调度，避免误判超时
+        future.result(timeout=self.submit_timeout + 1)
+
+    def submit_nowait(self, coro_func, *args, key=None):
+        """不等待地提交任务，队列满时立即抛出 QueueFullError，只能在工作池事件循环线程中调用"""
+        self._scheduler.put_nowait(key, coro_func, args)
+
+    def run(self, coro, timeout=None):
+        """在工作池事件循环上同步执行一个协程并返回结果"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout=timeout)
+
+    async def _shutdown(self):
+        pending = self._scheduler.pending
+        if pending:
+            logger.info("等待工作队列排空，剩余任务: %s", pending)
+        if not await self._scheduler.join(timeout=self.shutdown_timeout):
+            logger.warning("工作队列未能在 %s 秒内排空，丢弃剩余任务: %s", self.shutdown_timeout, self._scheduler.pending)
+        await self._scheduler.stop()
+        for hook in self._shutdown_hooks:
+            try:
+                await hook()
+            except Exception as e:
+                logger.exception("工作池关闭钩子执行失败: %s", e)
+
+    def stop(self):
+        """停止接收新任务，等待队列排空后关闭事件循环线程"""
+        if not self.running:
+            return
+        self._accepting = False
+        try:
+            self.run(self._shutdown(), timeout=self.shutdown_timeout + 5)
+        except Exception as e:
+            logger.error("关闭工作池异常: %s", e)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+        logger.info("工作池已关闭")